@@ -1,9 +1,9 @@
 import multiprocessing as mp
 import os
-import pickle
 import re
+import threading
+from functools import partial
 
-import gammatone.gtgram as gt
 import matplotlib.pyplot as plt
 import mutagen
 import numpy as np
@@ -11,6 +11,15 @@ import soundfile as sf
 import tqdm
 from scipy import signal
 
+import filterbank
+import instrument
+from library import (append_ledger, load_manifest, record_failure, refresh_record, save_manifest,
+                     scan_file, tag_from_metadata, walk_library)
+from locations import LOCATIONS, LocationStore
+from scheduler import MemoryScheduler
+from stages import StagedPipeline
+from store import FeatureStore
+
 TEST_REGEX = re.compile('Toby Fox|Darren|CHV|STRFKR|Starfucker|Presidents|Passion|Panic|VARIOUS|Imagine|Glass|Death Cab'
                         '|Foo|Emanc|Avi|Coldplay|AWOL|Orchest|WALK|Walk|Juke|'
                         'kingur|Group|Vulf|Finish|Beautiful|Counting'
@@ -26,7 +35,9 @@ TEST_REGEX = re.compile('Toby Fox|Darren|CHV|STRFKR|Starfucker|Presidents|Passio
                         'Roosevelt|dead|Cro|Clean|Childish|Cinedelic|Pearl|Beck|Butthole|Red Hot|The Chainsmokers')
 
 
-def make_spect(filepath, method='fourier', height=60, interval=1, verbose=False, max_len=1080):
+@instrument.timed('analysis.song')
+def make_spect(filepath, method='fourier', height=60, interval=1, verbose=False, max_len=1080, stream=False,
+               blocksize=2 ** 16, crop=None):
     """
     Turns a file containing sound data into a matrix for processing. Two methods are supported,
     fourier spectrum analysis, which returns a spectrogram, and gammatone which returns a gammatone quefrency cepstrum.
@@ -47,43 +58,385 @@ def make_spect(filepath, method='fourier', height=60, interval=1, verbose=False,
 
     :param bool verbose: toggles behavior showing a plot of the returned 'gram.
 
-    :return: np.array
-    a matrix representing (in decibels) the completed analysis.
-    """
-    try:
-        data, sr = sf.read(filepath)
-    except RuntimeError:
-        return None
+    :param bool stream: for gammatones, read the file in blocks of `blocksize` frames instead of all at once. Memory use
+    is then bounded by the block size rather than the length of the song, so ``max_len`` stops mattering much.
 
-    if len(data) // sr > max_len:
-        return None
+    :param int blocksize: the number of frames to read at a time when streaming, and to filter at a time for gammatones.
 
-    if verbose:
-        plt.figure()
+    :param int crop: for gammatones, only analyze the middle `crop` time bins of the song. This gives the same result as
+    ``learning.cropped_corpus`` with ``tar_len=crop``, but only the excerpt (and a little before it, to let the filters
+    settle) is ever decoded. Songs with fewer time bins than that are analyzed in full. Should be even, like `tar_len`.
 
-    if method == 'fourier':
-        f, t, sxx = signal.spectrogram(data[:, 0], sr)
+    :return: np.array
+    a matrix representing (in decibels) the completed analysis.
+    """
+    if method == 'gamma':
+        window = decode_window(filepath, height, interval, crop=crop, max_len=max_len, stream=stream,
+                               blocksize=blocksize)
+        if window is None:
+            return None
+        try:
+            sxx = gamma_window(window, height, interval, blocksize=blocksize)
+        except RuntimeError:
+            return None
+        del window
+        if verbose:
+            plt.figure()
+            plt.pcolormesh(10 * np.log10(sxx))
+            plt.show()
+    elif method == 'fourier':
+        if stream or crop:
+            raise ValueError('Streaming and cropping are only supported for gammatones.')
+        try:
+            with instrument.span('analysis.decode', song=filepath):
+                data, sr = sf.read(filepath, always_2d=True)
+        except RuntimeError:
+            return None
+
+        if len(data) // sr > max_len:
+            return None
+
+        with instrument.span('analysis.spectrogram'):
+            f, t, sxx = signal.spectrogram(data[:, 0], sr)
         del data
 
         if verbose:
+            plt.figure()
             plt.pcolormesh(t, f, 10 * np.log10(sxx))
             plt.ylabel('Frequency [Hz]')
             plt.xlabel('Time [sec]')
             plt.show()
-    elif method == 'gamma':
-        sxx = gt.gtgram(data[:, 0], sr, interval, interval, height, 20)
-        del data
-        if verbose:
-            plt.pcolormesh(10 * np.log10(sxx))
-            plt.show()
     else:
         raise ValueError(f'{method} is not a valid method.')
-    with np.testing.suppress_warnings() as sup:
+    return decibels(sxx)
+
+
+def decibels(sxx):
+    """
+    Converts a spectrogram or gammatonegram to decibels.
+
+
+    :param sxx: np.array
+
+    :return: np.array
+    """
+    with np.testing.suppress_warnings() as sup, instrument.span('analysis.decibels'):
         sup.filter(RuntimeWarning)
         # This is because log10 will throw a warning when it coerces a 0 to Nan and I find that obnoxious.
         return 10 * np.log10(sxx)
 
 
+def feature_config(config=None):
+    """
+    Fills in the defaults for a feature config, a dict describing one analysis for ``make_spects``. The keys are
+    'method', 'height', 'interval' and 'crop', with the same meanings as in ``make_spect``, and default to a gammatone
+    analysis with a height of 16, 1 second time bins and no cropping, which is what ``preprocess`` has always done.
+
+
+    :param config: dict or NoneType
+
+    :return: dict
+    """
+    full = {'method': 'gamma', 'height': 16, 'interval': 1, 'crop': None}
+    full.update(config or {})
+    if full['method'] not in ('gamma', 'fourier'):
+        raise ValueError(f'{full["method"]} is not a valid method.')
+    if full['method'] == 'fourier' and full['crop']:
+        raise ValueError('Cropping is only supported for gammatones.')
+    return full
+
+
+def config_name(config):
+    """
+    A short name for a feature config, used as its namespace in the feature store.
+
+
+    :param config: dict
+
+    :return: str e.g. 'gamma-h16-i1-c120'
+    """
+    config = feature_config(config)
+    if config['method'] == 'fourier':
+        return 'fourier'
+    name = f"gamma-h{config['height']}-i{config['interval']}"
+    if config['crop']:
+        name += f"-c{config['crop']}"
+    return name
+
+
+def decode_windows(filepath, configs, max_len=1080):
+    """
+    The reading half of ``make_spects``. Works out which stretch of the song each config needs (see ``center_window``)
+    and decodes the smallest window that covers all of them, once.
+
+
+    :param str filepath: path to file
+
+    :param configs: list of feature configs, see ``feature_config``
+
+    :param max_len: see ``make_spect``
+
+    :return: tuple (samples, sample rate, where the samples start in the song, list of (first sample, sample count)
+    wanted by each config), or None if the song can't be read or is too long.
+    """
+    try:
+        info = sf.info(filepath)
+    except RuntimeError:
+        return None
+    if info.frames // info.samplerate > max_len:
+        return None
+
+    start, end = info.frames, 0
+    plans = []
+    for config in map(feature_config, configs):
+        if config['method'] == 'fourier':
+            first, count, warm_up = 0, info.frames, 0
+        else:
+            bank = filterbank.ERBFilterbank(info.samplerate, config['interval'], config['height'], 20)
+            first, count, warm_up = center_window(info.frames, bank, config['crop'])
+        plans.append((first + warm_up, count - warm_up))
+        start = min(start, first)
+        end = max(end, first + count)
+
+    try:
+        with instrument.span('analysis.decode', song=filepath, frames=max(0, end - start)):
+            data, _ = sf.read(filepath, start=start, frames=max(0, end - start), always_2d=True, dtype='float32')
+    except RuntimeError:
+        return None
+    return np.ascontiguousarray(data[:, 0]), info.samplerate, start, plans
+
+
+def analyze_windows(decoded, configs, blocksize=2 ** 16):
+    """
+    The computing half of ``make_spects``. Gammatone configs with the same height share one filterbank, which filters
+    the decoded window once and feeds a ``filterbank.TimeBins`` for each of them, so sweeping `interval` or `crop`
+    costs hardly more than a single analysis.
+
+
+    :param tuple decoded: as returned by ``decode_windows``
+
+    :param configs: the same list of feature configs that was decoded for.
+
+    :param int blocksize: see ``make_spect``
+
+    :return: list of np.array, in decibels, one per config.
+    """
+    samples, sr, start, plans = decoded
+    configs = [feature_config(config) for config in configs]
+    results = [None] * len(configs)
+    heights = {}
+    for i, (config, (first, count)) in enumerate(zip(configs, plans)):
+        if config['method'] == 'fourier':
+            with instrument.span('analysis.spectrogram'):
+                f, t, sxx = signal.spectrogram(samples[first - start:first - start + count].astype(np.float64), sr)
+            results[i] = decibels(sxx)
+        else:
+            heights.setdefault(config['height'], []).append(i)
+
+    for height, members in heights.items():
+        bank = filterbank.ERBFilterbank(sr, configs[members[0]]['interval'], height, 20, blocksize=blocksize)
+        bins = {i: filterbank.TimeBins(filterbank.window_samples(configs[i]['interval'], sr), height,
+                                       skip=plans[i][0] - start, limit=plans[i][1]) for i in members}
+        columns = {i: [] for i in members}
+        with instrument.span('analysis.filterbank', height=height, configs=len(members)):
+            for xe in bank.energy(samples):
+                for i in members:
+                    columns[i] += bins[i].add(xe)
+        for i in members:
+            sxx = np.column_stack(columns[i]) if columns[i] else np.zeros((height, 0))
+            results[i] = decibels(sxx.astype(np.float32))
+    return results
+
+
+@instrument.timed('analysis.song')
+def make_spects(filepath, configs, max_len=1080, blocksize=2 ** 16):
+    """
+    Runs several analyses of the same song from a single decode, for parameter sweeps. See ``decode_windows`` and
+    ``analyze_windows`` for how the work is shared.
+
+
+    :param str filepath: path to file
+
+    :param configs: list of feature configs, see ``feature_config``
+
+    :param max_len: see ``make_spect``
+
+    :param blocksize: see ``make_spect``
+
+    :return: list of np.array, one per config, or None if the song can't be read or is too long.
+    """
+    decoded = decode_windows(filepath, configs, max_len=max_len)
+    if decoded is None:
+        return None
+    return analyze_windows(decoded, configs, blocksize=blocksize)
+
+
+def decode_window(filepath, height=16, interval=1, crop=None, max_len=1080, stream=False, blocksize=2 ** 16):
+    """
+    Does the reading half of a gammatone analysis. Works out which part of the song is needed (see ``center_window``)
+    and decodes the first channel of it. This is all I/O, so it's safe to do on a thread.
+
+
+    :param str filepath: path to file
+
+    :param height: see ``make_spect``
+
+    :param interval: see ``make_spect``
+
+    :param crop: see ``make_spect``
+
+    :param max_len: see ``make_spect``
+
+    :param stream: bool rather than decoding it all now, return a generator that decodes it `blocksize` at a time.
+
+    :param blocksize: see ``make_spect``
+
+    :return: tuple (blocks, sample rate, warm_up) for ``gamma_window``, or None if the song can't be read or is too
+    long. blocks is a list of one array unless streaming.
+    """
+    try:
+        info = sf.info(filepath)
+    except RuntimeError:
+        return None
+    if info.frames // info.samplerate > max_len:
+        return None
+
+    bank = filterbank.ERBFilterbank(info.samplerate, interval, height, 20, blocksize=blocksize)
+    start, frames, warm_up = center_window(info.frames, bank, crop)
+    if stream:
+        blocks = (block[:, 0] for block in sf.blocks(filepath, blocksize=blocksize, start=start, frames=frames,
+                                                     always_2d=True, dtype='float32'))
+    else:
+        try:
+            with instrument.span('analysis.decode', song=filepath, frames=frames):
+                data, _ = sf.read(filepath, start=start, frames=frames, always_2d=True, dtype='float32')
+        except RuntimeError:
+            return None
+        blocks = [np.ascontiguousarray(data[:, 0])]
+    return blocks, info.samplerate, warm_up
+
+
+def gamma_window(window, height=16, interval=1, blocksize=2 ** 16):
+    """
+    Does the computing half of a gammatone analysis, on what ``decode_window`` read.
+
+
+    :param tuple window: as returned by ``decode_window``
+
+    :param height: see ``make_spect``
+
+    :param interval: see ``make_spect``
+
+    :param blocksize: see ``make_spect``
+
+    :return: np.array the gammatonegram, not yet in decibels.
+    """
+    blocks, sr, warm_up = window
+    bank = filterbank.ERBFilterbank(sr, interval, height, 20, blocksize=blocksize)
+    # When streaming, the blocks are decoded as they're filtered, so that's in here too.
+    with instrument.span('analysis.filterbank', height=height, streamed=not isinstance(blocks, list)):
+        columns = list(bank.stream(blocks, warm_up=warm_up))
+    if columns:
+        return np.column_stack(columns)
+    return np.zeros((height, 0), dtype=np.float32)
+
+
+def analyze_window(window, height=16, interval=1, blocksize=2 ** 16):
+    """
+    ``gamma_window``, in decibels, the same as ``make_spect`` would return. This is what ``stages.StagedPipeline``
+    runs on its process pool.
+
+
+    :param tuple window: as returned by ``decode_window``
+
+    :return: np.array
+    """
+    return decibels(gamma_window(window, height, interval, blocksize))
+
+
+def stream_gtgram(blocks, sr, interval, channels, f_min):
+    """
+    A streaming version of ``gammatone.gtgram.gtgram``. Takes an iterable of 1D blocks of samples and yields the
+    columns of the gammatonegram one at a time, as soon as each time bin is complete. The filter state is carried
+    across block edges by a ``filterbank.ERBFilterbank``, so the result is the same as running the analysis on the
+    whole song, with the window and hop both set to `interval`. Only whole time bins are emitted, any leftover samples
+    at the end are dropped, just like ``gtgram`` does.
+
+
+    :param blocks: iterable of np.array, consecutive chunks of a mono signal.
+
+    :param int sr: sample rate
+
+    :param num interval: the width in seconds of the time bins.
+
+    :param int channels: how many filters to use.
+
+    :param num f_min: lowest centre frequency of the filterbank.
+
+    :return: generator of np.array, each of length `channels`.
+    """
+    return filterbank.ERBFilterbank(sr, interval, channels, f_min).stream(blocks)
+
+
+def estimate_memory(frames, samplerate, channels=2, height=16, interval=1, stream=False, crop=None,
+                    blocksize=2 ** 16):
+    """
+    A rough upper bound on how much memory ``make_spect`` will need for a gammatone analysis of a song, for scheduling
+    purposes. Everything read from the header of the file by ``sf.info`` is enough to work it out, so nothing needs to
+    be decoded.
+
+
+    :param int frames: the length of the song in frames
+
+    :param int samplerate: its sample rate
+
+    :param int channels: how many audio channels it has
+
+    :param height: see ``make_spect``
+
+    :param interval: see ``make_spect``
+
+    :param stream: see ``make_spect``
+
+    :param crop: see ``make_spect``
+
+    :param blocksize: see ``make_spect``
+
+    :return: int bytes
+    """
+    if crop is not None:
+        frames = min(frames, int((crop * interval + 1) * samplerate))
+    decoded = (blocksize if stream else frames) * channels * 4
+    # The filterbank keeps the spectra of its filters, and works on a complex and a real copy of each block.
+    nfft = 2 * blocksize + samplerate
+    filtering = height * nfft * (8 + 4 + 4)
+    return int(decoded + filtering + frames // samplerate // interval * height * 4)
+
+
+def center_window(frames, bank, crop=None):
+    """
+    Works out which frames of a song have to be decoded to analyze only its middle `crop` time bins. The window starts
+    ``bank.taps - 1`` frames early, so that the filters have seen exactly the same samples they would have if the whole
+    song had been analyzed.
+
+
+    :param int frames: the length of the song in frames, as given by ``sf.info``.
+
+    :param bank: filterbank.ERBFilterbank that will do the analysis.
+
+    :param crop: int or NoneType, the number of time bins wanted. None means the whole song.
+
+    :return: tuple (start, frames, warm_up), where to seek to, how much to decode, and how many of the decoded frames
+    only serve to warm up the filters.
+    """
+    columns = max(0, 1 + (frames - bank.nwin) // bank.nwin)
+    if crop is None or columns <= crop:
+        return 0, frames, 0
+    first = (columns // 2 - crop // 2) * bank.nwin
+    start = max(0, first - (bank.taps - 1))
+    return start, first - start + crop * bank.nwin, first - start
+
+
 def song_name_gen(fname: str):
     """
     A utility function which takes a file name and strips out all the stuff that's probably not the song title.
@@ -102,6 +455,7 @@ def song_name_gen(fname: str):
 def library_addition(library, target, locale='D:\\What.cd\\', filetype='.flac'):
     """
     A utility for recursively adding files of type filetype to a list. Stores them as a list of their full location.
+    See ``library.walk_library`` for a version with more options.
 
 
     :param library: list the library you're adding to.
@@ -120,42 +474,44 @@ def library_addition(library, target, locale='D:\\What.cd\\', filetype='.flac'):
 
     :return: NoneType
     """
-    try:
-        nodes = os.listdir(locale + target)
-    except NotADirectoryError:
-        return None
-    for file in nodes:
-        if file.endswith(filetype):
-            library.append(locale + target + '\\' + file)
-        else:
-            library_addition(library, file, locale=(locale + target + '\\'))
+    library.extend(walk_library(os.path.join(locale, target), extensions=(filetype,)))
 
 
-def gt_and_store(song_loc, locale='cepstra\\'):
+def gt_and_store(song_loc, store='cepstra.store', stream=False, crop=None, tag=None):
     """
-    This calculates the gammatone cepstrum, pickles it, and drops it in a designated folder. Default is a folder called
-    cepstra. This acts like a worker function, so it doesn't return anything.
+    Calculates the gammatone cepstrum of one song and appends it to the feature store, in the same namespace
+    ``preprocess`` would put it in. Songs already in there are left alone.
+
+    This used to pickle each cepstrum into a folder of its own, next to ``cepstrum_location``, which said where. The
+    store has replaced that folder, so ``cepstrum_location`` is gone, and this is only kept for scripts that analyze a
+    song at a time. Only one process should write to a store at once, so use ``preprocess`` for a whole library.
 
 
     :param song_loc: str filepath
 
-    :param locale: str folder to drop cepstra in
+    :param store: str location of the ``store.FeatureStore``.
 
-    :return: NoneType
+    :param stream: bool use the bounded-memory streaming analysis, see ``make_spect``.
+
+    :param crop: int or NoneType only analyze the middle `crop` seconds, see ``make_spect``.
+
+    :param tag: str or NoneType the song's corpus tag, if you already know it. Saves opening the file with mutagen.
+
+    :return: str the tag, or False if the song couldn't be analyzed.
     """
-    tag = corpus_tag_generator(song_loc)
-    filename = f'{locale}{tag}.pkl'
-    filename = re.sub('[?*:"<>/|]', "", filename)
-    if not os.path.exists(filename):
-        cepstrum = make_spect(song_loc, method='gamma', height=16)
+    if tag is None:
+        tag = corpus_tag_generator(song_loc)
+    features = FeatureStore(store, namespace=config_name({'crop': crop}))
+    if tag not in features:
+        cepstrum = make_spect(song_loc, method='gamma', height=16, stream=stream, crop=crop)
         if cepstrum is None:
             return False
-        with open(filename, 'wb+') as f:
-            pickle.dump(cepstrum, f)
-            return tag
+        features.extend([(tag, cepstrum)])
+    return tag
 
 
-def library_from_regex(target_regex, library_locale='D:\\What.cd\\'):
+def library_from_regex(target_regex, library_locale='D:\\What.cd\\', exclude=None, extensions=('.flac',),
+                       include_depth=1):
     """
     Takes in a regex, and a pointer to your music library and compiles a list of song locations from it.
 
@@ -164,25 +520,34 @@ def library_from_regex(target_regex, library_locale='D:\\What.cd\\'):
 
     :param library_locale: str
 
-    :return: list
-    """
+    :param exclude: re.Pattern or NoneType skip files and folders whose names match this.
 
-    targets = []
-    lib = []
-    r = target_regex
+    :param extensions: tuple of str file extensions to include.
 
-    targets += list(filter(r.match, os.listdir(library_locale)))
-    for song in targets:
-        library_addition(lib, song, locale=library_locale)
-    return lib
+    :param include_depth: int or NoneType how many levels down to try target_regex on folder names. The default only
+    looks at the top level folders. None tries it on every folder and file.
+
+    :return: list
+    """
+    return sorted(walk_library(library_locale, include=target_regex, exclude=exclude, extensions=extensions,
+                               include_depth=include_depth))
 
 
-def preprocess(target_regex, library_locale='D:\\What.cd\\', pool_size=2):
+@instrument.timed('analysis.preprocess')
+def preprocess(target_regex, library_locale='D:\\What.cd\\', pool_size=2, stream=False, crop=None,
+               manifest='manifest.pkl', store='cepstra.store', memory_budget=None, worker_limit=None, decoders=None,
+               configs=None, resume=True, retries=2, locations=LOCATIONS):
     """
-    This runs ```gt_and_store()``` on every file which is in a folder that matches with target_regex. Some notes about
-    running this on a personal computer. If you have more than 16 GB of ram, you should be fine. If you have 16 or less,
-    Be prepared for the spin-up to lag your computer. It should stabilize after a while once the processes
-    get out of sync. Also creates a dictionary that relates corpus tags to their file location.
+    This runs the gammatone analysis on every file which is in a folder that matches with target_regex, and appends
+    the cepstra to a ``store.FeatureStore``. Some notes about running this on a personal computer. If you have more
+    than 16 GB of ram, you should be fine. If you have 16 or less, Be prepared for the spin-up to lag your computer. It
+    should stabilize after a while once the processes get out of sync. Also adds every song it analyzes to a
+    ``locations.LocationStore``, which relates corpus tags to their file location.
+
+    Everything learned about each song is kept in a manifest (see ``library.update_manifest``), so running this again
+    on the same library only reads the songs that have been added or changed since, and only analyzes those that haven't
+    been analyzed yet. Each song's outcome goes into the manifest's ledger (see ``library.append_ledger``) as soon as
+    it's known, and its cepstrum into the store, so if a run gets killed, running it again picks up where it left off.
 
 
     :param target_regex: re.compile a regex of the things you want. Might be long and full of pipes.
@@ -191,15 +556,187 @@ def preprocess(target_regex, library_locale='D:\\What.cd\\', pool_size=2):
     :param library_locale: str the location of your music library.
 
 
-    :return: a list of successes and failures for if something went wrong with a song.
+    :param pool_size: int how many songs to analyze at once.
+
+
+    :param stream: bool use the streaming analysis. Each worker then only needs a few tens of MB no matter how long
+    the song is, so `pool_size` can safely go up to the number of cores you have.
+
+
+    :param crop: int or NoneType only decode and analyze the middle `crop` seconds of each song. Use the same value you
+    intend to pass to ``learning.cropped_corpus`` as `tar_len`. Like every analysis, the cepstra go into the store's
+    namespace for it, ``config_name({'crop': crop})``, so cropped and whole songs are never mixed up. Load them with
+    ``learning.load_corpus(namespace=...)``, without one it loads the whole songs.
+
+
+    :param manifest: str location of the library manifest.
+
+
+    :param store: str location of the feature store.
+
+
+    :param locations: str location of the ``locations.LocationStore``.
+
+
+    :param memory_budget: int or NoneType bytes of RAM the analysis may use. If given, songs are handed out by a
+    ``scheduler.MemoryScheduler``, with their memory estimated by ``estimate_memory`` from the manifest, instead of a
+    fixed pool. `pool_size` is then the most songs analyzed at once, so set it to the number of cores you have.
+
+
+    :param worker_limit: int or NoneType bytes a single song may use while sharing the pool with others. Songs that go
+    over are retried on their own rather than taking the pool down.
+
+
+    :param decoders: int or NoneType if given, songs are decoded by this many threads while `pool_size` processes do
+    the filterbanks, and the results are written in batches (see ``stages.StagedPipeline``). The progress bar shows how
+    much work is queued at each stage. This helps most when the library is on a spinning disk or a network share.
+    Can't be combined with `stream`, `memory_budget` or `worker_limit`.
+
+
+    :param configs: list of feature configs or NoneType for parameter sweeps. Each song is decoded once and run through
+    every config with ``make_spects``, and each config's cepstra go into their own namespace of the store, named by
+    ``config_name``. Load them with ``learning.load_corpus(namespace=...)``. Can't be combined with `stream`, use crop
+    to keep the memory down instead.
+
+
+    :param resume: bool skip the songs that are already done, and retry the ones that failed, as long as they haven't
+    failed more than `retries` times. If False, every song is analyzed again and past failures are forgotten.
+
+
+    :param retries: int how many more times to try a song that failed, on later runs, before it's quarantined (see
+    ``library.record_failure``). Quarantined songs are left alone until the file changes, ``library.quarantined``
+    lists them.
+
+
+    :return: a list of the tags of the songs tried this time, in the order they were found, with False for the ones
+    that failed, including those whose headers still can't be read. Songs skipped as up to date or quarantined aren't
+    in it.
     """
 
-    lib = library_from_regex(target_regex, library_locale=library_locale)
-    p = mp.Pool(pool_size, maxtasksperchild=1000)
-    if not os.path.exists('cepstra'):
-        os.mkdir('cepstra')
-    tags = list(tqdm.tqdm(p.imap(gt_and_store, lib), total=len(lib)))
-    create_location_dictionary(lib, tags)
+    if decoders and (stream or memory_budget is not None or worker_limit is not None):
+        raise ValueError('The staged pipeline can\'t stream, or be scheduled against a memory budget.')
+    single = configs is None
+    if single:
+        stores = [FeatureStore(store, namespace=config_name({'crop': crop}))]
+    else:
+        if stream:
+            raise ValueError('Streaming is only supported for a single analysis.')
+        configs = [feature_config(config) for config in configs]
+        stores = [FeatureStore(store, namespace=config_name(config)) for config in configs]
+    mfst = load_manifest(manifest)
+    places = LocationStore(locations)
+    todo = []
+    # Everything tried, in the order it was found. todo is only what's handed to the pool, whose results come back by
+    # their place in it.
+    tried = []
+    # pending is run by the pool's or the decoders' threads, record by the main or the writer thread, and both of them
+    # change the manifest and append to its ledger.
+    manifest_lock = threading.Lock()
+
+    def due(song):
+        rescanned = refresh_record(mfst, song)
+        entry = mfst[song]
+        if not resume and not rescanned:
+            entry['status'] = 'new' if entry['tag'] is not None else 'failed'
+            entry['attempts'] = 0
+        if entry['status'] == 'failed' and entry['tag'] is None and not rescanned:
+            # Its header couldn't be read last time, so that's tried again first.
+            attempts = entry.get('attempts', 0)
+            mfst[song] = entry = scan_file(song)
+            if entry['tag'] is None:
+                entry['attempts'] = attempts
+                record_failure(entry, retries)
+                append_ledger(mfst, [song], manifest)
+                tried.append(song)
+                return False
+        elif entry['tag'] is None and rescanned:
+            # A new or changed file whose header can't be read. scan_file has already counted that as its first failure.
+            append_ledger(mfst, [song], manifest)
+            tried.append(song)
+            return False
+        missing = any(entry['tag'] not in features for features in stores)
+        retry = entry['status'] == 'failed' and entry['tag'] is not None
+        if entry['status'] == 'new' or retry or (entry['status'] == 'done' and missing):
+            todo.append(song)
+            tried.append(song)
+            return True
+        return False
+
+    def pending():
+        # Songs are checked against the manifest as the walk finds them, so analysis starts straight away.
+        for song in walk_library(library_locale, include=target_regex, include_depth=1):
+            with manifest_lock:
+                wanted = due(song)
+            if wanted:
+                yield song
+
+    tags = {}
+    progress = tqdm.tqdm()
+
+    def record(results):
+        if single:
+            results = [(song, None if cepstrum is None else [cepstrum]) for song, cepstrum in results]
+        for n, features in enumerate(stores):
+            features.extend([(mfst[song]['tag'], cepstra[n]) for song, cepstra in results if cepstra is not None])
+        with manifest_lock:
+            for song, cepstra in results:
+                if cepstra is None:
+                    record_failure(mfst[song], retries)
+                else:
+                    mfst[song]['status'] = 'done'
+                tags[song] = False if cepstra is None else mfst[song]['tag']
+            # Before the ledger, so a song is never marked done without its location.
+            places.update([(mfst[song]['tag'], song) for song, cepstra in results if cepstra is not None])
+            append_ledger(mfst, [song for song, _ in results], manifest)
+        failed = sum(cepstra is None for _, cepstra in results)
+        instrument.count('analysis.analyzed', len(results) - failed)
+        instrument.count('analysis.failed', failed)
+        progress.update(len(results))
+
+    if decoders:
+        if single:
+            staged = StagedPipeline(partial(decode_window, height=16, crop=crop),
+                                    partial(analyze_window, height=16), decoders=decoders, workers=pool_size)
+        else:
+            staged = StagedPipeline(partial(decode_windows, configs=configs),
+                                    partial(analyze_windows, configs=configs), decoders=decoders, workers=pool_size)
+
+        def record_staged(results):
+            record(results)
+            progress.set_postfix(staged.depths())
+
+        staged.run(pending(), record_staged)
+    else:
+        if single:
+            analyze = partial(make_spect, method='gamma', height=16, stream=stream, crop=crop)
+            height, span = 16, crop
+        else:
+            analyze = partial(make_spects, configs=configs)
+            # Sized for the biggest filterbank over the widest window any of the configs needs.
+            height = max(config['height'] for config in configs)
+            spans = [config['crop'] and config['crop'] * config['interval'] for config in configs]
+            span = None if None in spans else max(spans)
+        if memory_budget is None:
+            p = mp.Pool(pool_size, maxtasksperchild=1000)
+            cepstra = enumerate(p.imap(analyze, pending()))
+        else:
+            p = None
+            scheduler = MemoryScheduler(memory_budget, workers=pool_size, worker_limit=worker_limit)
+            cepstra = scheduler.imap_unordered(analyze, pending(),
+                                               lambda song: estimate_memory(mfst[song]['frames'],
+                                                                            mfst[song]['samplerate'],
+                                                                            mfst[song].get('channels') or 2,
+                                                                            height=height, stream=stream, crop=span))
+        for i, cepstrum in cepstra:
+            record([(todo[i], cepstrum)])
+        if p is not None:
+            p.close()
+            p.join()
+    progress.close()
+
+    save_manifest(mfst, manifest)
+    places.close()
+    return [tags.get(song, False) for song in tried]
 
 
 def corpus_tag_generator(song_loc):
@@ -211,55 +748,30 @@ def corpus_tag_generator(song_loc):
 
     :return: str the tag as used by the learning parts of the system.
     """
-    mdata = mutagen.File(song_loc)
-    try:
-        album = mdata['album'][0]
-    except KeyError:
-        album = "Unknown Album"
-    try:
-        albumartist = mdata['albumartist'][0]
-    except KeyError:
-        albumartist = mdata['artist'][0]
-    try:
-        name = re.sub('[\\\\/]', '', mdata['title'][0])
-    except KeyError:
-        name = 'Unknown Track'
+    return tag_from_metadata(mutagen.File(song_loc))
 
-    filename = f'{albumartist} - {album} - {name}'
-    filename = re.sub('[?*:"<>/|]', "", filename)
-    return filename
 
-
-def create_location_dictionary(lib, tags=None):
+def create_location_dictionary(lib, tags=None, loc=LOCATIONS):
     """
-    Takes everything in the library and adds it to a location dictionary stored in locations.pkl.
+    Adds songs to the ``locations.LocationStore`` at `loc`, or moves them there. Only their rows are written, so this
+    costs the same however big the library is. ``preprocess`` already does this for every song it analyzes, this is
+    for songs it didn't, e.g. to fill in a new store from the manifest.
 
 
     :param lib: list of song locations
 
     :param tags: list or NoneType if you already have the tag, then you don't need to generate it again.
 
+    :param loc: str location of the store.
+
 
     :return: NoneType
     """
-    if os.path.exists('../locations.pkl') and os.path.getsize('../locations.pkl') > 0:
-        with open('../locations.pkl', 'rb') as file:
-            mdata_dict = pickle.load(file)
-        os.remove('../locations.pkl')
-    else:
-        mdata_dict = {}
-
     if tags is None:
         tags = [None] * len(lib)
 
-    for song, tag in zip(lib, tags):
-        if tag:
-            mdata_dict[tag] = song
-        else:
-            mdata_dict[corpus_tag_generator(song)] = song
-
-    with open('../locations.pkl', 'wb') as file:
-        pickle.dump(mdata_dict, file)
+    with LocationStore(loc) as places:
+        places.update([(tag or corpus_tag_generator(song), song) for song, tag in zip(lib, tags)])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,132 @@
+"""
+Compares the in-project ``filterbank`` engine against the ``gammatone.gtgram`` MATLAB port it replaced. Each path runs
+in its own process so that the peak RSS it reports belongs to that path alone.
+
+    python benchmarks/bench_filterbank.py --songs 8 --seconds 240
+    python benchmarks/bench_filterbank.py --library D:\\What.cd\\Some Album
+
+The ``gammatone`` package is only needed for the comparison, it isn't a dependency of ongaku anymore.
+"""
+import argparse
+import multiprocessing as mp
+import os
+import resource
+import sys
+import tempfile
+from time import time
+
+import numpy as np
+import soundfile as sf
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import filterbank  # noqa: E402
+
+
+def synthetic_songs(folder, n, seconds, sr=44100):
+    """
+    Writes `n` stereo FLAC files of tones and noise into `folder`.
+
+    :param str folder: where to put them
+
+    :param int n: how many songs
+
+    :param num seconds: length of each song
+
+    :param int sr: sample rate
+
+    :return: list of file locations
+    """
+    rs = np.random.RandomState(0)
+    t = np.arange(int(seconds * sr)) / sr
+    songs = []
+    for i in range(n):
+        wave = 0.3 * np.sin(2 * np.pi * rs.uniform(50, 2000) * t) + 0.05 * rs.randn(len(t))
+        loc = os.path.join(folder, f'{i:03}.flac')
+        sf.write(loc, np.column_stack([wave, wave]) * 0.5, sr)
+        songs.append(loc)
+    return songs
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """
+    Peak resident set size of this process in MB.
+
+    :param who: ``resource.RUSAGE_SELF``, or ``resource.RUSAGE_CHILDREN`` for the biggest of the processes it started
+    that have finished.
+
+    :return: float
+    """
+    rss = resource.getrusage(who).ru_maxrss
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+def run_path(path, songs, height, interval, queue):
+    """
+    Analyzes every song with one of the two engines, and reports throughput, peak memory, and the output.
+
+    :param str path: 'gtgram' or 'filterbank'
+
+    :return: NoneType, results are put on `queue`.
+    """
+    out = []
+    st = time()
+    for song in songs:
+        if path == 'gtgram':
+            import gammatone.gtgram as gt
+            data, sr = sf.read(song)
+            sxx = gt.gtgram(data[:, 0], sr, interval, interval, height, 20)
+        else:
+            data, sr = sf.read(song, always_2d=True, dtype='float32')
+            sxx = filterbank.gtgram(data[:, 0], sr, interval, height, 20)
+        del data
+        with np.errstate(divide='ignore'):
+            out.append(10 * np.log10(sxx))
+    queue.put((path, len(songs) / (time() - st), peak_rss_mb(), out))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--library', help='folder of .flac files to use instead of synthetic songs')
+    parser.add_argument('--songs', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=240)
+    parser.add_argument('--height', type=int, default=16)
+    parser.add_argument('--interval', type=float, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        if args.library:
+            songs = sorted(os.path.join(args.library, f) for f in os.listdir(args.library) if f.endswith('.flac'))
+        else:
+            songs = synthetic_songs(folder, args.songs, args.seconds)
+
+        try:
+            import gammatone  # noqa: F401
+            paths = ['gtgram', 'filterbank']
+        except ImportError:
+            print('gammatone is not installed, only timing the filterbank engine.')
+            paths = ['filterbank']
+
+        ctx = mp.get_context('spawn')
+        results = {}
+        for path in paths:
+            queue = ctx.Queue()
+            proc = ctx.Process(target=run_path, args=(path, songs, args.height, args.interval, queue))
+            proc.start()
+            results[path] = queue.get()
+            proc.join()
+
+    print(f'{"path":<12}{"songs/s":>10}{"peak RSS (MB)":>16}')
+    for path, songs_per_sec, rss, _ in results.values():
+        print(f'{path:<12}{songs_per_sec:>10.3f}{rss:>16.1f}')
+
+    if len(results) == 2:
+        diffs = []
+        for ref, new in zip(results['gtgram'][3], results['filterbank'][3]):
+            mask = ref > -100
+            diffs.append(np.abs(ref - new)[mask].max())
+        print(f'max difference above -100 dB: {max(diffs):.2e} dB (tolerance {filterbank.DB_TOLERANCE} dB)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+"""
+Times every stage of ongaku, from one song's cepstrum to playlists, on synthetic libraries of a few sizes, so a change
+that makes one of them scale worse shows up here rather than on a real library. For each size a library of tagged
+FLAC files is generated (the same one every time, for a given size and length), and then each stage is run in its own
+process, after the ones before it, so the peak RSS it reports belongs to it:
+
+    make_spect      the gammatone cepstrum of a few songs, one after the other
+    preprocess      ``analysis.preprocess`` on the whole library, into a fresh store
+    load_corpus     ``learning.load_corpus`` from that store
+    make_manifold   ``learning.make_manifold`` with ``learning.default_pipeline`` (fewer components for tiny libraries)
+    index           building a ``playlists.ManifoldIndex``
+    dist_playlist   ``playlists.abs_dist_playlist`` with the index, for a few seeds
+    line_playlist   ``playlists.line_playlist`` between a few pairs of seeds
+    cone_plist      ``playlists.cone_plist`` between the same pairs
+    cyl_plist       ``playlists.cyl_plist`` between the same pairs
+
+The wall time, throughput and peak RSS of each stage at each size are written to a JSON file along with the commit
+they were measured on, and two of those files can be compared:
+
+    python benchmarks/bench_pipeline.py --sizes 100 300 1000 --out before.json
+    git checkout my-branch
+    python benchmarks/bench_pipeline.py --sizes 100 300 1000 --out after.json
+    python benchmarks/bench_pipeline.py --compare before.json after.json
+
+Pass `--libraries` to keep the generated libraries around between runs, they take a while to make at the bigger sizes.
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import pickle
+import platform
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+from time import perf_counter
+
+import numpy as np
+import soundfile as sf
+from mutagen.flac import FLAC
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+
+from bench_filterbank import peak_rss_mb  # noqa: E402
+
+SONGS_PER_ALBUM = 10
+ALBUMS_PER_ARTIST = 2
+STAGES = ['make_spect', 'preprocess', 'load_corpus', 'make_manifold', 'index', 'dist_playlist', 'line_playlist',
+          'cone_plist', 'cyl_plist']
+# What each stage needs to have run before it.
+NEEDS = {'load_corpus': 'preprocess', 'make_manifold': 'preprocess', 'index': 'make_manifold',
+         'dist_playlist': 'make_manifold', 'line_playlist': 'make_manifold', 'cone_plist': 'make_manifold',
+         'cyl_plist': 'make_manifold'}
+
+
+def needs(stage):
+    """
+    Every stage that has to run before `stage`, nearest first.
+    """
+    chain = []
+    while stage in NEEDS:
+        stage = NEEDS[stage]
+        chain.append(stage)
+    return chain
+
+
+def synthetic_library(folder, n, seconds, sr=22050):
+    """
+    Writes `n` tagged stereo FLAC files into `folder`, as ``Artist/Album/track.flac``, ten songs to an album and two
+    albums to an artist. Every song on an album is built on the same chord, with its own melody and noise on top, so
+    albums and artists are actually closer together than chance. It's seeded, so the same `n` and `seconds` always
+    make the same library, and if `folder` already holds a finished one it's left alone.
+
+    :param str folder: where to put it
+    :param int n: how many songs
+    :param num seconds: length of each song
+    :param int sr: sample rate
+    :return: str `folder`
+    """
+    done = os.path.join(folder, '.complete')
+    if os.path.exists(done):
+        return folder
+    shutil.rmtree(folder, ignore_errors=True)
+    rs = np.random.RandomState(n)
+    t = np.arange(int(seconds * sr)) / sr
+    for i in range(n):
+        album = i // SONGS_PER_ALBUM
+        artist = album // ALBUMS_PER_ARTIST
+        if i % SONGS_PER_ALBUM == 0:
+            chord = np.random.RandomState(album).uniform(60, 1000, 3)
+        wave = sum(0.15 * np.sin(2 * np.pi * f * t) for f in chord)
+        wave += 0.2 * np.sin(2 * np.pi * rs.uniform(200, 4000) * t) * (rs.rand(len(t) // sr + 1) > 0.5).repeat(sr)[
+            :len(t)]
+        wave += 0.05 * rs.randn(len(t))
+        loc = os.path.join(folder, f'Artist{artist:04}', f'Album{album:05}', f'{i % SONGS_PER_ALBUM:02}.flac')
+        os.makedirs(os.path.dirname(loc), exist_ok=True)
+        sf.write(loc, np.column_stack([wave, wave]) * 0.5, sr)
+        tags = FLAC(loc)
+        tags['artist'] = f'Artist{artist:04}'
+        tags['album'] = f'Album{album:05}'
+        tags['title'] = f'Song{i:06}'
+        tags['tracknumber'] = str(i % SONGS_PER_ALBUM + 1)
+        tags.save()
+    open(done, 'w').close()
+    return folder
+
+
+def library_songs(library):
+    return sorted(os.path.join(root, name) for root, _, names in os.walk(library) for name in names
+                  if name.endswith('.flac'))
+
+
+def load_manifold(work):
+    with open(os.path.join(work, 'manifold.pkl'), 'rb') as file:
+        return pickle.load(file)
+
+
+def seed_pairs(manifold_df, count):
+    rs = np.random.RandomState(0)
+    tags = list(manifold_df.columns)
+    return [tuple(rs.choice(len(tags), 2, replace=False)) for _ in range(count)], tags
+
+
+def setup_stage(stage, library, work, args):
+    """
+    Gets a stage ready to run, from whatever the stages before it left in `work`.
+
+    :return: tuple (function to time, how many things it does, function to call on its result afterwards, or None)
+    """
+    import analysis
+    import learning
+    import playlists
+
+    if stage == 'make_spect':
+        songs = library_songs(library)[:args.spect_songs]
+        return lambda: [analysis.make_spect(song, method='gamma', height=16) for song in songs], len(songs), None
+    if stage == 'preprocess':
+        songs = library_songs(library)
+
+        def finish(tags):
+            if not all(tags):
+                raise RuntimeError(f'{tags.count(False)} songs failed to preprocess.')
+
+        return (lambda: analysis.preprocess(re.compile(''), library_locale=library + os.sep, pool_size=args.workers,
+                                            locations=os.path.join(work, 'locations.db')),
+                len(songs), finish)
+    if stage == 'load_corpus':
+        songs = len(library_songs(library))
+        # The store is memory mapped, so touching every song is part of loading it.
+        return lambda: sum(float(song.sum()) for song in learning.load_corpus().values()), songs, None
+    if stage == 'make_manifold':
+        corp = learning.Corpus.from_dict(learning.load_corpus(), tar_len=args.tar_len)
+        corp = corp.crop(args.tar_len, pad_shorts=True)
+
+        def finish(manifold_df):
+            with open(os.path.join(work, 'manifold.pkl'), 'wb') as file:
+                pickle.dump(manifold_df, file)
+
+        pipeline = learning.default_pipeline().set_params(embedding__n_components=min(45, len(corp) // 2))
+        return lambda: learning.make_manifold(corp, pipeline), len(corp), finish
+
+    manifold_df = load_manifold(work)
+    if stage == 'index':
+        return lambda: playlists.ManifoldIndex(manifold_df), manifold_df.shape[1], None
+    pairs, tags = seed_pairs(manifold_df, args.seeds)
+    if stage == 'dist_playlist':
+        index = playlists.ManifoldIndex(manifold_df)
+        return (lambda: [playlists.abs_dist_playlist(tags[a], manifold_df, length=10, index=index) for a, _ in pairs],
+                len(pairs), None)
+    function = {'line_playlist': playlists.line_playlist, 'cone_plist': playlists.cone_plist,
+                'cyl_plist': playlists.cyl_plist}[stage]
+    return lambda: [function(tags[a], tags[b], manifold_df) for a, b in pairs], len(pairs), None
+
+
+def run_stage(stage, library, work, args, queue):
+    """
+    Runs one stage in this process, and reports how long it took and the peak RSS of this process, and of the
+    biggest process it started, if it started any.
+
+    :return: NoneType, results are put on `queue`.
+    """
+    try:
+        os.chdir(work)
+        work_fn, items, finish = setup_stage(stage, library, work, args)
+        st = perf_counter()
+        result = work_fn()
+        seconds = perf_counter() - st
+        if finish is not None:
+            finish(result)
+        queue.put({'seconds': seconds, 'items': items, 'per_second': items / seconds if seconds else None,
+                   'peak_rss_mb': peak_rss_mb(), 'children_peak_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN)})
+    except Exception as err:
+        queue.put({'error': repr(err)})
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=here, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(args):
+    """
+    Runs every stage at every size.
+
+    :return: dict ready to be written out as JSON.
+    """
+    libraries = args.libraries or tempfile.mkdtemp(prefix='ongaku-libraries-')
+    scratch = tempfile.mkdtemp(prefix='ongaku-bench-')
+    ctx = mp.get_context('spawn')
+    results = []
+    try:
+        for n in args.sizes:
+            st = perf_counter()
+            library = synthetic_library(os.path.join(libraries, f'{n}-songs-{args.seconds:g}s'), n, args.seconds)
+            print(f'{n} songs: library ready in {perf_counter() - st:.1f} s', file=sys.stderr)
+            # Every stage runs in here, and preprocess is pointed at a location store in here too, so nothing the
+            # benchmark makes ends up next to the real library's files.
+            work = os.path.join(scratch, str(n), 'work')
+            os.makedirs(work)
+            failed = set()
+            for stage in args.stages:
+                if failed.intersection(needs(stage)):
+                    continue
+                queue = ctx.Queue()
+                proc = ctx.Process(target=run_stage, args=(stage, library, work, args, queue))
+                proc.start()
+                result = dict(stage=stage, n=n, **queue.get())
+                proc.join()
+                results.append(result)
+                if 'error' in result:
+                    failed.add(stage)
+                print(f'{n} songs: {stage} {result.get("seconds", result.get("error"))}', file=sys.stderr)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+        if not args.libraries:
+            shutil.rmtree(libraries, ignore_errors=True)
+
+    return {'commit': commit(), 'date': datetime.now(timezone.utc).isoformat(), 'python': platform.python_version(),
+            'platform': platform.platform(), 'numpy': np.__version__, 'cpus': os.cpu_count(),
+            'settings': {'sizes': args.sizes, 'seconds': args.seconds, 'workers': args.workers,
+                         'tar_len': args.tar_len, 'seeds': args.seeds, 'spect_songs': args.spect_songs},
+            'results': results}
+
+
+def compare(before_loc, after_loc):
+    """
+    Prints how long every stage took in two result files, side by side.
+    """
+    with open(before_loc) as file:
+        before = json.load(file)
+    with open(after_loc) as file:
+        after = json.load(file)
+    old = {(r['stage'], r['n']): r for r in before['results']}
+    print(f'before {before["commit"]}\nafter  {after["commit"]}\n')
+    print(f'{"stage":<16}{"n":>7}{"before s":>11}{"after s":>11}{"ratio":>8}{"before MB":>11}{"after MB":>10}')
+    for new in after['results']:
+        ref = old.get((new['stage'], new['n']))
+        if ref is None or 'seconds' not in ref or 'seconds' not in new:
+            continue
+        print(f'{new["stage"]:<16}{new["n"]:>7}{ref["seconds"]:>11.3f}{new["seconds"]:>11.3f}'
+              f'{new["seconds"] / ref["seconds"]:>8.2f}{ref["peak_rss_mb"]:>11.1f}{new["peak_rss_mb"]:>10.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 300, 1000], help='library sizes, in songs')
+    parser.add_argument('--seconds', type=float, default=20, help='length of each song')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--workers', type=int, default=2, help='pool_size for preprocess')
+    parser.add_argument('--tar-len', type=int, default=16, help='frames to crop each song to for the manifold')
+    parser.add_argument('--seeds', type=int, default=20, help='playlists to make per playlist stage')
+    parser.add_argument('--spect-songs', type=int, default=8, help='songs for the make_spect stage')
+    parser.add_argument('--libraries', default=None, help='keep the generated libraries in this folder')
+    parser.add_argument('--out', default=None, help='write the results here, as JSON')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two result files')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    args.stages = [stage for stage in STAGES if stage in args.stages]
+    for stage in args.stages:
+        missing = [need for need in needs(stage) if need not in args.stages]
+        if missing:
+            parser.error(f'{stage} needs {", ".join(missing)} to run first.')
+    results = benchmark(args)
+    text = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, 'w') as file:
+            file.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
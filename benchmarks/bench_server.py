@@ -0,0 +1,113 @@
+"""
+Load tests a running ``server.py``. A number of clients each keep one connection open and send playlist requests one
+after another for a while, seeded from the server's own songs, and the requests per second and latencies are reported.
+
+    python server.py --manifold manifold.pkl &
+    python benchmarks/bench_server.py --clients 64 --seconds 10 --kind dist
+    python benchmarks/bench_server.py --kind cone --seeds 50
+
+A small `--seeds` means most requests are answered from the server's cache, a large one means most have to be worked
+out.
+"""
+import argparse
+import asyncio
+import json
+import random
+from time import perf_counter
+from urllib.parse import urlencode
+
+import numpy as np
+
+
+async def request(reader, writer, target):
+    """
+    Sends one GET on an open connection and reads the response.
+
+    :return: tuple (status, body bytes)
+    """
+    writer.write(f'GET {target} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode('latin-1'))
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        header = await reader.readline()
+        if header in (b'\r\n', b''):
+            break
+        name, _, value = header.decode('latin-1').partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+    return status, await reader.readexactly(length)
+
+
+async def connect(host, port, unix):
+    if unix:
+        return await asyncio.open_unix_connection(unix)
+    return await asyncio.open_connection(host, port)
+
+
+def make_target(kind, seeds, rng):
+    """
+    A random request of the given kind.
+    """
+    if kind == 'dist':
+        return '/dist?' + urlencode({'tag': rng.choice(seeds), 'length': 10})
+    a, b = rng.sample(seeds, 2)
+    return f'/{kind}?' + urlencode({'a': a, 'b': b})
+
+
+async def client(host, port, unix, kind, seeds, until, latencies, errors, seed):
+    rng = random.Random(seed)
+    reader, writer = await connect(host, port, unix)
+    try:
+        while perf_counter() < until:
+            st = perf_counter()
+            status, _ = await request(reader, writer, make_target(kind, seeds, rng))
+            latencies.append(perf_counter() - st)
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def run(args):
+    reader, writer = await connect(args.host, args.port, args.unix)
+    _, body = await request(reader, writer, '/tags')
+    writer.close()
+    tags = json.loads(body)
+    seeds = random.Random(0).sample(tags, min(args.seeds, len(tags)))
+
+    latencies = []
+    errors = []
+    st = perf_counter()
+    until = st + args.seconds
+    await asyncio.gather(*[client(args.host, args.port, args.unix, args.kind, seeds, until, latencies, errors, i)
+                           for i in range(args.clients)])
+    elapsed = perf_counter() - st
+
+    latencies = np.array(latencies) * 1000
+    result = {'kind': args.kind, 'clients': args.clients, 'seeds': len(seeds), 'requests': len(latencies),
+              'errors': len(errors), 'requests_per_second': len(latencies) / elapsed,
+              'p50_ms': float(np.percentile(latencies, 50)), 'p95_ms': float(np.percentile(latencies, 95)),
+              'p99_ms': float(np.percentile(latencies, 99))}
+    reader, writer = await connect(args.host, args.port, args.unix)
+    _, body = await request(reader, writer, '/stats')
+    writer.close()
+    result['server'] = json.loads(body)
+    print(json.dumps(result, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', default=None, help='connect to this unix socket instead')
+    parser.add_argument('--kind', default='dist', choices=['dist', 'line', 'cone', 'cyl', 'icone'])
+    parser.add_argument('--clients', type=int, default=32, help='connections sending requests at once')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--seeds', type=int, default=1000, help='how many different songs to ask about')
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
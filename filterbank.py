@@ -0,0 +1,311 @@
+"""
+A gammatone filterbank which runs every ERB channel at once. The filter design is the same as Malcolm Slaney's, which is
+what ``gammatone.gtgram`` ports from MATLAB, but rather than running four cascaded IIR filters channel by channel over
+the whole song, each channel's impulse response is computed once, truncated where its energy has died away, and
+applied to the audio in blocks with FFT overlap-add convolution. All of the channels share one FFT of the input, and
+everything is done in float32, so a block of a few seconds of audio is the most that's ever held in memory.
+
+Compared against ``gammatone.gtgram.gtgram`` with the same `interval`, `height` and `f_min`, the decibel output of
+:func:`gtgram` agrees to within :data:`DB_TOLERANCE` for every time bin above -100 dB.
+"""
+from functools import lru_cache
+
+import numpy as np
+from scipy import fft, signal
+
+EAR_Q = 9.26449  # Glasberg and Moore Parameters
+MIN_BW = 24.7
+
+DB_TOLERANCE = 0.01
+
+
+def erb_space(f_min, f_max, channels):
+    """
+    Centre frequencies spaced evenly on the ERB scale between `f_min` and `f_max`, lowest first. This is the same as
+    ``gammatone.filters.centre_freqs``, but in ascending order, which is the order the rows of a gammatonegram are in.
+
+    :param num f_min: lowest centre frequency
+
+    :param num f_max: upper edge of the filterbank, usually the Nyquist frequency.
+
+    :param int channels: how many centre frequencies to make.
+
+    :return: np.array
+    """
+    fraction = np.arange(channels, 0, -1) / channels
+    return -EAR_Q * MIN_BW + np.exp(
+        fraction * (np.log(f_min + EAR_Q * MIN_BW) - np.log(f_max + EAR_Q * MIN_BW))
+    ) * (f_max + EAR_Q * MIN_BW)
+
+
+def erb_filters(sr, cfs):
+    """
+    Designs the four second order sections of each gammatone filter, after Slaney's MakeERBFilters.
+
+    :param int sr: sample rate
+
+    :param np.array cfs: centre frequencies
+
+    :return: (numerators, denominators, gain) numerators has shape (channels, 4, 3), the other two are per channel.
+    """
+    t = 1 / sr
+    erb = cfs / EAR_Q + MIN_BW
+    b = 1.019 * 2 * np.pi * erb
+    arg = 2 * cfs * np.pi * t
+    vec = np.exp(2j * arg)
+
+    rt_pos = np.sqrt(3 + 2 ** 1.5)
+    rt_neg = np.sqrt(3 - 2 ** 1.5)
+    ks = np.stack([np.cos(arg) + rt_pos * np.sin(arg),
+                   np.cos(arg) - rt_pos * np.sin(arg),
+                   np.cos(arg) + rt_neg * np.sin(arg),
+                   np.cos(arg) - rt_neg * np.sin(arg)], axis=1)
+
+    numerators = np.zeros((len(cfs), 4, 3))
+    numerators[:, :, 0] = t
+    numerators[:, :, 1] = -t * np.exp(-b * t)[:, None] * ks
+    denominators = np.stack([np.ones_like(cfs), -2 * np.cos(arg) / np.exp(b * t), np.exp(-2 * b * t)], axis=1)
+
+    gain_arg = np.exp(1j * arg - b * t)
+    gain = np.abs(np.prod(vec[:, None] - gain_arg[:, None] * ks, axis=1)
+                  * (t * np.exp(b * t) / (-1 / np.exp(b * t) + 1 + vec * (1 - np.exp(b * t)))) ** 4)
+    return numerators, denominators, gain
+
+
+@lru_cache(maxsize=16)
+def impulse_responses(sr, channels, f_min, f_max=None, tol=1e-9):
+    """
+    Runs the gammatone filters on an impulse and truncates the responses once all but `tol` of their energy has passed.
+    The lowest channel rings the longest, every row is zero padded out to its length. The results are cached, since
+    every song with the same sample rate uses the same filters, so don't write to the array you get back.
+
+    :param int sr: sample rate
+
+    :param int channels: number of filters
+
+    :param num f_min: lowest centre frequency
+
+    :param num f_max: highest centre frequency, default is the Nyquist frequency.
+
+    :param float tol: the fraction of each filter's energy that can be thrown away.
+
+    :return: np.array float32 of shape (channels, taps)
+    """
+    if f_max is None:
+        f_max = sr / 2
+    cfs = erb_space(f_min, f_max, channels)
+    numerators, denominators, gain = erb_filters(sr, cfs)
+
+    # The envelope of a gammatone is t^3 exp(-bt), so 60 time constants of the slowest filter is far more than enough.
+    slowest = 1.019 * 2 * np.pi * (cfs.min() / EAR_Q + MIN_BW)
+    impulse = np.zeros(int(np.ceil(60 / slowest * sr)))
+    impulse[0] = 1
+
+    irs = np.empty((channels, len(impulse)))
+    for idx in range(channels):
+        y = impulse
+        for k in range(4):
+            y = signal.lfilter(numerators[idx, k], denominators[idx], y)
+        irs[idx] = y / gain[idx]
+
+    energy = np.cumsum(irs ** 2, axis=1)
+    taps = np.max(np.argmax(energy >= (1 - tol) * energy[:, -1:], axis=1)) + 1
+    return irs[:, :taps].astype(np.float32)
+
+
+def window_samples(interval, sr):
+    """
+    How many samples there are in a time bin, rounded the same way ``gammatone.gtgram`` does it.
+
+    :param num interval: the width in seconds of the time bins.
+
+    :param int sr: sample rate
+
+    :return: int
+    """
+    return int(np.sign(interval * sr) * np.floor(np.abs(interval * sr) + 0.5))
+
+
+class TimeBins:
+    """
+    Integrates filterbank energy into time bins of `nwin` samples, carrying a partly filled bin from one call to the
+    next. Several of these can share one :class:`ERBFilterbank`, which is how a song gets analyzed at more than one
+    interval, or more than one excerpt of it, while only being filtered once.
+
+    :param int nwin: samples per time bin.
+
+    :param int channels: rows of the energy it'll be given.
+
+    :param int skip: samples at the start to ignore, e.g. filter warm-up, or audio before an excerpt.
+
+    :param limit: int or NoneType the most samples to count, after `skip`. None counts everything.
+    """
+
+    def __init__(self, nwin, channels, skip=0, limit=None):
+        self.nwin = nwin
+        self.channels = channels
+        self.skip = skip
+        self.limit = limit
+        self.acc = np.zeros(channels, dtype=np.float64)
+        self.filled = 0
+        self.counted = 0
+
+    def add(self, xe):
+        """
+        Counts the next stretch of energy towards the time bins.
+
+        :param np.array xe: (channels, m) squared filter outputs for the next m samples.
+
+        :return: list of np.array, the columns completed by this stretch, possibly none.
+        """
+        columns = []
+        pos = min(self.skip, xe.shape[1])
+        self.skip -= pos
+        end = xe.shape[1]
+        if self.limit is not None:
+            end = min(end, pos + self.limit - self.counted)
+        while pos < end:
+            take = min(self.nwin - self.filled, end - pos)
+            self.acc += xe[:, pos:pos + take].sum(axis=1, dtype=np.float64)
+            self.filled += take
+            self.counted += take
+            pos += take
+            if self.filled == self.nwin:
+                columns.append(np.sqrt(self.acc / self.nwin))
+                self.acc = np.zeros(self.channels, dtype=np.float64)
+                self.filled = 0
+        return columns
+
+
+class ERBFilterbank:
+    """
+    A block-at-a-time gammatonegram. Feed it consecutive chunks of a mono signal with :meth:`process` and it hands back
+    whatever columns of the gammatonegram were completed by that chunk. The convolution tail and the partially filled
+    time bin are carried from one call to the next, so the chunk sizes don't change the result. The filtering and the
+    time bins are separate (see :meth:`energy` and :class:`TimeBins`), so one filterbank can feed several sets of bins.
+
+    :param int sr: sample rate
+
+    :param num interval: the width in seconds of the time bins.
+
+    :param int channels: how many filters to use.
+
+    :param num f_min: lowest centre frequency of the filterbank.
+
+    :param int blocksize: the number of samples convolved per FFT. Longer blocks are a little faster, but use more
+    memory.
+    """
+
+    def __init__(self, sr, interval, channels, f_min, blocksize=2 ** 16):
+        self.sr = sr
+        self.channels = channels
+        self.nwin = window_samples(interval, sr)
+        irs = impulse_responses(sr, channels, f_min)
+        self.taps = irs.shape[1]
+        self.blocksize = blocksize
+        self.nfft = fft.next_fast_len(blocksize + self.taps - 1, real=True)
+        self.spectra = fft.rfft(irs, self.nfft, axis=1)
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets everything, ready for a new song.
+
+        :return: NoneType
+        """
+        self.tail = np.zeros((self.channels, self.taps - 1), dtype=np.float32)
+        self.bins = TimeBins(self.nwin, self.channels)
+
+    def filter(self, block):
+        """
+        Runs the filterbank over a block of samples, carrying the convolution tail over to the next call.
+
+        :param np.array block: 1D, at most `blocksize` samples long.
+
+        :return: np.array float32 of shape (channels, len(block))
+        """
+        n = len(block)
+        spectrum = fft.rfft(np.asarray(block, dtype=np.float32), self.nfft)
+        full = fft.irfft(self.spectra * spectrum, self.nfft, axis=1)[:, :n + self.taps - 1]
+        full[:, :self.taps - 1] += self.tail
+        self.tail = full[:, n:].copy()
+        return full[:, :n]
+
+    def prime(self, block):
+        """
+        Runs a block through the filters without counting it towards any time bin. This is for warming up the filters on
+        the audio just before an excerpt.
+
+        :param np.array block: 1D chunk of the signal, any length.
+
+        :return: NoneType
+        """
+        for start in range(0, len(block), self.blocksize):
+            self.filter(block[start:start + self.blocksize])
+
+    def stream(self, blocks, warm_up=0):
+        """
+        Yields the columns of the gammatonegram one at a time, as the blocks come in.
+
+        :param blocks: iterable of np.array, consecutive chunks of a mono signal.
+
+        :param int warm_up: how many samples at the start only go towards :meth:`prime`.
+
+        :return: generator of np.array, each of length `channels`.
+        """
+        for block in blocks:
+            if warm_up:
+                head = block[:warm_up]
+                self.prime(head)
+                warm_up -= len(head)
+                block = block[len(head):]
+            yield from self.process(block).T
+
+    def energy(self, block):
+        """
+        Filters a block of samples and squares the result, `blocksize` samples at a time.
+
+        :param np.array block: 1D chunk of the signal, any length.
+
+        :return: generator of np.array float32 of shape (channels, up to blocksize)
+        """
+        for start in range(0, len(block), self.blocksize):
+            xe = self.filter(block[start:start + self.blocksize])
+            np.square(xe, out=xe)
+            yield xe
+
+    def process(self, block):
+        """
+        Filters a block of samples and integrates the energy into time bins.
+
+        :param np.array block: 1D chunk of the signal, any length.
+
+        :return: np.array of shape (channels, k), the k columns completed by this block, possibly none.
+        """
+        columns = []
+        for xe in self.energy(block):
+            columns += self.bins.add(xe)
+        if columns:
+            return np.column_stack(columns).astype(np.float32)
+        return np.zeros((self.channels, 0), dtype=np.float32)
+
+
+def gtgram(wave, sr, interval, channels, f_min, blocksize=2 ** 16):
+    """
+    A drop-in replacement for ``gammatone.gtgram.gtgram(wave, sr, interval, interval, channels, f_min)``.
+
+    :param np.array wave: 1D signal
+
+    :param int sr: sample rate
+
+    :param num interval: the width in seconds of the time bins.
+
+    :param int channels: how many filters to use.
+
+    :param num f_min: lowest centre frequency of the filterbank.
+
+    :param int blocksize: see :class:`ERBFilterbank`
+
+    :return: np.array float32 of shape (channels, columns)
+    """
+    return ERBFilterbank(sr, interval, channels, f_min, blocksize=blocksize).process(wave)
@@ -0,0 +1,405 @@
+"""
+Where a run's time and memory go. The pipeline is marked up with spans, e.g. ``analysis.decode``,
+``analysis.filterbank``, ``learning.scale`` or ``playlists.search``, and counters, and when nothing is listening they
+cost next to nothing. To listen, give ``recording`` (or ``configure``) some sinks:
+
+    import instrument
+    totals = instrument.Aggregator()
+    with instrument.recording(totals, instrument.JsonLinesSink('run.jsonl'), trace_memory=['analysis.*']):
+        analysis.preprocess(...)
+    print(totals.frame())
+
+Every span that finishes is handed to each sink as a dict, with its name, how long it took in wall and CPU time, how
+deep it was nested, the process and thread it ran on, the peak RSS of the process so far, and whatever fields it was
+given. Spans whose names match one of the `trace_memory` patterns also get the peak memory allocated while they ran,
+from ``tracemalloc``, so e.g. ``analysis.song`` says how much each song needed. ``tracemalloc`` only keeps one peak
+for the whole process, so while traced spans are open on several threads at once, each of them gets the peak of
+everything the process allocated while it was open, not just what its own thread did. Tracing starts with the first
+traced span and stops when the last one, on whichever thread, is done. Spans matching `profile` are run under
+``cProfile``, and the stats are saved in `profile_dir`, with the file name in the event.
+
+The settings are passed on to worker processes through the environment, so the spans in ``analysis.preprocess``'s
+pool end up in the same JSON lines file. That includes forked workers, which start over with their own sinks rather
+than sharing the parent's. An ``Aggregator`` only sees its own process, but ``Aggregator.read`` totals up a JSON lines
+file afterwards.
+"""
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from fnmatch import fnmatchcase
+from functools import wraps
+from itertools import count as counter
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    # Windows has no getrusage, so there's no peak RSS in the events.
+    resource = None
+
+ENVIRONMENT = 'ONGAKU_INSTRUMENT'
+
+_sinks = []
+_settings = {'profile': (), 'trace_memory': (), 'profile_dir': 'profiles'}
+_local = threading.local()
+_profiles = counter()
+# The traced spans open on any thread, and whether they started tracemalloc, so the last one out can stop it.
+_tracing = {'lock': threading.Lock(), 'open': [], 'started': False}
+
+
+class JsonLinesSink:
+    """
+    Appends every event to a file, one JSON object per line. Each line is written with a single call, so several
+    processes can share the file.
+
+    :param str loc: the file.
+    """
+
+    def __init__(self, loc='instrument.jsonl'):
+        self.loc = os.path.abspath(loc)
+        self.lock = threading.Lock()
+        self.file = None
+
+    def __call__(self, event):
+        line = json.dumps(event, default=str) + '\n'
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.loc, 'a', encoding='utf-8')
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class Aggregator:
+    """
+    Keeps running totals of the events it's given, per span or counter name.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = defaultdict(lambda: {'count': 0, 'seconds': 0., 'max_seconds': 0., 'cpu_seconds': 0.,
+                                           'peak_mb': None, 'rss_mb': None, 'value': 0})
+
+    def __call__(self, event):
+        with self.lock:
+            total = self.totals[event['name']]
+            total['count'] += 1
+            if event.get('kind') == 'counter':
+                total['value'] += event['value']
+                return
+            total['seconds'] += event['seconds']
+            total['max_seconds'] = max(total['max_seconds'], event['seconds'])
+            total['cpu_seconds'] += event['cpu_seconds']
+            for key in ('peak_mb', 'rss_mb'):
+                if event.get(key) is not None:
+                    total[key] = max(total[key] or 0, event[key])
+
+    @classmethod
+    def read(cls, loc='instrument.jsonl'):
+        """
+        Totals up a file written by ``JsonLinesSink``, from every process that wrote to it.
+
+        :param str loc:
+        :return: Aggregator
+        """
+        totals = cls()
+        with open(loc, encoding='utf-8') as file:
+            for line in file:
+                if line.endswith('\n'):
+                    totals(json.loads(line))
+        return totals
+
+    def summary(self):
+        """
+        :return: dict relating each name to its totals.
+        """
+        with self.lock:
+            return {name: dict(total) for name, total in self.totals.items()}
+
+    def frame(self):
+        """
+        The totals as a table, the slowest first.
+
+        :return: pd.DataFrame
+        """
+        table = pd.DataFrame.from_dict(self.summary(), orient='index')
+        if len(table):
+            table['mean_seconds'] = table['seconds'] / table['count']
+            table = table.sort_values('seconds', ascending=False)
+        return table
+
+
+class _NoSpan:
+    """
+    What ``span`` hands back when nothing is listening.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **fields):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Span:
+    """
+    Times one stretch of work. Use ``span`` to make one.
+    """
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.traced = any(fnmatchcase(name, pattern) for pattern in _settings['trace_memory'])
+        self.profiled = any(fnmatchcase(name, pattern) for pattern in _settings['profile'])
+        self.profiler = None
+
+    def set(self, **fields):
+        """
+        Adds fields to the event, e.g. things only known once the work is done.
+        """
+        self.fields.update(fields)
+
+    def __enter__(self):
+        stack = _stack()
+        self.depth = len(stack)
+        self.parent = stack[-1].name if stack else None
+        if self.traced:
+            with _tracing['lock']:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    _tracing['started'] = True
+                # Every open traced span, on this thread or any other, keeps its own peak, so it has to be handed to
+                # them before it's reset.
+                current, peak = tracemalloc.get_traced_memory()
+                for other in _tracing['open']:
+                    other.peak = max(other.peak, peak)
+                tracemalloc.reset_peak()
+                self.base = self.peak = current
+                _tracing['open'].append(self)
+        if self.profiled and not getattr(_local, 'profiling', False):
+            self.profiler = cProfile.Profile()
+            try:
+                self.profiler.enable()
+                _local.profiling = True
+            except ValueError:
+                # Another profiler is already running, on some other thread.
+                self.profiler = None
+        stack.append(self)
+        self.start = time.time()
+        self.cpu = time.thread_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.wall
+        cpu_seconds = time.thread_time() - self.cpu
+        stack = _stack()
+        stack.pop()
+        event = {'name': self.name, 'start': self.start, 'seconds': seconds, 'cpu_seconds': cpu_seconds,
+                 'depth': self.depth, 'parent': self.parent, 'pid': os.getpid(),
+                 'thread': threading.current_thread().name, 'rss_mb': peak_rss_mb()}
+        if self.profiler is not None:
+            self.profiler.disable()
+            _local.profiling = False
+            if not os.path.exists(_settings['profile_dir']):
+                os.makedirs(_settings['profile_dir'], exist_ok=True)
+            loc = os.path.join(_settings['profile_dir'], f'{self.name}-{os.getpid()}-{next(_profiles)}.prof')
+            self.profiler.dump_stats(loc)
+            event['profile'] = loc
+        if self.traced:
+            with _tracing['lock']:
+                peak = tracemalloc.get_traced_memory()[1]
+                for other in _tracing['open']:
+                    other.peak = max(other.peak, peak)
+                _tracing['open'].remove(self)
+                if not _tracing['open'] and _tracing['started']:
+                    tracemalloc.stop()
+                    _tracing['started'] = False
+            event['peak_mb'] = (self.peak - self.base) / 2 ** 20
+        if exc[0] is not None:
+            event['error'] = exc[0].__name__
+        event.update(self.fields)
+        emit(event)
+        return False
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process so far in MB, or None where that can't be had.
+
+    :return: float or NoneType
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+def enabled():
+    """
+    :return: bool whether anything is listening.
+    """
+    return bool(_sinks)
+
+
+def span(name, **fields):
+    """
+    Times whatever happens in the ``with`` block, and hands an event to the sinks when it's done.
+
+        with instrument.span('analysis.decode', song=filepath) as sp:
+            ...
+            sp.set(frames=len(data))
+
+    :param str name: dotted, the module first.
+    :param fields: anything else to put in the event. Keep it JSON friendly.
+    :return: a context manager
+    """
+    if not _sinks:
+        return _NO_SPAN
+    return Span(name, fields)
+
+
+def timed(name):
+    """
+    Decorates a function so every call to it is a span.
+
+    :param str name:
+    :return: decorator
+    """
+
+    def decorate(function):
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            if not _sinks:
+                return function(*args, **kwargs)
+            with Span(name, {}):
+                return function(*args, **kwargs)
+
+        return timed_function
+
+    return decorate
+
+
+def count(name, value=1, **fields):
+    """
+    Adds to a counter, e.g. songs that failed.
+
+    :param str name:
+    :param num value:
+    :param fields: anything else to put in the event.
+    :return: NoneType
+    """
+    if _sinks:
+        emit(dict(fields, name=name, kind='counter', value=value, start=time.time(), pid=os.getpid()))
+
+
+def emit(event):
+    """
+    Hands an event to every sink.
+
+    :param dict event:
+    :return: NoneType
+    """
+    for sink in list(_sinks):
+        sink(event)
+
+
+def configure(sinks=(), profile=(), trace_memory=(), profile_dir='profiles'):
+    """
+    Starts listening, replacing whatever was set before.
+
+    :param sinks: callables taking an event dict, like ``JsonLinesSink`` and ``Aggregator``.
+    :param profile: patterns (as for ``fnmatch``) of span names to run under ``cProfile``, e.g. ``['learning.fit']``.
+    Only the outermost profiled span on a thread is profiled.
+    :param trace_memory: patterns of span names to record the peak allocated memory of. This starts ``tracemalloc``
+    while they run, which slows allocation down a lot, so keep it to the spans you care about.
+    :param profile_dir: str where to save the profiles.
+    :return: NoneType
+    """
+    _sinks[:] = list(sinks)
+    _settings.update(profile=tuple(profile), trace_memory=tuple(trace_memory),
+                     profile_dir=os.path.abspath(profile_dir))
+    files = [sink.loc for sink in _sinks if isinstance(sink, JsonLinesSink)]
+    if _sinks:
+        os.environ[ENVIRONMENT] = json.dumps(dict(_settings, jsonl=files[0] if files else None))
+    else:
+        os.environ.pop(ENVIRONMENT, None)
+
+
+def reset():
+    """
+    Stops listening, and closes any files.
+
+    :return: NoneType
+    """
+    for sink in _sinks:
+        if hasattr(sink, 'close'):
+            sink.close()
+    configure()
+
+
+@contextmanager
+def recording(*sinks, profile=(), trace_memory=(), profile_dir='profiles'):
+    """
+    ``configure`` for the length of a ``with`` block. See ``configure`` for the parameters.
+    """
+    configure(sinks, profile, trace_memory, profile_dir)
+    try:
+        yield
+    finally:
+        reset()
+
+
+def _from_environment():
+    """
+    Picks up the settings of the process that started this one, if it was listening.
+    """
+    settings = os.environ.get(ENVIRONMENT)
+    if not settings:
+        return
+    settings = json.loads(settings)
+    _sinks[:] = [JsonLinesSink(settings['jsonl'])] if settings.get('jsonl') else []
+    _settings.update(profile=tuple(settings['profile']), trace_memory=tuple(settings['trace_memory']),
+                     profile_dir=settings['profile_dir'])
+
+
+def _forked():
+    """
+    Starts a forked child over, rather than with copies of its parent's sinks, whose totals would be lost and whose
+    locks may have been held mid-write, and of the traced spans, which will never finish here.
+    """
+    if _tracing['started']:
+        tracemalloc.stop()
+    _tracing.update(lock=threading.Lock(), open=[], started=False)
+    _local.stack = []
+    _sinks[:] = []
+    _from_environment()
+
+
+_from_environment()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forked)
@@ -3,12 +3,19 @@ import pickle
 import os
 from sklearn import manifold as mnfd
 from sklearn import decomposition as dcomp
-from sklearn import preprocessing as pre
 import pandas as pd
 from analysis import TEST_REGEX, library_from_regex
+from scipy.sparse import csgraph
+from sklearn.base import BaseEstimator, TransformerMixin, clone
+from sklearn.neighbors import NearestNeighbors
 from sklearn.pipeline import Pipeline
 import re
-from analysis import corpus_tag_generator
+import time
+from analysis import config_name, corpus_tag_generator
+from store import FeatureStore
+from library import dump_atomic
+from locations import LOCATIONS, LocationStore
+import instrument
 
 TEST_REGEX = re.compile(TEST_REGEX.pattern)
 here = os.path.dirname(__file__)
@@ -16,17 +23,38 @@ here = os.path.dirname(__file__)
 musicbee = 'C:\\Users\\Coen D. Needell\\Music\\MusicBee\\Playlists\\'  # Personal playlist location
 
 
-def load_corpus(loc='cepstra\\', precompiled=False):
+def load_corpus(loc='cepstra\\', precompiled=False, store='cepstra.store', namespace=None):
     """
     Generates a corpus for machine learning from your preprocessed cepstra. Location should be the same folder you used
     for the analysis.py run. Returns a dict with keys being the 'song code' as made by the analysis.corpus_tag_generator
     function.
 
+    If there's a feature store (see ``store.FeatureStore``) it's used instead of the folder of pickles. The songs are
+    then read-only views into a memory map of the store, so this takes next to no time or memory, no matter how big the
+    corpus is.
+
     :param loc: str directory where the spectra are.
 
-    :param precompiled: bool triggers whether or not it should load the corpus from a pickle file or the cepstra folder
+    :param precompiled: bool triggers whether or not it should load the corpus from a pickle file or the cepstra folder,
+    when there's no feature store.
+
+    :param store: str or NoneType location of the feature store made by analysis.preprocess
+
+    :param namespace: str or NoneType which analysis to load, see ``analysis.config_name``. By default it's the whole
+    songs, the analysis ``preprocess`` does without a `crop` or `configs`, or, for a store made before analyses had
+    namespaces, whatever is at the top of it.
     :return: dict
     """
+    if store and os.path.exists(store):
+        legacy = os.path.exists(os.path.join(store, 'index.jsonl'))
+        if namespace is None:
+            namespace = config_name(None)
+            if legacy and not os.path.exists(os.path.join(store, namespace)):
+                return FeatureStore(store).load()
+        if not os.path.exists(os.path.join(store, namespace)):
+            analyses = sorted(name for name in os.listdir(store) if os.path.isdir(os.path.join(store, name)))
+            raise ValueError(f'{store} has no analysis called {namespace}, it has {", ".join(analyses) or "none"}.')
+        return FeatureStore(store, namespace=namespace).load()
     if precompiled:
         with open('../corpus.pkl', 'rb') as file:
             return pickle.load(file)
@@ -35,39 +63,36 @@ def load_corpus(loc='cepstra\\', precompiled=False):
         with open(f'cepstra\\{song}', 'rb') as file:
             corpus[song.replace('.pkl', '')] = pickle.load(file)
     corpus = {title: song for title, song in corpus.items() if song is not None}
-    with open('../corpus.pkl', 'wb') as file:
-        pickle.dump(corpus, file)
+    dump_atomic(corpus, '../corpus.pkl')
     return corpus
 
 
-def create_tag_dict(lib, loc=here + '/' + 'locations.pkl'):
+def create_tag_dict(lib, loc=LOCATIONS):
     """
-    Makes a dictionary that relates the tags to associated filename.
+    Adds the songs to the tag dictionary, a ``locations.LocationStore`` relating the tags to associated filename.
 
     :param lib: list contains all of the filenames.
 
-    :param loc: str file to dump the tag dictionary in if you want to avoid doing this more than once.
+    :param loc: str where the store is.
 
-    :return:
+    :return: LocationStore
     """
-    mdata_dict = {}
-    for song in lib:
-        mdata_dict[corpus_tag_generator(song)] = song
-    with open(loc, 'wb') as file:
-        pickle.dump(mdata_dict, file)
-    return mdata_dict
+    places = LocationStore(loc)
+    places.update([(corpus_tag_generator(song), song) for song in lib])
+    return places
 
 
-def load_tag_dict(loc=here + '/' + 'locations.pkl'):
+def load_tag_dict(loc=LOCATIONS):
     """
-    Loads the tag dictionary, and returns it.
+    Opens the tag dictionary, and returns it. Nothing is read until it's looked in, so this is cheap.
 
-    :param loc: str location of pkl
-    :return:
+    :param loc: str location of the ``locations.LocationStore``, or of an old pickled dictionary.
+    :return: LocationStore, or dict for a pickle.
     """
-    with open(loc, 'rb') as file:
-        mdata_dict = pickle.load(file)
-    return mdata_dict
+    if loc.endswith('.pkl'):
+        with open(loc, 'rb') as file:
+            return pickle.load(file)
+    return LocationStore(loc)
 
 
 def generate_m3u(tags, title, reference, locale='playlists\\'):
@@ -76,10 +101,13 @@ def generate_m3u(tags, title, reference, locale='playlists\\'):
 
     :param tags: list of tags
     :param title: name of plist
-    :param reference: dict tag dictionary, default just runs load_tag_dict()
+    :param reference: dict or LocationStore tag dictionary, e.g. from load_tag_dict()
     :param locale: str place to dump your playlist
     :return:
     """
+    if isinstance(reference, LocationStore):
+        # Just the playlist's songs, in one query.
+        reference = reference.locations(tags)
     with open(f'{locale}{title}.m3u', 'w+', encoding='utf-8') as file:
         for tag in tags:
             file.write(reference[tag] + '\n')
@@ -131,7 +159,7 @@ def cropped_corpus(corp, tar_len=90, pad_shorts=False):
     new_corp = {}
     for title, song in corp.items():
         s_len = song.shape[1]
-        if s_len > tar_len:
+        if s_len >= tar_len:
             st = (s_len // 2) - (tar_len // 2)
             end = (s_len // 2) + (tar_len // 2)
             assert end - st == tar_len
@@ -143,32 +171,568 @@ def cropped_corpus(corp, tar_len=90, pad_shorts=False):
     return new_corp
 
 
+class Corpus:
+    """
+    A corpus as one array rather than a dict of them. Every song is a row of a contiguous ``(songs, height, frames)``
+    array, padded with `fill` out to the length of the longest song, and :attr:`tags` says which row is which.
+
+    Two things about the layout make cropping free. Each song sits in the middle of its row, with the padding split
+    between its two ends, so the middle `tar_len` frames of every song are the same columns of the array. And the rows
+    are sorted longest first, so the songs long enough for a crop are always the first few rows. :meth:`crop` and
+    :meth:`pad` are then plain slices of the array, which numpy hands back as views, and the only copy of the data on
+    the way to ``make_manifold`` is the one :meth:`flatten` makes.
+
+    :param np.array data: (songs, height, frames) array laid out as above. Use :meth:`from_dict` to make one.
+
+    :param tags: list of str the tag of each row.
+
+    :param lengths: np.array how many frames of each row are the song rather than padding.
+
+    :param fill: float what the padding is.
+    """
+
+    def __init__(self, data, tags, lengths, fill=-np.inf):
+        self.data = data
+        self.fill = fill
+        self.tags = list(tags)
+        self.lengths = np.asarray(lengths)
+        self.index = {tag: i for i, tag in enumerate(self.tags)}
+
+    @classmethod
+    @instrument.timed('learning.pack')
+    def from_dict(cls, corp, fill=-np.inf, tar_len=None):
+        """
+        Packs a dict corpus, as returned by ``load_corpus``, into one array.
+
+        Every row is as wide as the longest song, so a single very long track makes the array that much bigger for
+        every song in the library. If the corpus is only going to be cropped, pass the same `tar_len` here, and only
+        the middle `tar_len` frames of each song are copied in, which is all ``crop`` would keep of them anyway.
+
+        :param corp: dict
+        :param fill: float what to pad the shorter songs with. -inf, like ``padded_corpus``, by default.
+        :param tar_len: int or NoneType the most frames of each song to keep.
+        :return: Corpus
+        """
+        tags = sorted(corp, key=lambda tag: -corp[tag].shape[1])
+        lengths = np.array([corp[tag].shape[1] for tag in tags], dtype=int)
+        if tar_len is not None:
+            lengths = np.minimum(lengths, tar_len)
+        width = int(lengths.max()) if len(tags) else 0
+        height = corp[tags[0]].shape[0] if len(tags) else 0
+        dtype = np.result_type(*[corp[tag].dtype for tag in tags]) if len(tags) else np.float32
+        data = np.full((len(tags), height, width), fill, dtype=dtype)
+        for i, tag in enumerate(tags):
+            song = corp[tag]
+            # The middle of the song, the same frames crop would take.
+            st = song.shape[1] // 2 - lengths[i] // 2
+            offset = width // 2 - lengths[i] // 2
+            data[i, :, offset:offset + lengths[i]] = song[:, st:st + lengths[i]]
+        return cls(data, tags, lengths, fill)
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __contains__(self, tag):
+        return tag in self.index
+
+    def __getitem__(self, tag):
+        i = self.index[tag]
+        width = self.data.shape[2]
+        offset = max(width // 2 - self.lengths[i] // 2, 0)
+        return self.data[i, :, offset:offset + min(self.lengths[i], width)]
+
+    def to_dict(self):
+        """
+        :return: dict relating each tag to a view of its song, without the padding.
+        """
+        return {tag: self[tag] for tag in self.tags}
+
+    def pad(self):
+        """
+        The corpus with every song padded out to the length of the longest, like ``padded_corpus``, except that the
+        padding is split between the start and the end of each song. The array is already laid out that way, so this
+        is the corpus itself.
+
+        :return: Corpus
+        """
+        return Corpus(self.data, self.tags, np.full(len(self), self.data.shape[2]), self.fill)
+
+    @instrument.timed('learning.crop')
+    def crop(self, tar_len=90, pad_shorts=False):
+        """
+        The middle `tar_len` frames of every song, like ``cropped_corpus``. Songs shorter than that are dropped, or, if
+        `pad_shorts` is True, kept with padding on both sides. Either way the result is a view of this corpus.
+
+        :param tar_len: int
+        :param pad_shorts: bool
+        :return: Corpus
+        """
+        width = self.data.shape[2]
+        if tar_len > width:
+            if not pad_shorts:
+                return Corpus(self.data[:0], [], [], self.fill)
+            # Nothing is long enough, so this is the one case that has to make a new array.
+            extra = tar_len - width
+            st = tar_len // 2 - width // 2
+            data = np.pad(self.data, ((0, 0), (0, 0), (st, extra - st)), constant_values=self.fill)
+            return Corpus(data, self.tags, np.full(len(self), tar_len), self.fill)
+        st = width // 2 - tar_len // 2
+        keep = len(self) if pad_shorts else int(np.count_nonzero(self.lengths >= tar_len))
+        return Corpus(self.data[:keep, :, st:st + tar_len], self.tags[:keep], np.full(keep, tar_len), self.fill)
+
+    @instrument.timed('learning.flatten')
+    def flatten(self):
+        """
+        Copies the corpus into a (songs, height * frames) matrix, with ``np.nan_to_num`` applied, like
+        ``flattened_corpus``. This is the one copy of the data, everything after it can happen in place.
+
+        :return: np.array
+        """
+        flat = np.array(self.data, order='C').reshape(len(self), -1)
+        for song in flat:
+            # A row at a time, since nan_to_num makes masks the size of whatever it's given.
+            np.nan_to_num(song, copy=False)
+        return flat
+
+
+@instrument.timed('learning.scale_params')
+def robust_scale_params(songs, chunk=256):
+    """
+    What ``sklearn.preprocessing.RobustScaler`` would learn from the songs, the median and interquartile range of each
+    feature, worked out a few hundred columns at a time. Runs ``np.nan_to_num`` over the songs in place on the way.
+
+    :param np.array songs: (songs, features) matrix, as made by ``Corpus.flatten``.
+    :param chunk: int columns to look at at once.
+    :return: tuple (medians, interquartile ranges) as np.arrays
+    """
+    center = np.empty(songs.shape[1], dtype=songs.dtype)
+    scale = np.empty(songs.shape[1], dtype=songs.dtype)
+    for st in range(0, songs.shape[1], chunk):
+        block = songs[:, st:st + chunk]
+        np.nan_to_num(block, copy=False)
+        q1, median, q3 = np.percentile(block, [25, 50, 75], axis=0)
+        iqr = q3 - q1
+        iqr[iqr == 0] = 1
+        center[st:st + chunk] = median
+        scale[st:st + chunk] = iqr
+    return center, scale
+
+
+@instrument.timed('learning.scale')
+def robust_scale(songs, lower=-1000, upper=5, chunk=256, center=None, scale=None):
+    """
+    Does what ``sklearn.preprocessing.RobustScaler`` followed by ``np.nan_to_num`` and ``np.clip`` does, but in place,
+    and a few hundred columns at a time, so the only extra memory it needs is for one chunk.
+
+    :param np.array songs: (songs, features) matrix, as made by ``Corpus.flatten``. It's overwritten.
+    :param lower: float clip below
+    :param upper: float clip above
+    :param chunk: int columns to scale at once.
+    :param center: np.array or NoneType medians to scale with, from ``robust_scale_params``. By default they're worked
+    out from the songs themselves.
+    :param scale: np.array or NoneType interquartile ranges to go with `center`.
+    :return: np.array the same matrix, scaled.
+    """
+    if center is None or scale is None:
+        center, scale = robust_scale_params(songs, chunk)
+    for st in range(0, songs.shape[1], chunk):
+        block = songs[:, st:st + chunk]
+        np.nan_to_num(block, copy=False)
+        block -= center[st:st + chunk].astype(songs.dtype)
+        block /= scale[st:st + chunk].astype(songs.dtype)
+        np.nan_to_num(block, copy=False)
+        np.clip(block, lower, upper, out=block)
+    return songs
+
+
 def make_manifold(processed_corp,
                   pipeline=Pipeline([('reduce_dims', dcomp.PCA()), ('embedding', mnfd.Isomap(n_components=45))])):
     """
     Uses sklearn to construct a manifold data frame. You can use whatever pipeline you like, but the default is PCA into
     Isomap with 45 components, I've had good success with this value.
-    :param processed_corp: dict
+
+    Passing a ``Corpus`` is the cheap way to do it, the songs are flattened into one matrix and scaled in place (see
+    ``robust_scale``), so there's only ever one copy of the data on top of the corpus itself. A dict corpus gets packed
+    into a ``Corpus`` first.
+    :param processed_corp: Corpus or dict
     :param pipeline: sklearn.pipeline.Pipeline
     :return: pd.DataFrame
     """
-    flat_corp = flattened_corpus(processed_corp)
-    songs = list(flat_corp.values())
-    songs_scaled = np.nan_to_num(pre.RobustScaler().fit_transform(songs))
-    songs_scaled = np.clip(songs_scaled, -1000, 5)
+    if not isinstance(processed_corp, Corpus):
+        processed_corp = Corpus.from_dict(processed_corp)
+    songs_scaled = robust_scale(processed_corp.flatten())
 
-    songs_transformed = pipeline.fit_transform(songs_scaled)
-    manifold = {}
-    for title, song in zip(flat_corp, songs_transformed):
-        manifold[title] = song
-    manifold_df = pd.DataFrame(manifold)
+    with instrument.span('learning.fit', songs=songs_scaled.shape[0], features=songs_scaled.shape[1]):
+        songs_transformed = pipeline.fit_transform(songs_scaled)
+    manifold_df = pd.DataFrame(songs_transformed.T, columns=processed_corp.tags)
     return manifold_df
 
 
+def song_batches(corp, tags, tar_len=120, pad_shorts=True, batch_size=512):
+    """
+    Reads a corpus a batch of songs at a time, each batch cropped like ``Corpus.crop`` and flattened like
+    ``Corpus.flatten``. Only one batch is ever in memory, so with a memory mapped corpus from ``load_corpus`` this works
+    on corpora much bigger than RAM. The last batch takes up any leftover songs, so no batch is smaller than
+    `batch_size` unless there are fewer songs than that.
+
+    :param corp: dict or Corpus
+    :param tags: list of the tags to read, in order. Songs too short for `tar_len` should already be left out if
+    `pad_shorts` is False.
+    :param tar_len: int
+    :param pad_shorts: bool
+    :param batch_size: int songs per batch
+    :return: generator of (list of tags, (songs, features) np.array)
+    """
+    for chunk in np.array_split(np.asarray(tags, dtype=object), max(1, len(tags) // batch_size)):
+        if len(chunk) == 0:
+            continue
+        batch = Corpus.from_dict({tag: corp[tag] for tag in chunk}, tar_len=tar_len)
+        batch = batch.crop(tar_len, pad_shorts=pad_shorts)
+        yield batch.tags, batch.flatten()
+
+
+def make_manifold_streaming(corp=None, tar_len=120, pad_shorts=True, reduce_to=100, embedding=None, batch_size=512,
+                            sample_size=4096, lower=-1000, upper=5, random_state=None):
+    """
+    ``make_manifold`` for corpora that don't fit in memory. The corpus is read from disk in batches (see
+    ``song_batches``) three times:
+
+    1. The robust scaling is fit on a random sample of `sample_size` songs, so its medians and quartiles are estimates.
+    2. ``sklearn.decomposition.IncrementalPCA`` is fit down to `reduce_to` dimensions, one scaled batch at a time.
+    3. Every batch is scaled and reduced, and only the reduced songs are kept.
+
+    ``np.nan_to_num`` and the clipping happen in place on each batch. The memory needed is then roughly
+    ``4 * (sample_size + 4 * batch_size) * features`` bytes for the first two passes and ``8 * songs * reduce_to``
+    for the reduced corpus, whatever the size of the corpus. The reduced corpus is then embedded in memory.
+
+    :param corp: dict or NoneType default is ``load_corpus()``, which memory maps the feature store.
+    :param tar_len: int crop every song to its middle `tar_len` frames.
+    :param pad_shorts: bool pad songs shorter than that rather than leaving them out.
+    :param reduce_to: int PCA dimensions, or fewer if there are fewer songs or features than that.
+    :param embedding: sklearn transformer or NoneType run on the reduced songs. Default is the Isomap from
+    ``default_pipeline``, use ``LandmarkIsomap`` for really big libraries.
+    :param batch_size: int songs per batch, at least `reduce_to`.
+    :param sample_size: int songs to fit the scaling on.
+    :param lower: float clip below
+    :param upper: float clip above
+    :param random_state: int or NoneType for the sample.
+    :return: pd.DataFrame in the same format as ``make_manifold``
+    """
+    if corp is None:
+        corp = load_corpus()
+    if embedding is None:
+        embedding = default_pipeline().named_steps['embedding']
+    tags = [tag for tag in corp if pad_shorts or corp[tag].shape[1] >= tar_len]
+    if not tags:
+        raise ValueError('The corpus is empty.' if pad_shorts else f'No song in the corpus is {tar_len} frames long.')
+    # IncrementalPCA can't find more components than the songs in its first batch, or the features.
+    reduce_to = min(reduce_to, len(tags), corp[tags[0]].shape[0] * tar_len)
+    batch_size = max(batch_size, reduce_to)
+
+    rng = np.random.default_rng(random_state)
+    sample = sorted(rng.choice(len(tags), size=min(sample_size, len(tags)), replace=False))
+    _, songs = next(song_batches(corp, [tags[i] for i in sample], tar_len, pad_shorts, len(sample)))
+    center, scale = robust_scale_params(songs)
+    del songs
+
+    pca = dcomp.IncrementalPCA(n_components=reduce_to)
+    for _, songs in song_batches(corp, tags, tar_len, pad_shorts, batch_size):
+        songs = robust_scale(songs, lower, upper, center=center, scale=scale)
+        with instrument.span('learning.fit', step='pca', songs=len(songs)):
+            pca.partial_fit(songs)
+
+    reduced = np.empty((len(tags), reduce_to))
+    order = []
+    for batch_tags, songs in song_batches(corp, tags, tar_len, pad_shorts, batch_size):
+        songs = robust_scale(songs, lower, upper, center=center, scale=scale)
+        with instrument.span('learning.transform', step='pca', songs=len(songs)):
+            reduced[len(order):len(order) + len(batch_tags)] = pca.transform(songs)
+        order += batch_tags
+
+    with instrument.span('learning.fit', step='embedding', songs=len(reduced)):
+        songs_transformed = embedding.fit_transform(reduced)
+    return pd.DataFrame(songs_transformed.T, columns=order)
+
+
+def default_pipeline():
+    """
+    A fresh copy of the pipeline ``make_manifold`` uses by default, PCA into Isomap with 45 components.
+
+    :return: sklearn.pipeline.Pipeline
+    """
+    return Pipeline([('reduce_dims', dcomp.PCA()), ('embedding', mnfd.Isomap(n_components=45))])
+
+
+class LandmarkIsomap(BaseEstimator, TransformerMixin):
+    """
+    Isomap for libraries too big for ``sklearn.manifold.Isomap``, which keeps the geodesic distance between every pair
+    of songs, so it needs 8 N² bytes and stops fitting somewhere in the tens of thousands of songs. This follows
+    de Silva and Tenenbaum's landmark Isomap instead:
+
+    1. Each song is joined to its `n_neighbors` nearest neighbours in a sparse graph, which takes O(N k) memory.
+    2. Geodesic distances are only found from `n_landmarks` randomly chosen songs to everything else, by running
+       Dijkstra from each of them, `batch_size` at a time.
+    3. Classical MDS is done on the landmarks alone, and every other song is placed by triangulating from its distances
+       to the landmarks.
+
+    The memory is then about 4 `n_landmarks` N bytes for the landmark distances, which are kept for :meth:`transform`,
+    and the time is about `n_landmarks` runs of Dijkstra on the graph. Those two knobs trade accuracy for speed, a
+    couple of thousand landmarks is plenty to get the shape of a library. Finding the neighbours is brute force, so it
+    goes a lot faster after a PCA to a hundred or so dimensions, see ``landmark_pipeline``.
+
+    If the neighbour graph comes out in more than one piece, the distance between pieces is taken to be twice the
+    largest distance found within one.
+
+    :param n_components: int dimensions of the embedding.
+    :param n_neighbors: int neighbours per song in the graph.
+    :param n_landmarks: int songs to find geodesics from.
+    :param batch_size: int landmarks to run Dijkstra from at once, each needs 8 N bytes while it runs.
+    :param n_jobs: int or NoneType for the neighbour search.
+    :param random_state: int or NoneType for picking the landmarks.
+    """
+
+    def __init__(self, n_components=45, n_neighbors=10, n_landmarks=2000, batch_size=64, n_jobs=None,
+                 random_state=None):
+        self.n_components = n_components
+        self.n_neighbors = n_neighbors
+        self.n_landmarks = n_landmarks
+        self.batch_size = batch_size
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+
+    def fit(self, X, y=None):
+        self.fit_transform(X)
+        return self
+
+    def fit_transform(self, X, y=None):
+        X = np.asarray(X)
+        n = X.shape[0]
+        if n < 2:
+            raise ValueError(f'LandmarkIsomap needs at least 2 songs to find neighbours among, got {n}.')
+        self.nbrs_ = NearestNeighbors(n_neighbors=min(self.n_neighbors, n - 1), n_jobs=self.n_jobs).fit(X)
+        graph = self.nbrs_.kneighbors_graph(mode='distance')
+        graph = graph.maximum(graph.T).tocsr()
+
+        rng = np.random.default_rng(self.random_state)
+        self.landmarks_ = np.sort(rng.choice(n, size=min(self.n_landmarks, n), replace=False))
+        self.geodesics_ = np.empty((len(self.landmarks_), n), dtype=np.float32)
+        for st in range(0, len(self.landmarks_), self.batch_size):
+            batch = self.landmarks_[st:st + self.batch_size]
+            self.geodesics_[st:st + len(batch)] = csgraph.dijkstra(graph, directed=False, indices=batch)
+        finite = np.isfinite(self.geodesics_)
+        if not finite.all():
+            self.geodesics_[~finite] = 2 * self.geodesics_[finite].max()
+
+        # Classical MDS on the landmarks, then the rest are placed from their distances to them.
+        squared = self.geodesics_[:, self.landmarks_].astype(np.float64) ** 2
+        squared = (squared + squared.T) / 2
+        self.mean_squared_ = squared.mean(axis=1)
+        centered = squared - self.mean_squared_[:, None] - self.mean_squared_[None, :] + self.mean_squared_.mean()
+        eigenvalues, eigenvectors = np.linalg.eigh(-centered / 2)
+        order = np.argsort(eigenvalues)[::-1][:self.n_components]
+        eigenvalues = np.clip(eigenvalues[order], np.finfo(float).eps, None)
+        self.pseudoinverse_ = (eigenvectors[:, order] / np.sqrt(eigenvalues)).T
+        return self._place(self.geodesics_)
+
+    def _place(self, geodesics):
+        """
+        Triangulates songs from their geodesic distances to the landmarks, a (landmarks, songs) array.
+        """
+        embedding = np.empty((geodesics.shape[1], self.pseudoinverse_.shape[0]))
+        for st in range(0, geodesics.shape[1], 8192):
+            squared = geodesics[:, st:st + 8192].astype(np.float64) ** 2
+            embedding[st:st + 8192] = (-self.pseudoinverse_ @ (squared - self.mean_squared_[:, None]) / 2).T
+        return embedding
+
+    def transform(self, X):
+        """
+        Places new songs from their nearest neighbours among the songs it was fit on, the same way Isomap does.
+        """
+        distances, neighbours = self.nbrs_.kneighbors(np.asarray(X))
+        geodesics = np.empty((len(self.landmarks_), len(neighbours)), dtype=np.float32)
+        for i, (dist, nbr) in enumerate(zip(distances, neighbours)):
+            geodesics[:, i] = (self.geodesics_[:, nbr] + dist.astype(np.float32)).min(axis=1)
+        return self._place(geodesics)
+
+
+def landmark_pipeline(n_components=45, reduce_to=100, n_neighbors=10, n_landmarks=2000, random_state=None):
+    """
+    The large library version of ``default_pipeline``. A randomized PCA down to `reduce_to` dimensions, so the
+    neighbour search is quick, into ``LandmarkIsomap``. The output is the same shape as the default's, so
+    ``make_manifold`` and ``ManifoldModel`` can use it as is, and ``playlists`` won't know the difference. With the
+    defaults, 200k songs take about 2 GB on top of the flattened corpus.
+
+    :param n_components: int
+    :param reduce_to: int PCA dimensions
+    :param n_neighbors: int see ``LandmarkIsomap``
+    :param n_landmarks: int see ``LandmarkIsomap``
+    :param random_state: int or NoneType
+    :return: sklearn.pipeline.Pipeline
+    """
+    return Pipeline([('reduce_dims', dcomp.PCA(n_components=reduce_to, svd_solver='randomized',
+                                               random_state=random_state)),
+                     ('embedding', LandmarkIsomap(n_components=n_components, n_neighbors=n_neighbors,
+                                                  n_landmarks=n_landmarks, random_state=random_state))])
+
+
+class ManifoldModel:
+    """
+    A fitted manifold that can be kept around and added to. ``make_manifold`` throws away the scaling and the pipeline
+    once it has the data frame, so a new album means fitting everything again. This keeps the robust scaling, the clip
+    bounds, the crop and the fitted pipeline, so new songs can be put into the space that's already there with
+    :meth:`transform_new`, which only costs as much as the new songs. The embedding step has to support ``transform``
+    for that, which Isomap does, by finding where each new song would sit among its nearest neighbours.
+
+    Songs placed that way don't move the manifold, so once enough of the library has been added since the last fit it
+    stops describing the library very well. :attr:`drift` is the number of songs added since the last fit, as a share
+    of those it was fit on, and :meth:`transform_new` refits everything once that passes `max_drift`.
+
+    :attr:`version` changes whenever the manifold does, so anything caching playlists can tell when to throw them out.
+
+    :param pipeline: sklearn.pipeline.Pipeline or NoneType default is ``default_pipeline()``
+    :param tar_len: int crop every song to its middle `tar_len` frames, as in ``Corpus.crop``.
+    :param pad_shorts: bool pad songs shorter than `tar_len` rather than leaving them out.
+    :param lower: float clip the scaled features below this
+    :param upper: float and above this
+    :param max_drift: float refit once the songs added since the last fit are more than this share of the manifold.
+    """
+
+    def __init__(self, pipeline=None, tar_len=120, pad_shorts=True, lower=-1000, upper=5, max_drift=0.25):
+        self.pipeline = default_pipeline() if pipeline is None else pipeline
+        self.tar_len = tar_len
+        self.pad_shorts = pad_shorts
+        self.lower = lower
+        self.upper = upper
+        self.max_drift = max_drift
+        self.center = None
+        self.scale = None
+        self.frame = pd.DataFrame()
+        self.fitted_tags = []
+        self.fits = 0
+        self.fitted = None
+
+    @property
+    def version(self):
+        """
+        :return: str the number of fits so far, and the number of songs in the manifold.
+        """
+        return f'{self.fits}.{len(self.frame.columns)}'
+
+    @property
+    def drift(self):
+        """
+        :return: float songs added since the last fit, as a share of the songs it was fit on.
+        """
+        if not self.fitted_tags:
+            return np.inf
+        return (len(self.frame.columns) - len(self.fitted_tags)) / len(self.fitted_tags)
+
+    def needs_refit(self):
+        """
+        :return: bool whether the drift has passed `max_drift`.
+        """
+        return self.drift > self.max_drift
+
+    def _songs(self, corpus):
+        """
+        Crops and flattens a corpus the way the model was fit.
+
+        :return: tuple (list of tags, (songs, features) matrix)
+        """
+        if not isinstance(corpus, Corpus):
+            corpus = Corpus.from_dict(corpus, tar_len=self.tar_len)
+        corpus = corpus.crop(self.tar_len, pad_shorts=self.pad_shorts)
+        return corpus.tags, corpus.flatten()
+
+    def fit(self, corpus):
+        """
+        Fits the scaling and the pipeline on a whole corpus, replacing the manifold.
+
+        :param corpus: Corpus or dict
+        :return: ManifoldModel itself
+        """
+        tags, songs = self._songs(corpus)
+        self.center, self.scale = robust_scale_params(songs)
+        robust_scale(songs, self.lower, self.upper, center=self.center, scale=self.scale)
+        self.pipeline = clone(self.pipeline)
+        with instrument.span('learning.fit', songs=songs.shape[0], features=songs.shape[1]):
+            songs_transformed = self.pipeline.fit_transform(songs)
+        self.frame = pd.DataFrame(songs_transformed.T, columns=tags)
+        self.fitted_tags = list(tags)
+        self.fits += 1
+        self.fitted = time.time()
+        return self
+
+    def transform(self, corpus):
+        """
+        Places songs in the manifold without changing it.
+
+        :param corpus: Corpus or dict of the songs to place.
+        :return: pd.DataFrame in the same format as ``make_manifold``
+        """
+        tags, songs = self._songs(corpus)
+        if not tags:
+            return pd.DataFrame(index=self.frame.index)
+        robust_scale(songs, self.lower, self.upper, center=self.center, scale=self.scale)
+        with instrument.span('learning.transform', songs=songs.shape[0]):
+            return pd.DataFrame(self.pipeline.transform(songs).T, columns=tags)
+
+    def transform_new(self, tags, corpus=None, refit=True):
+        """
+        Places new songs in the manifold and adds them to :attr:`frame`. Songs that are already in it are skipped, and
+        so are songs shorter than `tar_len` unless the model pads them. If that pushes the drift past `max_drift`, and
+        `refit` is True, the whole manifold is fit again.
+
+        :param tags: list of corpus tags
+        :param corpus: Corpus or dict with the new songs in it. Default is ``load_corpus()``, which is a memory map of
+        the feature store, so it's cheap to load.
+        :param refit: bool whether to refit if the manifold has drifted too far.
+        :return: pd.DataFrame the new songs' columns.
+        """
+        if corpus is None:
+            corpus = load_corpus()
+        new = [tag for tag in dict.fromkeys(tags) if tag not in self.frame.columns]
+        placed = self.transform({tag: corpus[tag] for tag in new})
+        self.frame = pd.concat([self.frame, placed], axis=1)
+        if refit and self.needs_refit():
+            self.refit(corpus)
+        return self.frame[placed.columns]
+
+    def refit(self, corpus=None):
+        """
+        Fits the model again on every song in the manifold.
+
+        :param corpus: Corpus or dict with every song in the manifold in it. Default is ``load_corpus()``
+        :return: ManifoldModel itself
+        """
+        tags = list(self.frame.columns)
+        if corpus is None or any(tag not in corpus for tag in tags):
+            corpus = load_corpus()
+        return self.fit({tag: corpus[tag] for tag in tags})
+
+    def save(self, loc='manifold_model.pkl'):
+        """
+        Pickles the model with ``library.dump_atomic``, so an interrupted save leaves the old model intact.
+
+        :param loc: str
+        :return: NoneType
+        """
+        dump_atomic(self, loc)
+
+    @staticmethod
+    def load(loc='manifold_model.pkl'):
+        """
+        :param loc: str
+        :return: ManifoldModel
+        """
+        with open(loc, 'rb') as file:
+            return pickle.load(file)
+
+
 if __name__ == '__main__':
     libr = library_from_regex(re.compile(''))
-    cor = load_corpus()
-    nc = cropped_corpus(cor, tar_len=120, pad_shorts=True)
+    cor = Corpus.from_dict(load_corpus(), tar_len=120)
+    nc = cor.crop(tar_len=120, pad_shorts=True)
     mandf = make_manifold(nc)
     with open('manifold.pkl') as f:
         pickle.dump(mandf, f)
@@ -0,0 +1,359 @@
+import json
+import logging
+import os
+import pickle
+import re
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import mutagen
+import soundfile as sf
+
+log = logging.getLogger(__name__)
+
+
+def tag_from_metadata(mdata):
+    """
+    Turns a file's metadata, as read by mutagen, into a corpus tag.
+
+
+    :param mdata: mutagen.FileType
+
+    :return: str the tag as used by the learning parts of the system.
+    """
+    try:
+        album = mdata['album'][0]
+    except KeyError:
+        album = "Unknown Album"
+    try:
+        albumartist = mdata['albumartist'][0]
+    except KeyError:
+        albumartist = mdata['artist'][0]
+    try:
+        name = re.sub('[\\\\/]', '', mdata['title'][0])
+    except KeyError:
+        name = 'Unknown Track'
+
+    filename = f'{albumartist} - {album} - {name}'
+    filename = re.sub('[?*:"<>/|]', "", filename)
+    return filename
+
+
+def scan_folder(folder, depth, include=None, exclude=None, extensions=('.flac',), include_depth=None,
+                included=False):
+    """
+    Lists one folder for ``walk_library``.
+
+
+    :return: tuple (list of matching files, list of (subfolder, whether it's already included) to go into)
+    """
+    files = []
+    folders = []
+    try:
+        entries = list(os.scandir(folder))
+    except (NotADirectoryError, PermissionError, FileNotFoundError):
+        return files, folders
+    for entry in entries:
+        if exclude is not None and exclude.match(entry.name):
+            continue
+        matched = included or include is None
+        if not matched and (include_depth is None or depth < include_depth):
+            matched = bool(include.match(entry.name))
+        if entry.is_dir():
+            if matched or include_depth is None or depth + 1 < include_depth:
+                folders.append((entry.path, matched))
+        elif matched and entry.name.endswith(extensions):
+            files.append(entry.path)
+    return files, folders
+
+
+def walk_library(locale, include=None, exclude=None, extensions=('.flac',), include_depth=None, workers=8):
+    """
+    Finds every song under `locale`. Folders are listed with ``os.scandir`` by a pool of threads, so a slow network
+    share can have lots of listings in flight at once, and paths are handed back as soon as their folder has been
+    listed, in no particular order.
+
+    A file is kept if its extension is one of `extensions` and either it or one of the folders it's in matches
+    `include`. Anything, file or folder, whose name matches `exclude` is skipped, along with everything in it.
+
+
+    :param locale: str the top of your music library.
+
+    :param include: re.Pattern or NoneType matched (with ``re.match``) against file and folder names. None keeps all.
+
+    :param exclude: re.Pattern or NoneType
+
+    :param extensions: tuple of str file extensions to keep.
+
+    :param include_depth: int or NoneType only try `include` against names this many levels down or fewer. 1 means
+    only the top level folders, which is what ``library_from_regex`` has always done. None means any depth.
+
+    :param workers: int how many folders to list at once.
+
+    :return: generator of str paths
+    """
+    running = {}
+    with ThreadPoolExecutor(workers) as pool:
+        def submit(folder, depth, included):
+            future = pool.submit(scan_folder, folder, depth, include, exclude, extensions, include_depth, included)
+            running[future] = depth
+
+        submit(locale, 0, False)
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                depth = running.pop(future)
+                files, folders = future.result()
+                for folder, included in folders:
+                    submit(folder, depth + 1, included)
+                yield from files
+
+
+def scan_file(song_loc, stat=None):
+    """
+    Reads everything the rest of the system needs to know about a song in one go: its size and modification time, its
+    length from the audio header, its tags, and its corpus tag. If the file can't be read, the record comes back with
+    a status of 'failed', one failed attempt (see ``record_failure``) and no corpus tag.
+
+
+    :param song_loc: str the file location
+
+    :param stat: os.stat_result or NoneType if you've already stat-ed the file.
+
+    :return: dict a manifest record.
+    """
+    if stat is None:
+        stat = os.stat(song_loc)
+    record = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'frames': None, 'samplerate': None, 'channels': None,
+              'duration': None, 'tags': {}, 'tag': None, 'status': 'new', 'attempts': 0}
+    try:
+        info = sf.info(song_loc)
+        record['frames'] = info.frames
+        record['samplerate'] = info.samplerate
+        record['channels'] = info.channels
+        record['duration'] = info.frames / info.samplerate
+
+        mdata = mutagen.File(song_loc)
+        record['tags'] = {key: mdata[key][0] for key in ('album', 'albumartist', 'artist', 'title') if key in mdata}
+        record['tag'] = tag_from_metadata(mdata)
+    except (RuntimeError, mutagen.MutagenError, KeyError, TypeError):
+        record['status'] = 'failed'
+        record['attempts'] = 1
+    return record
+
+
+def dump_atomic(obj, loc):
+    """
+    Pickles something to a temporary file, syncs it to disk, and only then moves it into place, so whatever was at
+    `loc` before stays intact until the new one is completely written, even if the process gets killed halfway.
+
+
+    :param obj: anything picklable
+
+    :param loc: str where it goes.
+
+    :return: NoneType
+    """
+    tmp = f'{loc}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as file:
+        pickle.dump(obj, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp, loc)
+
+
+def trim_partial_line(loc):
+    """
+    Cuts a line that's missing its newline off the end of a file, the leftover of a process that was killed while it
+    was appending, so the next append starts on a line of its own instead of being glued onto half of one.
+
+
+    :param loc: str location of a file of lines, which doesn't have to exist.
+
+    :return: int how many bytes were cut off.
+    """
+    if not os.path.exists(loc):
+        return 0
+    with open(loc, 'rb+') as file:
+        size = file.seek(0, os.SEEK_END)
+        end = size
+        while end > 0:
+            start = max(0, end - 4096)
+            file.seek(start)
+            block = file.read(end - start)
+            newline = block.rfind(b'\n')
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        if end == size:
+            return 0
+        file.truncate(end)
+        file.flush()
+        os.fsync(file.fileno())
+    return size - end
+
+
+def ledger_location(loc='manifest.pkl'):
+    """
+    Where the ledger of a manifest goes, see ``append_ledger``.
+
+
+    :param loc: str location of the manifest.
+
+    :return: str
+    """
+    return loc + '.ledger'
+
+
+def load_manifest(loc='manifest.pkl'):
+    """
+    Loads the library manifest, a dict relating each song's location to its manifest record (see ``scan_file``).
+    Returns an empty manifest if there isn't one yet. Anything in the manifest's ledger, records written since it was
+    last saved, e.g. by a run that got killed, is applied on top.
+
+
+    :param loc: str location of the manifest.
+
+    :return: dict
+    """
+    manifest = {}
+    if os.path.exists(loc) and os.path.getsize(loc) > 0:
+        with open(loc, 'rb') as file:
+            manifest = pickle.load(file)
+    ledger = ledger_location(loc)
+    if os.path.exists(ledger):
+        with open(ledger, encoding='utf-8') as file:
+            for number, line in enumerate(file, 1):
+                # A line without its newline was cut off part way through, so it's left out.
+                if not line.endswith('\n'):
+                    continue
+                try:
+                    entry = json.loads(line)
+                    manifest[entry['song']] = entry['record']
+                except (ValueError, KeyError, TypeError):
+                    log.warning('Skipping line %d of %s, which can\'t be read.', number, ledger)
+    return manifest
+
+
+def append_ledger(manifest, songs, loc='manifest.pkl'):
+    """
+    Writes the current records of a few songs to the end of the manifest's ledger, and syncs it to disk. This costs
+    the same however big the manifest is, so it can be done as every result comes in, and nothing that's finished is
+    lost if the run doesn't. ``save_manifest`` folds the ledger back into the manifest. If an earlier run was killed
+    half way through a line, that line is cut off first (see ``trim_partial_line``), so this one isn't glued onto it.
+
+
+    :param manifest: dict
+
+    :param songs: list of song locations
+
+    :param loc: str location of the manifest.
+
+    :return: NoneType
+    """
+    if not songs:
+        return
+    trim_partial_line(ledger_location(loc))
+    with open(ledger_location(loc), 'a', encoding='utf-8') as file:
+        file.write(''.join(json.dumps({'song': song, 'record': manifest[song]}) + '\n' for song in songs))
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def save_manifest(manifest, loc='manifest.pkl'):
+    """
+    Writes the manifest out, with ``dump_atomic``, so an interrupted save leaves the old manifest intact. Its ledger is
+    then no longer needed, and is removed.
+
+
+    :param manifest: dict
+
+    :param loc: str location of the manifest.
+
+    :return: NoneType
+    """
+    dump_atomic(manifest, loc)
+    if os.path.exists(ledger_location(loc)):
+        os.remove(ledger_location(loc))
+
+
+def record_failure(record, retries=2):
+    """
+    Counts a failed attempt at a song against its record. Once it's failed more than `retries` times over, it's
+    quarantined, and ``analysis.preprocess`` leaves it alone until the file changes. Edits the record in-place.
+
+
+    :param record: dict manifest record
+
+    :param retries: int how many times to try again after the first failure.
+
+    :return: str the song's new status.
+    """
+    record['attempts'] = record.get('attempts', 0) + 1
+    record['status'] = 'quarantined' if record['attempts'] > retries else 'failed'
+    return record['status']
+
+
+def quarantined(manifest):
+    """
+    :param manifest: dict
+
+    :return: list the songs that have failed too many times to be tried again. See ``record_failure``.
+    """
+    return [song for song, record in manifest.items() if record['status'] == 'quarantined']
+
+
+def refresh_record(manifest, song):
+    """
+    Brings one song's manifest record up to date. The song is stat-ed, and only read again if it's new, or if its size
+    or modification time have changed since it was last scanned, in which case its status goes back to 'new'. Edits
+    the manifest in-place.
+
+
+    :param manifest: dict as returned by ``load_manifest``
+
+    :param song: str song location
+
+    :return: bool whether the song had to be (re)scanned.
+    """
+    stat = os.stat(song)
+    record = manifest.get(song)
+    if record is None or record['size'] != stat.st_size or record['mtime'] != stat.st_mtime_ns:
+        manifest[song] = scan_file(song, stat)
+        return True
+    return False
+
+
+def update_manifest(manifest, lib, workers=8):
+    """
+    Brings the manifest up to date with the songs in lib. Every song gets stat-ed, but only the ones that are new, or
+    whose size or modification time have changed since the last scan, are opened and read. Those get a fresh record,
+    with their status set back to 'new'. Edits the manifest in-place.
+
+
+    :param manifest: dict as returned by ``load_manifest``
+
+    :param lib: list of song locations
+
+    :param workers: int how many files to read at once.
+
+    :return: list the songs which were (re)scanned.
+    """
+    with ThreadPoolExecutor(workers) as pool:
+        rescanned = pool.map(lambda song: refresh_record(manifest, song), lib)
+        return [song for song, changed in zip(lib, rescanned) if changed]
+
+
+def prune_manifest(manifest):
+    """
+    Drops the records of songs which aren't there anymore. Edits the manifest in-place.
+
+
+    :param manifest: dict
+
+    :return: list the songs which were dropped.
+    """
+    gone = [song for song in manifest if not os.path.exists(song)]
+    for song in gone:
+        del manifest[song]
+    return gone
@@ -0,0 +1,160 @@
+import os
+import pickle
+import sqlite3
+import threading
+from collections.abc import Mapping
+
+here = os.path.dirname(__file__)
+
+LOCATIONS = os.path.join(here, 'locations.db')
+
+
+class LocationStore(Mapping):
+    """
+    Where every song is, by corpus tag. It's a SQLite database with one row per song, indexed both ways, so looking up
+    a tag's file, or a file's tag, is one query, and adding or moving a few songs only touches their rows, however big
+    the library is. It reads like a dict relating tags to file locations, so it can be handed to anything that used to
+    take the tag dictionary, e.g. ``playlists.generate_m3u``.
+
+    The database is in WAL mode, so the playlists and ``server.py`` can keep reading while ``analysis.preprocess``
+    writes, and one store can be shared between threads.
+
+    :param str loc: the database file. It's created if it doesn't exist.
+
+    :param legacy: str, list or NoneType pickled tag dictionaries, as the old ``locations.pkl`` were, to import if the
+    store is empty. Default is a ``locations.pkl`` next to `loc`, then one in the parent folder, where
+    ``analysis.create_location_dictionary`` used to keep it.
+    """
+
+    def __init__(self, loc=LOCATIONS, legacy=None):
+        self.loc = loc
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(loc, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS locations (tag TEXT PRIMARY KEY, path TEXT NOT NULL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS locations_path ON locations (path)')
+        if legacy is None:
+            legacy = [os.path.join(os.path.dirname(os.path.abspath(loc)), 'locations.pkl'),
+                      os.path.join('..', 'locations.pkl')]
+        elif isinstance(legacy, str):
+            legacy = [legacy]
+        if self.empty():
+            for old in legacy:
+                if os.path.exists(old) and os.path.getsize(old) > 0:
+                    self.import_pickle(old)
+                    break
+
+    def _query(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def __getitem__(self, tag):
+        rows = self._query('SELECT path FROM locations WHERE tag = ?', (tag,))
+        if not rows:
+            raise KeyError(tag)
+        return rows[0][0]
+
+    def __contains__(self, tag):
+        return bool(self._query('SELECT 1 FROM locations WHERE tag = ?', (tag,)))
+
+    def __len__(self):
+        return self._query('SELECT COUNT(*) FROM locations')[0][0]
+
+    def __iter__(self):
+        return iter([tag for tag, in self._query('SELECT tag FROM locations')])
+
+    def empty(self):
+        """
+        :return: bool whether there are no songs at all. Unlike ``len``, this doesn't count them.
+        """
+        return not self._query('SELECT 1 FROM locations LIMIT 1')
+
+    def tag(self, path, default=None):
+        """
+        The tag of the song at a file location.
+
+        :param str path:
+
+        :param default: what to return if there's no song there.
+
+        :return: str
+        """
+        rows = self._query('SELECT tag FROM locations WHERE path = ?', (path,))
+        return rows[0][0] if rows else default
+
+    def locations(self, tags):
+        """
+        Looks up lots of tags at once.
+
+        :param tags: list of str
+
+        :return: dict relating each of the tags that's in the store to its file location.
+        """
+        tags = list(tags)
+        found = {}
+        # SQLite only takes so many parameters in one query.
+        for start in range(0, len(tags), 500):
+            chunk = tags[start:start + 500]
+            found.update(self._query(f'SELECT tag, path FROM locations WHERE tag IN ({",".join("?" * len(chunk))})',
+                                     chunk))
+        return found
+
+    def update(self, pairs=(), **kwargs):
+        """
+        Adds songs, or moves them. Any other tag that was at one of the file locations is dropped, so a retagged file
+        doesn't leave its old tag behind. It's all one transaction, so either every song is written or none are.
+
+        :param pairs: dict relating tags to file locations, or an iterable of (tag, location) pairs.
+
+        :return: NoneType
+        """
+        pairs = list(pairs.items() if isinstance(pairs, Mapping) else pairs) + list(kwargs.items())
+        if not pairs:
+            return
+        with self.lock, self.conn:
+            self.conn.executemany('DELETE FROM locations WHERE path = ? AND tag != ?',
+                                  [(path, tag) for tag, path in pairs])
+            self.conn.executemany('INSERT OR REPLACE INTO locations (tag, path) VALUES (?, ?)', pairs)
+
+    def remove(self, tags):
+        """
+        Drops songs from the store.
+
+        :param tags: list of str
+
+        :return: NoneType
+        """
+        with self.lock, self.conn:
+            self.conn.executemany('DELETE FROM locations WHERE tag = ?', [(tag,) for tag in tags])
+
+    def import_pickle(self, loc):
+        """
+        Adds everything in a pickled tag dictionary, like the old ``locations.pkl``.
+
+        :param str loc:
+
+        :return: NoneType
+        """
+        with open(loc, 'rb') as file:
+            self.update(pickle.load(file))
+
+    def to_dict(self):
+        """
+        :return: dict relating every tag to its file location.
+        """
+        return dict(self._query('SELECT tag, path FROM locations'))
+
+    def items(self):
+        return self.to_dict().items()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
@@ -1,7 +1,12 @@
+from collections import OrderedDict
+
 import numpy as np
 import pandas as pd
 from learning import load_corpus
-from scipy.spatial.distance import pdist
+from scipy.stats import norm
+
+ARTIST = 0
+ALBUM = 1
 
 
 def corpus_xdsd(mdf):
@@ -16,15 +21,331 @@ def corpus_xdsd(mdf):
     return xd_sd
 
 
-def corpus_cohesion(mdf):
+class DistanceStats:
+    """
+    Running totals of a lot of pairwise distances, so their mean, standard deviation and mean log can be had without
+    ever keeping the distances themselves. ``pairwise_stats`` fills one in with every pair, ``sampled_pairwise_stats``
+    with a random sample of them, in which case the means are estimates and :meth:`interval` says how good.
+
+    :param int population: how many pairs there are in all.
+    :param bool logs: whether to keep the totals of the log distances too. Taking the logs is about as slow as working
+    out the distances, so leave it off if they're not needed.
+    """
+
+    def __init__(self, population, logs=True):
+        self.population = population
+        self.logs = logs
+        self.count = 0
+        self.total = 0.
+        self.squares = 0.
+        self.log_total = 0. if logs else np.nan
+        self.log_squares = 0. if logs else np.nan
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, dists):
+        """
+        Adds some distances to the totals. NaNs are left out, like ``np.nanmean`` would.
+
+        :param np.array dists:
+        :return: NoneType
+        """
+        dists = dists.ravel()
+        total = dists.sum()
+        if np.isnan(total):
+            dists = dists[~np.isnan(dists)]
+            total = dists.sum()
+        if not len(dists):
+            return
+        self.count += len(dists)
+        self.total += total
+        self.squares += dists @ dists
+        if self.logs:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                logs = np.log(dists)
+                self.log_total += logs.sum()
+                self.log_squares += logs @ logs
+        self.min = min(self.min, dists.min())
+        self.max = max(self.max, dists.max())
+
+    @property
+    def sampled(self):
+        return self.count < self.population
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else np.nan
+
+    @property
+    def log_mean(self):
+        return self.log_total / self.count if self.count else np.nan
+
+    @property
+    def std(self):
+        if not self.count:
+            return np.nan
+        return np.sqrt(max(self.squares / self.count - self.mean ** 2, 0))
+
+    @property
+    def log_std(self):
+        if not self.count:
+            return np.nan
+        with np.errstate(invalid='ignore'):
+            return np.sqrt(max(self.log_squares / self.count - self.log_mean ** 2, 0))
+
+    def interval(self, confidence=0.95, log=False):
+        """
+        A normal approximation confidence interval for the mean (or mean log) distance over every pair, from the
+        sample. If every pair went into the totals, it's just the mean.
+
+        :param float confidence:
+        :param bool log: the interval for the mean log distance instead.
+        :return: tuple (low, high)
+        """
+        mean, std = (self.log_mean, self.log_std) if log else (self.mean, self.std)
+        if not self.sampled:
+            return mean, mean
+        error = norm.ppf(0.5 + confidence / 2) * std / np.sqrt(max(self.count - 1, 1))
+        return mean - error, mean + error
+
+
+def _tile_distances(x, y, x_squares, y_squares):
+    """
+    Euclidean distances between the rows of two blocks of songs, with one matrix product. Where that loses too many
+    digits, i.e. songs that are very close compared to how far they are from the origin, it's redone the slow way, so
+    that identical songs come out at exactly zero like they do with ``pdist``.
+    """
+    dists = x @ (-2 * y).T
+    dists += x_squares[:, None]
+    dists += y_squares[None, :]
+    # Only rows with something that close in them need looking at.
+    with np.errstate(invalid='ignore'):
+        suspect = np.flatnonzero(dists.min(axis=1) < 1e-6 * (x_squares + y_squares.max()))
+    for row in suspect:
+        close = np.flatnonzero(dists[row] < 1e-6 * (x_squares[row] + y_squares))
+        dists[row, close] = np.square(x[row] - y[close]).sum(axis=1)
+    np.maximum(dists, 0, out=dists)
+    return np.sqrt(dists, out=dists)
+
+
+def pairwise_stats(songs, block=2048, logs=True):
+    """
+    The ``DistanceStats`` of every pair of songs, exactly, without ever having more than a `block` by `block` tile of
+    distances in memory. ``pdist`` on 100k songs needs 40 GB, this needs a few tens of MB with the default block.
+
+    :param np.array songs: (songs, dimensions)
+    :param int block: songs per side of a tile.
+    :param bool logs: see ``DistanceStats``
+    :return: DistanceStats
+    """
+    songs = np.asarray(songs, dtype=np.float64)
+    stats = DistanceStats(len(songs) * (len(songs) - 1) // 2, logs)
+    squares = np.square(songs).sum(axis=1)
+    for st in range(0, len(songs), block):
+        x = songs[st:st + block]
+        for other in range(st, len(songs), block):
+            dists = _tile_distances(x, songs[other:other + block], squares[st:st + block],
+                                    squares[other:other + block])
+            if other == st:
+                dists = dists[np.triu_indices(len(x), 1)]
+            stats.update(dists)
+    return stats
+
+
+def sampled_pairwise_stats(songs, pairs=100000, random_state=None, logs=True):
+    """
+    ``pairwise_stats`` from a random sample of pairs, for a quick estimate. See ``DistanceStats.interval`` for how
+    quick.
+
+    :param np.array songs: (songs, dimensions)
+    :param int pairs: how many pairs to sample. If that's all of them, the exact stats are worked out instead.
+    :param random_state: int or NoneType
+    :param bool logs: see ``DistanceStats``
+    :return: DistanceStats
+    """
+    songs = np.asarray(songs, dtype=np.float64)
+    population = len(songs) * (len(songs) - 1) // 2
+    if pairs >= population:
+        return pairwise_stats(songs, logs=logs)
+    stats = DistanceStats(population, logs)
+    rng = np.random.default_rng(random_state)
+    first = rng.integers(len(songs), size=pairs)
+    # An offset of 1 to n - 1 makes sure the second song is never the first.
+    second = (first + rng.integers(1, len(songs), size=pairs)) % len(songs)
+    stats.update(np.sqrt(np.square(songs[first] - songs[second]).sum(axis=1)))
+    return stats
+
+
+def corpus_cohesion(mdf, pairs=None, random_state=None):
     """
     This is a metric for the average pairwise distance for the whole corpus. Divided by the log dimensionality.
 
+    The distances are added up a tile at a time (see ``pairwise_stats``), so this works for any size of corpus. For a
+    quicker estimate while tuning, pass `pairs` to average over that many random pairs instead, and use
+    ``corpus_cohesion_interval`` to see how far off it might be.
+
     :param mdf: pd.DataFrame
+    :param pairs: int or NoneType
+    :param random_state: int or NoneType for the sample.
     :return: float
     """
-    cohesion = np.nanmean(pdist(mdf)) // np.log(mdf.shape[0])
-    return cohesion
+    songs = mdf.values.T
+    if pairs is None:
+        stats = pairwise_stats(songs, logs=False)
+    else:
+        stats = sampled_pairwise_stats(songs, pairs, random_state, logs=False)
+    return stats.mean / np.log(songs.shape[1])
+
+
+def corpus_cohesion_interval(mdf, pairs=100000, confidence=0.95, random_state=None):
+    """
+    A sampled ``corpus_cohesion``, with a confidence interval.
+
+    :param mdf: pd.DataFrame
+    :param int pairs:
+    :param float confidence:
+    :param random_state: int or NoneType
+    :return: tuple (estimate, low, high)
+    """
+    songs = mdf.values.T
+    stats = sampled_pairwise_stats(songs, pairs, random_state, logs=False)
+    low, high = stats.interval(confidence)
+    dims = np.log(songs.shape[1])
+    return stats.mean / dims, low / dims, high / dims
+
+
+class GroupIndex:
+    """
+    Which songs belong to which artist or album, worked out once from the tags. Each song gets the code of its group,
+    the groups are numbered in sorted order of their names, and :attr:`order` lists the songs sorted by group (and in
+    their original order within each group), so each group's songs are the rows ``order[starts[g]:starts[g] +
+    counts[g]]``. Per group metrics are then reductions over those runs of rows, rather than a pass over every song for
+    every group.
+
+    Use ``group_index`` to get one, it keeps the last few it made.
+
+    :param tags: list of corpus tags
+    :param int level: which part of the tag to group by, ``ARTIST`` or ``ALBUM``.
+    """
+
+    def __init__(self, tags, level=ARTIST):
+        self.tags = tuple(tags)
+        self.level = level
+        self.names, self.codes = np.unique([tag.split(' - ')[level] for tag in tags], return_inverse=True)
+        self.order = np.argsort(self.codes, kind='stable')
+        self.counts = np.bincount(self.codes, minlength=len(self.names))
+        self.starts = np.concatenate([[0], np.cumsum(self.counts)[:-1]]).astype(int)
+
+    def __len__(self):
+        return len(self.names)
+
+    def rows(self, group):
+        """
+        :param int group: group code
+        :return: np.array the rows of its songs.
+        """
+        return self.order[self.starts[group]:self.starts[group] + self.counts[group]]
+
+
+_group_indexes = OrderedDict()
+
+
+def remember_group_index(index, keep=8):
+    """
+    Adds a ``GroupIndex`` to the ones ``group_index`` hands out, e.g. one made once and passed to worker processes (see
+    ``tuning``), so they don't each have to make their own.
+
+    :param GroupIndex index:
+    :param int keep: how many to keep.
+    :return: GroupIndex the same one
+    """
+    _group_indexes[(index.tags, index.level)] = index
+    _group_indexes.move_to_end((index.tags, index.level))
+    while len(_group_indexes) > keep:
+        _group_indexes.popitem(last=False)
+    return index
+
+
+def group_index(mdf, level=ARTIST):
+    """
+    The ``GroupIndex`` of a manifold's songs. It's only worked out the first time it's asked for, as long as the songs
+    are the same.
+
+    :param mdf: pd.DataFrame
+    :param int level: ``ARTIST`` or ``ALBUM``
+    :return: GroupIndex
+    """
+    key = (tuple(mdf.columns), level)
+    if key in _group_indexes:
+        _group_indexes.move_to_end(key)
+        return _group_indexes[key]
+    return remember_group_index(GroupIndex(key[0], level))
+
+
+def group_songs(mdf, level=ARTIST):
+    """
+    Groups a corpus by artist or album.
+
+    :param mdf: pd.DataFrame
+    :param int level: ``ARTIST`` or ``ALBUM``
+    :return: dict relating each name to a (songs, dimensions) np.array
+    """
+    index = group_index(mdf, level)
+    songs = mdf.values.T
+    return {name: songs[index.rows(g)] for g, name in enumerate(index.names)}
+
+
+def group_log_distances(mdf, level=ARTIST, batch=2 ** 22, small=64):
+    """
+    The mean log pairwise distance within each group, divided by the log dimensionality. Groups of the same size, up to
+    `small` songs, are done together, with every pair of songs in a batch of them subtracted at once, and bigger ones
+    go through ``pairwise_stats`` one at a time, so a huge "Various Artists" doesn't need all its distances at once.
+
+    :param mdf: pd.DataFrame
+    :param int level: ``ARTIST`` or ``ALBUM``
+    :param int batch: roughly the most numbers to subtract at once.
+    :param int small: the biggest group to batch.
+    :return: np.array one metric per group, nan for groups of one song.
+    """
+    index = group_index(mdf, level)
+    songs = mdf.values.T
+    dims = songs.shape[1]
+    metric = np.full(len(index), np.nan)
+    with np.errstate(divide='ignore'):
+        for size in np.unique(index.counts):
+            groups = np.flatnonzero(index.counts == size)
+            if size < 2:
+                continue
+            if size > small:
+                for g in groups:
+                    metric[g] = pairwise_stats(songs[index.rows(g)]).log_mean / np.log(dims)
+                continue
+            first, second = np.triu_indices(size, 1)
+            step = max(1, batch // (len(first) * dims))
+            for st in range(0, len(groups), step):
+                chunk = groups[st:st + step]
+                rows = index.order[index.starts[chunk][:, None] + np.arange(size)[None, :]]
+                grouped = songs[rows]
+                dist = np.sqrt(((grouped[:, first] - grouped[:, second]) ** 2).sum(axis=2))
+                metric[chunk] = np.nanmean(np.log(dist), axis=1) / np.log(dims)
+    return metric
+
+
+def group_xdsd(mdf, level=ARTIST):
+    """
+    The cross-dimensional standard deviation of each group, from sums over each group's run of rows.
+
+    :param mdf: pd.DataFrame
+    :param int level: ``ARTIST`` or ``ALBUM``
+    :return: np.array one per group
+    """
+    index = group_index(mdf, level)
+    songs = mdf.values.T[index.order].astype(np.float64)
+    means = np.add.reduceat(songs, index.starts, axis=0) / index.counts[:, None]
+    songs -= np.repeat(means, index.counts, axis=0)
+    std = np.sqrt(np.add.reduceat(songs ** 2, index.starts, axis=0) / index.counts[:, None])
+    with np.errstate(invalid='ignore'):
+        return np.nanmean(std, axis=1)
 
 
 def artist_metric(mdf):
@@ -34,12 +355,7 @@ def artist_metric(mdf):
     :param mdf: pd.DataFrame
     :return: dict
     """
-    new_df = group_artists(mdf)
-    dist_df = {}
-    for artist in new_df:
-        dist = pdist(new_df[artist])
-        dist_df[artist] = np.nanmean(np.log(dist)) / np.log(new_df[artist].shape[1])
-    return dist_df
+    return dict(zip(group_index(mdf, ARTIST).names, group_log_distances(mdf, ARTIST)))
 
 
 def group_artists(mdf):
@@ -49,15 +365,7 @@ def group_artists(mdf):
     :param mdf: pd.DataFrame
     :return: dict
     """
-    names = np.unique([code.split(' - ')[0] for code in mdf])
-    new_df = {}
-    for artist in names:
-        songs = []
-        for code in mdf:
-            if code.split(' - ')[0] == artist:
-                songs.append(mdf[code].values)
-        new_df[artist] = np.array(songs)
-    return new_df
+    return group_songs(mdf, ARTIST)
 
 
 def album_metric(mdf):
@@ -67,12 +375,7 @@ def album_metric(mdf):
     :param mdf: pd.DataFrame
     :return: dict
     """
-    new_df = group_albums(mdf)
-    dist_df = {}
-    for album in new_df:
-        dist = pdist(new_df[album])
-        dist_df[album] = np.nanmean(np.log(dist)) / np.log(new_df[album].shape[1])
-    return dist_df
+    return dict(zip(group_index(mdf, ALBUM).names, group_log_distances(mdf, ALBUM)))
 
 
 def avg_album_metric(mdf):
@@ -82,8 +385,7 @@ def avg_album_metric(mdf):
     :param mdf: pd.DataFrame
     :return: float
     """
-    albmet = album_metric(mdf)
-    return np.nanmean(list(albmet.values()))
+    return np.nanmean(group_log_distances(mdf, ALBUM))
 
 
 def avg_artist_metric(mdf):
@@ -93,8 +395,7 @@ def avg_artist_metric(mdf):
     :param mdf: pd.DataFrame
     :return: float
     """
-    artmet = artist_metric(mdf)
-    return np.nanmean(list(artmet.values()))
+    return np.nanmean(group_log_distances(mdf, ARTIST))
 
 
 def album_xdsd(mdf):
@@ -104,12 +405,7 @@ def album_xdsd(mdf):
     :param mdf: pd.DataFrame
     :return: dict
     """
-    new_df = group_albums(mdf)
-    sd_df = {}
-    for album in new_df:
-        xd_sd = np.nanmean(new_df[album].std(axis=0))
-        sd_df[album] = xd_sd
-    return sd_df
+    return dict(zip(group_index(mdf, ALBUM).names, group_xdsd(mdf, ALBUM)))
 
 
 def group_albums(mdf):
@@ -119,15 +415,7 @@ def group_albums(mdf):
     :param mdf: pd.DataFrame
     :return: dict
     """
-    names = np.unique([code.split(' - ')[1] for code in mdf])
-    new_df = {}
-    for album in names:
-        songs = []
-        for code in mdf:
-            if code.split(' - ')[1] == album:
-                songs.append(mdf[code].values)
-        new_df[album] = np.array(songs)
-    return new_df
+    return group_songs(mdf, ALBUM)
 
 
 def artist_xdsd(mdf):
@@ -137,12 +425,7 @@ def artist_xdsd(mdf):
     :param mdf: pd.DataFrame
     :return: dict
     """
-    new_df = group_artists(mdf)
-    sd_df = {}
-    for artist in new_df:
-        xd_sd = np.nanmean(new_df[artist].std(axis=0))
-        sd_df[artist] = xd_sd
-    return sd_df
+    return dict(zip(group_index(mdf, ARTIST).names, group_xdsd(mdf, ARTIST)))
 
 
 def avg_album_xdsd(mdf):
@@ -152,7 +435,7 @@ def avg_album_xdsd(mdf):
     :param mdf: pd.DataFrame
     :return: float
     """
-    return np.nanmean(list(album_xdsd(mdf).values()))
+    return np.nanmean(group_xdsd(mdf, ALBUM))
 
 
 def avg_artist_xdsd(mdf):
@@ -162,7 +445,20 @@ def avg_artist_xdsd(mdf):
     :param mdf: pd.DataFrame
     :return: float
     """
-    return np.nanmean(list(album_xdsd(mdf).values()))
+    return np.nanmean(group_xdsd(mdf, ARTIST))
+
+
+def manifold_frame(xformd_songlist, corp):
+    """
+    Puts transformed songs back into a manifold data frame, with the corpus' tags.
+
+    :param xformd_songlist: np.array (songs, dimensions)
+    :param corp: dict original corpus
+    :return: pd.DataFrame
+    """
+    xformd_songlist = np.asarray(xformd_songlist)
+    tags = list(corp)[:len(xformd_songlist)]
+    return pd.DataFrame(xformd_songlist[:len(tags)].T, columns=tags)
 
 
 def artist_cohesion_score(xformd_songlist, corp):
@@ -174,10 +470,7 @@ def artist_cohesion_score(xformd_songlist, corp):
     :param corp: dict original corpus
     :return: float
     """
-    manifold = {}
-    for title, song in zip(corp, xformd_songlist):
-        manifold[title] = song
-    manifold_df = pd.DataFrame(manifold)
+    manifold_df = manifold_frame(xformd_songlist, corp)
     return avg_artist_metric(manifold_df)
 
 
@@ -189,10 +482,7 @@ def album_cohesion_score(xformd_songlist, corp):
     :param corp: dict original corpus
     :return: float
     """
-    manifold = {}
-    for title, song in zip(corp, xformd_songlist):
-        manifold[title] = song
-    manifold_df = pd.DataFrame(manifold)
+    manifold_df = manifold_frame(xformd_songlist, corp)
     return avg_album_metric(manifold_df)
 
 
@@ -220,10 +510,7 @@ def album_xdsd_score(xformd_songlist, corp):
     :param corp: dict original corpus
     :return: float
     """
-    manifold = {}
-    for title, song in zip(corp, xformd_songlist):
-        manifold[title] = song
-    manifold_df = pd.DataFrame(manifold)
+    manifold_df = manifold_frame(xformd_songlist, corp)
     return avg_album_xdsd(manifold_df)
 
 
@@ -235,10 +522,7 @@ def artist_xdsd_score(xformd_songlist, corp):
     :param corp: dict original corpus
     :return: float
     """
-    manifold = {}
-    for title, song in zip(corp, xformd_songlist):
-        manifold[title] = song
-    manifold_df = pd.DataFrame(manifold)
+    manifold_df = manifold_frame(xformd_songlist, corp)
     return avg_artist_xdsd(manifold_df)
 
 
@@ -250,10 +534,7 @@ def corpus_xdsd_score(xformd_songlist, corp):
     :param corp: dict original corpus
     :return: float
     """
-    manifold = {}
-    for title, song in zip(corp, xformd_songlist):
-        manifold[title] = song
-    manifold_df = pd.DataFrame(manifold)
+    manifold_df = manifold_frame(xformd_songlist, corp)
     return corpus_xdsd(manifold_df)
 
 
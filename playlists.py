@@ -1,8 +1,16 @@
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 import numpy as np
 import pandas as pd
-from scipy.spatial.distance import pdist, cdist, squareform, euclidean
+import pickle
+from scipy.spatial.distance import euclidean
+from sklearn.neighbors import BallTree, KDTree
 from time import time
 from learning import load_tag_dict
+from library import dump_atomic
+from locations import LocationStore
+import instrument
 import os
 
 here = os.path.dirname(__file__)
@@ -14,176 +22,582 @@ def generate_m3u(tags, title, reference, locale='playlists\\'):
 
     :param list tags: The songs you want to target.
     :param str title: the name of the created playlist file.
-    :param dict reference: a dictionary that relates tags to locations
+    :param reference: dict or ``locations.LocationStore`` that relates tags to locations
     :param str locale: the folder to dump playlists in.
     :return: NoneType
     """
+    if isinstance(reference, LocationStore):
+        # Only the playlist's own songs are looked up, in one query.
+        reference = reference.locations(tags)
     with open(f'{locale}{title}.m3u', 'w+', encoding='utf-8') as file:
         for tag in tags:
             file.write(reference[tag] + '\n')
 
 
-def abs_dist_playlist(tag, manifold_df, length=5, metrics=False):
+def manifold_fingerprint(manifold_df):
+    """
+    A hash of a manifold's songs and coordinates, to tell whether a saved ``ManifoldIndex`` was built from it.
+
+    :param pd.DataFrame manifold_df: manifold data frame
+    :return: str
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update('\n'.join(map(str, manifold_df.columns)).encode('utf-8'))
+    digest.update(np.ascontiguousarray(manifold_df.values, dtype=np.float32).tobytes())
+    return digest.hexdigest()
+
+
+class ManifoldIndex:
+    """
+    A nearest neighbour index over the manifold, built once so that each seed song is a tree query rather than a
+    distance matrix of the whole library. The songs are kept as the rows of a float32 matrix, with :attr:`rows`
+    relating each tag to its row, and a KD tree over them. A seed song on a 100k song manifold takes a few
+    milliseconds. A ball tree can do better if the manifold has a lot of dimensions that all matter.
+
+    If `dims` is given the tree only uses the first `dims` coordinates, which is where an Isomap or PCA manifold keeps
+    most of its spread. Queries then take `oversample` times as many candidates from the tree as were asked for, and
+    sort those by their distance in all of the coordinates, so the answer is approximate, but the tree is a lot
+    quicker in few dimensions.
+
+    :param pd.DataFrame manifold_df: manifold data frame, as made by ``learning.make_manifold``
+    :param str kind: 'kd' or 'ball'
+    :param dims: int or NoneType build the tree on this many coordinates, for approximate queries.
+    :param int oversample: candidates per requested song, when `dims` is given.
+    :param int leaf_size: see ``sklearn.neighbors.KDTree``
+    """
+
+    def __init__(self, manifold_df, kind='kd', dims=None, oversample=4, leaf_size=40):
+        if kind not in ('ball', 'kd'):
+            raise ValueError(f'{kind} is not a valid kind of tree.')
+        self.tags = list(manifold_df.columns)
+        self.rows = {tag: i for i, tag in enumerate(self.tags)}
+        self.matrix = np.ascontiguousarray(manifold_df.values.T, dtype=np.float32)
+        self.fingerprint = manifold_fingerprint(manifold_df)
+        self.dims = dims
+        self.oversample = oversample
+        tree = BallTree if kind == 'ball' else KDTree
+        with instrument.span('playlists.index', songs=len(self.tags), kind=kind):
+            self.tree = tree(self.matrix if dims is None else self.matrix[:, :dims], leaf_size=leaf_size)
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __contains__(self, tag):
+        return tag in self.rows
+
+    def vector(self, tag):
+        """
+        :param str tag: corpus tag
+        :return: np.array the song's coordinates.
+        """
+        return self.matrix[self.rows[tag]]
+
+    @instrument.timed('playlists.search')
+    def query_points(self, points, k=5):
+        """
+        The `k` nearest songs to each of a batch of points.
+
+        :param np.array points: (points, dimensions)
+        :param int k: songs per point
+        :return: tuple ((points, k) distances, (points, k) rows), nearest first.
+        """
+        points = np.atleast_2d(np.asarray(points, dtype=np.float32))
+        k = min(k, len(self))
+        if self.dims is None:
+            return self.tree.query(points, k=k)
+        _, candidates = self.tree.query(points[:, :self.dims], k=min(k * self.oversample, len(self)))
+        distances = np.linalg.norm(self.matrix[candidates] - points[:, None, :], axis=2)
+        order = np.argsort(distances, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(candidates, order, axis=1)
+
+    def query_rows(self, rows, k=5, chunk_size=256):
+        """
+        The `k` nearest songs to each of a lot of songs in the index, for batch jobs. Rather than a tree query per song,
+        each chunk of songs has its distances to the whole library worked out at once with a matrix product, which is
+        much faster per song, and memory is bounded by about ``16 * chunk_size * len(self)`` bytes.
+
+        :param rows: list of int rows of the songs, see :attr:`rows`
+        :param int k: songs per song, counting itself.
+        :param int chunk_size: songs per chunk.
+        :return: generator of (rows of the chunk, (chunk, k) distances, (chunk, k) rows), nearest first.
+        """
+        k = min(k, len(self))
+        rows = np.asarray(rows, dtype=int)
+        songs = self.matrix.astype(np.float64)
+        norms = np.einsum('ij,ij->i', songs, songs)
+        for st in range(0, len(rows), chunk_size):
+            chunk = rows[st:st + chunk_size]
+            with instrument.span('playlists.search', songs=len(chunk)):
+                squared = songs[chunk] @ songs.T
+                squared *= -2
+                squared += norms[None, :]
+                squared += norms[chunk, None]
+                nearest = np.argpartition(squared, k - 1, axis=1)[:, :k] if k < len(self) else \
+                    np.tile(np.arange(len(self)), (len(chunk), 1))
+                distances = np.sqrt(np.clip(np.take_along_axis(squared, nearest, axis=1), 0, None))
+                del squared
+                order = np.lexsort((nearest, distances), axis=1)
+            yield chunk, np.take_along_axis(distances, order, axis=1), np.take_along_axis(nearest, order, axis=1)
+
+    def query(self, tag, length=5):
+        """
+        The songs nearest to a seed song, starting with the seed itself.
+
+        :param str tag: the seed song
+        :param int length: how many songs
+        :return: pd.Series of distances from the seed, indexed by tag, nearest first.
+        """
+        distances, rows = self.query_points(self.vector(tag), k=length)
+        return pd.Series(distances[0], index=[self.tags[row] for row in rows[0]], name=tag)
+
+    def save(self, loc):
+        """
+        Pickles the index with ``library.dump_atomic``, so an interrupted save leaves the old index intact.
+
+        :param str loc: file location, see ``index_location``
+        :return: NoneType
+        """
+        dump_atomic(self, loc)
+
+    @staticmethod
+    def load(loc):
+        """
+        :param str loc: file location
+        :return: ManifoldIndex
+        """
+        with open(loc, 'rb') as file:
+            return pickle.load(file)
+
+    @classmethod
+    def cached(cls, manifold_df, manifold_loc='manifold.pkl', **kwargs):
+        """
+        The index for a manifold, loaded from next to the manifold's pickle if it was saved there and the manifold
+        hasn't changed since, otherwise built and saved there.
+
+        :param pd.DataFrame manifold_df: manifold data frame
+        :param str manifold_loc: where the manifold is pickled
+        :param kwargs: passed on to ``ManifoldIndex`` if it has to be built.
+        :return: ManifoldIndex
+        """
+        loc = index_location(manifold_loc)
+        if os.path.exists(loc):
+            index = cls.load(loc)
+            if index.fingerprint == manifold_fingerprint(manifold_df):
+                return index
+        index = cls(manifold_df, **kwargs)
+        index.save(loc)
+        return index
+
+
+def index_location(manifold_loc='manifold.pkl'):
+    """
+    Where the ``ManifoldIndex`` of a pickled manifold is kept, next to it. 'manifold.pkl' gets 'manifold.index.pkl'.
+
+    :param str manifold_loc: where the manifold is pickled
+    :return: str
+    """
+    root, ext = os.path.splitext(manifold_loc)
+    return f'{root}.index{ext or ".pkl"}'
+
+
+def abs_dist_playlist(tag, manifold_df, length=5, metrics=False, index=None):
     """
     Takes in two song tags, and the manifold data frame, and creates a playlist of the input song, and the length
     nearest neighbors, in order of distance from the input song.
 
+    This is a query of a ``ManifoldIndex``. Pass one in as `index` when making more than one playlist from the same
+    manifold, or get one with ``ManifoldIndex.cached``, otherwise one gets built for this playlist.
+
     :param str tag: The starting song
     :param pd.DataFrame manifold_df: manifold data frame
     :param int length: desired length of playlist
     :param bool metrics: Toggles printing the playlist to the console.
+    :param index: ManifoldIndex or NoneType
     :return:
     """
-    dist_mat = pd.DataFrame(squareform(pdist(manifold_df.transpose())),
-                            columns=manifold_df.transpose().index,
-                            index=manifold_df.transpose().index)
+    if index is None:
+        index = ManifoldIndex(manifold_df)
+    nearest = index.query(tag, length)
     if metrics:
-        print(dist_mat[tag].nsmallest(length))
-    return list(dist_mat[tag].nsmallest(length).index)
+        print(nearest)
+    return list(nearest.index)
 
 
-def make_dist_playlist(tag, manifold_df, length=5, verbose=False, locale='playlists\\'):
-    plist = abs_dist_playlist(tag, manifold_df, length=length)
+def make_dist_playlist(tag, manifold_df, length=5, verbose=False, locale='playlists\\', index=None):
+    plist = abs_dist_playlist(tag, manifold_df, length=length, index=index)
     if verbose:
         print(*plist, sep='\n')
-    generate_m3u(plist, f"{tag.split(' - ')[-1]}_circle{length}", locale=locale, reference=load_tag_dict())
+    with load_tag_dict() as reference:
+        generate_m3u(plist, f"{tag.split(' - ')[-1]}_circle{length}", reference, locale=locale)
+
+
+def circle_title(seed, length, taken):
+    """
+    The name of a seed's distance playlist, which is ``make_dist_playlist``'s, the song's title, unless another seed
+    already has it, e.g. a song of the same name on another album. Then the album goes in front, then the artist, then
+    a number, so no two seeds ever write to the same file.
+
+    :param str seed: tag
+    :param int length: playlist length
+    :param set taken: the names handed out so far, in lower case, since Windows doesn't tell them apart by case. The
+    new name is added to it.
+    :return: str
+    """
+    parts = seed.replace('\\', '').split(' - ')
+    for n in range(1, len(parts) + 1):
+        title = f"{' - '.join(parts[-n:])}_circle{length}"
+        if title.lower() not in taken:
+            break
+    else:
+        base, n = title, 2
+        while title.lower() in taken:
+            title = f'{base} ({n})'
+            n += 1
+    taken.add(title.lower())
+    return title
+
+
+def dist_playlists(seeds, index, length=5, chunk_size=256):
+    """
+    ``abs_dist_playlist`` for a lot of seed songs at once, see ``ManifoldIndex.query_rows``.
+
+    :param list seeds: seed song tags
+    :param ManifoldIndex index: the index of the manifold
+    :param int length: desired length of each playlist
+    :param int chunk_size: seeds to work on at once.
+    :return: generator of (seed, playlist)
+    """
+    for chunk, _, nearest in index.query_rows([index.rows[tag] for tag in seeds], k=length, chunk_size=chunk_size):
+        for row, plist in zip(chunk, nearest):
+            yield index.tags[row], [index.tags[i] for i in plist]
+
+
+def make_dist_playlists(manifold_df=None, seeds=None, length=5, index=None, verbose=False, locale='playlists\\',
+                        reference=None, chunk_size=256, writers=8):
+    """
+    ``make_dist_playlist`` for a lot of seed songs at once, say every song in the library for a nightly batch of radio
+    playlists. The tag dictionary is only opened once, the neighbours are found a chunk of seeds at a time (see
+    ``ManifoldIndex.query_rows``), and the playlists of each chunk are written by a pool of `writers` threads while the
+    next chunk is worked out. Memory is bounded by `chunk_size`, not the number of seeds, bar the names of the
+    playlists, which come from ``circle_title`` so that two seeds with the same title don't write to the same file.
+
+    :param pd.DataFrame manifold_df: manifold data frame, not needed if `index` is given.
+    :param seeds: list of seed song tags or NoneType for every song in the manifold.
+    :param int length: desired length of each playlist
+    :param index: ManifoldIndex or NoneType
+    :param bool verbose: print each seed as its playlist is written.
+    :param str locale: the folder to dump playlists in.
+    :param reference: dict, LocationStore or NoneType tag dictionary, default is ``load_tag_dict()``
+    :param int chunk_size: seeds to work on at once.
+    :param int writers: threads writing playlists.
+    :return: int how many playlists were written.
+    """
+    if index is None:
+        index = ManifoldIndex(manifold_df)
+    if seeds is None:
+        seeds = index.tags
+    written = 0
+    taken = set()
+    # A tag dictionary opened here is closed again once the writers are done with it.
+    with (load_tag_dict() if reference is None else nullcontext(reference)) as reference, \
+            ThreadPoolExecutor(writers) as pool:
+        pending = []
+        batch = []
+        for seed, plist in dist_playlists(seeds, index, length=length, chunk_size=chunk_size):
+            batch.append((seed, plist))
+            if len(batch) == chunk_size:
+                # Only one chunk of playlists waits to be written at a time, so memory doesn't grow with the seeds.
+                # Collecting each result also raises whatever went wrong writing the last chunk.
+                for future in pending:
+                    future.result()
+                    written += 1
+                pending = [pool.submit(generate_m3u, plist, circle_title(seed, length, taken), reference, locale)
+                           for seed, plist in batch]
+                batch = []
+            if verbose:
+                print(seed)
+        pending += [pool.submit(generate_m3u, plist, circle_title(seed, length, taken), reference, locale)
+                    for seed, plist in batch]
+        for future in pending:
+            future.result()
+            written += 1
+    return written
+
+
+@instrument.timed('playlists.distance')
+def segment_geometry(manifold_df, taga, tagb, chunk_size=65536):
+    """
+    Where every song sits relative to the segment from song a to song b, worked out exactly in one pass over the
+    manifold, `chunk_size` songs at a time. For a song s, u is where along the line from a to b its projection falls,
+    0 at a and 1 at b (it's not clipped, so songs beyond the ends have u < 0 or u > 1), and the squared perpendicular
+    distance is how far it is from the line. The squared distance from s to the point of the line at t is then
+    ``perp_sq + length_sq * (u - t) ** 2``, which is all that's needed to answer every question the playlists ask
+    about the segment, without sampling it.
+
+    :param pd.DataFrame manifold_df: manifold data frame
+    :param str taga: song a
+    :param str tagb: song b
+    :param int chunk_size: songs to work on at once.
+    :return: tuple (u, perp_sq, length_sq) with u and perp_sq np.arrays in the same order as the manifold's columns.
+    """
+    songs = manifold_df.values
+    a = manifold_df[taga].values.astype(np.float64)
+    diff = manifold_df[tagb].values.astype(np.float64) - a
+    length_sq = float(diff @ diff)
+    u = np.empty(songs.shape[1])
+    perp_sq = np.empty(songs.shape[1])
+    for st in range(0, songs.shape[1], chunk_size):
+        block = songs[:, st:st + chunk_size].astype(np.float64) - a[:, None]
+        along = diff @ block / length_sq if length_sq else np.zeros(block.shape[1])
+        block -= diff[:, None] * along[None, :]
+        u[st:st + chunk_size] = along
+        perp_sq[st:st + chunk_size] = np.einsum('ij,ij->j', block, block)
+    # The ends are exactly where they are, whatever order the sums above were done in.
+    u[manifold_df.columns.get_loc(taga)], perp_sq[manifold_df.columns.get_loc(taga)] = 0, 0
+    u[manifold_df.columns.get_loc(tagb)], perp_sq[manifold_df.columns.get_loc(tagb)] = 1 if length_sq else 0, 0
+    return u, perp_sq, length_sq
+
+
+def segment_distances(manifold_df, taga, tagb, line_res=100, exact=False):
+    """
+    How far every song is from the segment from a to b, and which of `line_res` evenly spaced slots along it the song
+    is nearest. By default the distance is to that slot's point, which is exactly what sampling the segment at
+    `line_res` points and taking the nearest gives. With `exact` it's the true distance to the segment, which is what
+    that converges to as `line_res` goes up. See ``segment_geometry``.
+
+    :param pd.DataFrame manifold_df: manifold data frame
+    :param str taga: song a
+    :param str tagb: song b
+    :param int line_res: how many slots.
+    :param bool exact: distance to the segment rather than to the nearest slot.
+    :return: tuple (pd.Series of distances, pd.Series of slots) indexed by tag.
+    """
+    u, perp_sq, length_sq = segment_geometry(manifold_df, taga, tagb)
+    slot = np.clip(np.rint(u * (line_res - 1)), 0, line_res - 1).astype(int)
+    nearest = np.clip(u, 0, 1) if exact else slot / (line_res - 1)
+    ldist = np.sqrt(perp_sq + length_sq * (u - nearest) ** 2)
+    return pd.Series(ldist, index=manifold_df.columns), pd.Series(slot, index=manifold_df.columns)
+
 
+def lower_envelope(vertices, offsets, curvature, lo=0., hi=1.):
+    """
+    Which of the parabolas ``curvature * (t - vertex) ** 2 + offset`` is lowest somewhere between `lo` and `hi`, in the
+    order they're lowest in. They all have the same curvature, so each one is lowest over at most one interval, and
+    sweeping them in order of their vertices finds those intervals in O(n) (after sorting), like Felzenszwalb and
+    Huttenlocher's distance transform.
+
+    :param np.array vertices:
+    :param np.array offsets:
+    :param float curvature:
+    :param float lo:
+    :param float hi:
+    :return: list of int positions in `vertices`
+    """
+    if not curvature:
+        return [int(np.argmin(offsets))]
+    heights = offsets + curvature * vertices ** 2
+    hull = []
+    starts = []
+    for j in np.lexsort((offsets, vertices)):
+        if hull and vertices[hull[-1]] == vertices[j]:
+            continue
+        start = -np.inf
+        while hull:
+            k = hull[-1]
+            start = (heights[j] - heights[k]) / (2 * curvature * (vertices[j] - vertices[k]))
+            if start > starts[-1]:
+                break
+            hull.pop()
+            starts.pop()
+            start = -np.inf
+        hull.append(j)
+        starts.append(start)
+    ends = starts[1:] + [np.inf]
+    return [int(j) for j, start, end in zip(hull, starts, ends) if end >= lo and start <= hi]
+
+
+def line_playlist(taga, tagb, manifold_df, line_res=100, metrics=False, exact=False):
+    """
+    The songs nearest to the segment from a to b, in order along it. Each of `line_res` evenly spaced points of the
+    segment picks its nearest song, or with `exact`, every song that's nearest to some point of the segment is picked.
 
-def line_playlist(taga, tagb, manifold_df, line_res=100, metrics=False):
+    Only songs within half the length of the segment of it can be nearest to any of it, since a and b themselves are
+    never further than that, so the rest are ruled out before anything is compared.
+
+    :param str taga: song a
+    :param str tagb: song b
+    :param pd.DataFrame manifold_df: manifold data frame
+    :param int line_res: how many points of the segment.
+    :param bool metrics: print how long each step took.
+    :param bool exact: use the whole segment rather than `line_res` points of it.
+    :return: np.array of tags
+    """
     st = time()
-    a = manifold_df[taga].values
-    b = manifold_df[tagb].values
-    x = np.linspace(a, b, num=line_res)  # Uhh, just put in a big number
+    u, perp_sq, length_sq = segment_geometry(manifold_df, taga, tagb)
     space_made = time()
-    d = pd.DataFrame(cdist(x, manifold_df.transpose()), columns=manifold_df.columns)
+    with instrument.span('playlists.search', exact=exact):
+        reach = perp_sq + length_sq * (u - np.clip(u, 0, 1)) ** 2
+        near = np.flatnonzero(reach <= length_sq / 4 * (1 + 1e-9))
+        if exact:
+            mins = near[lower_envelope(u[near], perp_sq[near], length_sq)]
+        else:
+            t = np.linspace(0, 1, num=line_res)
+            mins = near[np.argmin(perp_sq[near][None, :] + length_sq * (u[near][None, :] - t[:, None]) ** 2,
+                                  axis=1)]
     distances_calcd = time()
-    min_list = d.transpose().idxmin()
-    mins = pd.unique(min_list)
+    mins = pd.unique(manifold_df.columns[mins])
     plist_found = time()
     if metrics:
-        print(f'{space_made - st:.3} seconds to generate line.')
+        print(f'{space_made - st:.3} seconds to project the songs onto the line.')
         print(f'{distances_calcd - space_made:.3} seconds to calculate distances from the line.')
         print(f'{plist_found - distances_calcd:.3} seconds to find a playlist.')
     return mins
 
 
-def make_line_playlist(taga, tagb, manifold_df, verbose=True, line_res=100, locale='playlists\\'):
-    plist = line_playlist(taga, tagb, manifold_df, line_res=line_res)
+def make_line_playlist(taga, tagb, manifold_df, verbose=True, line_res=100, locale='playlists\\', exact=False):
+    plist = line_playlist(taga, tagb, manifold_df, line_res=line_res, exact=exact)
     if verbose:
         print(*plist, sep='\n')
-    generate_m3u(plist, f"{taga.split(' - ')[-1]} to {tagb.split(' - ')[-1]}", locale=locale, reference=load_tag_dict())
-
-
-def cone_plist(taga, tagb, manifold_df, line_res=100, min_len=15, metrics=False, resolution=1):
-    a, b, x, d, ldist, perpdist = space_maker(line_res, manifold_df, taga, tagb)
-
-    def make_list(_r=1):
-        if metrics:
-            print(f'Trying cone of size {_r}')
-        cone_edge = np.pad(np.linspace(0, _r, num=line_res // 2),
-                           (0, (line_res // 2)), 'symmetric')
-        songlist = {}
-        for i in range(len(cone_edge)):
-            q_songs = list(ldist[perpdist == i][ldist <= cone_edge[i]].index)
-            for s in q_songs:
-                songlist[s] = 0
-        plist = list(songlist.keys())
-        if _r > euclidean(a, b):
-            return plist
-        elif len(plist) < min_len:
-            return make_list(_r=_r + resolution)
-        else:
-            return plist
+    with load_tag_dict() as reference:
+        generate_m3u(plist, f"{taga.split(' - ')[-1]} to {tagb.split(' - ')[-1]}", reference, locale=locale)
 
-    return make_list()
 
+@instrument.timed('playlists.search')
+def shape_plist(ldist, perpdist, edge, limit, min_len=15, resolution=1, continuous=False, stops=(), metrics=False,
+                name='cone'):
+    """
+    Finds the smallest shape around the segment with at least `min_len` songs in it, for ``cone_plist`` and friends.
+    The shape's edge is ``edge(r)``, how far from the segment each slot reaches for a shape of size r, and it has to
+    scale with r, so dividing each song's distance by ``edge(1)`` at its slot says how big the shape has to be to take
+    it in. The size needed for `min_len` songs is then just the `min_len`-th smallest of those, rather than something
+    to search for by trying bigger and bigger shapes.
+
+    By default the size is the first of 1, 1 + `resolution`, 1 + 2 * `resolution`, ... that's big enough, and the size
+    gives up at the first of those bigger than the segment is long, which is the size the old search, trying each of
+    those in turn, would have stopped at. With `continuous` the size is exactly the smallest that's big enough, up to
+    the length of the segment.
+
+    :param pd.Series ldist: each song's distance from the segment, see ``segment_distances``
+    :param pd.Series perpdist: each song's slot
+    :param edge: function of the size, giving an np.array with the reach of each slot.
+    :param float limit: the length of the segment
+    :param int min_len: the fewest songs to find
+    :param float resolution: step between sizes
+    :param bool continuous: don't round the size up to a step.
+    :param stops: tags of songs which, in their own slot, end the playlist, so songs that come after them in the
+    manifold's column order are left out.
+    :param bool metrics: print the size.
+    :param str name: what to call the shape when printing it.
+    :return: list of tags, in order along the segment.
+    """
+    dist = ldist.values
+    slot = perpdist.values
+    position = np.arange(len(dist))
+    left_out = np.zeros(len(dist), dtype=bool)
+    for tag in stops:
+        stop = ldist.index.get_loc(tag)
+        left_out |= (slot == slot[stop]) & (position > stop)
+
+    reach = edge(1)[slot]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        needed = np.where(dist == 0, 0, dist / reach)
+    needed = needed[~left_out]
+    kth = np.partition(needed, min_len - 1)[min_len - 1] if 0 < min_len <= len(needed) else \
+        (0 if min_len <= 0 else np.inf)
+
+    if continuous:
+        size = min(kth, limit)
+    else:
+        steps = np.inf if not np.isfinite(kth) else max(0, int(np.ceil((kth - 1) / resolution)))
+        last = 0 if limit < 1 else int(np.floor((limit - 1) / resolution)) + 1
+        size = 1 + min(steps, last) * resolution
+    if metrics:
+        print(f'Using {name} of size {size}')
 
-def make_cone_plist(taga, tagb, manifold_df, verbose=True, line_res=100,
-                    locale='playlists\\', min_len=15, resolution=1):
-    plist = cone_plist(taga, tagb, manifold_df,
-                       min_len=min_len, line_res=line_res, resolution=resolution)
-    if verbose:
-        print(*plist, sep='\n')
-    generate_m3u(plist, f"{taga.split(' - ')[-1]} to {tagb.split(' - ')[-1]} Cone", locale=locale)
+    inside = np.flatnonzero((dist <= edge(size)[slot]) & ~left_out)
+    inside = inside[np.argsort(slot[inside], kind='stable')]
+    return list(ldist.index[inside])
 
 
-def cyl_plist(taga, tagb, manifold_df, line_res=100, min_len=15, metrics=False, resolution=1):
-    a, b, x, d, ldist, perpdist = space_maker(line_res, manifold_df, taga, tagb)
+def cone_plist(taga, tagb, manifold_df, line_res=100, min_len=15, metrics=False, resolution=1, exact=False,
+               continuous=False):
+    """
+    The songs within a cone around the segment from a to b, which is widest half way along, and as narrow as it can
+    be while holding `min_len` songs. See ``shape_plist`` for `resolution` and `continuous`.
+    """
+    a, b, x, ldist, perpdist = space_maker(line_res, manifold_df, taga, tagb, exact=exact)
+    return shape_plist(ldist, perpdist, lambda r: np.pad(np.linspace(0, r, num=line_res // 2),
+                                                         (0, (line_res // 2)), 'symmetric'),
+                       euclidean(a, b), min_len=min_len, resolution=resolution, continuous=continuous,
+                       metrics=metrics, name='cone')
 
-    def make_list(_r=1):
-        if metrics:
-            print(f'Trying cylinder of size {_r}')
 
-        songlist = {}
-        for i in range(len(x)):
-            q_songs = list(ldist[perpdist == i][ldist <= _r].index)
-            for s in q_songs:
-                songlist[s] = 0
-                if s == tagb or s == taga:
-                    break
+def make_cone_plist(taga, tagb, manifold_df, verbose=True, line_res=100,
+                    locale='playlists\\', min_len=15, resolution=1, exact=False, continuous=False):
+    plist = cone_plist(taga, tagb, manifold_df,
+                       min_len=min_len, line_res=line_res, resolution=resolution, exact=exact, continuous=continuous)
+    if verbose:
+        print(*plist, sep='\n')
+    with load_tag_dict() as reference:
+        generate_m3u(plist, f"{taga.split(' - ')[-1]} to {tagb.split(' - ')[-1]} Cone", reference, locale=locale)
 
-        plist = list(songlist.keys())
-        if _r > euclidean(a, b):
-            return plist
-        elif len(plist) < min_len:
-            return make_list(_r=_r + resolution)
-        else:
-            return plist
 
-    return make_list()
+def cyl_plist(taga, tagb, manifold_df, line_res=100, min_len=15, metrics=False, resolution=1, exact=False,
+              continuous=False):
+    """
+    The songs within a cylinder around the segment from a to b, as narrow as it can be while holding `min_len` songs.
+    See ``shape_plist`` for `resolution` and `continuous`.
+    """
+    a, b, x, ldist, perpdist = space_maker(line_res, manifold_df, taga, tagb, exact=exact)
+    return shape_plist(ldist, perpdist, lambda r: np.full(len(x), r), euclidean(a, b), min_len=min_len,
+                       resolution=resolution, continuous=continuous, stops=(taga, tagb), metrics=metrics,
+                       name='cylinder')
 
 
-def space_maker(line_res, manifold_df, taga, tagb):
+def space_maker(line_res, manifold_df, taga, tagb, exact=False):
+    """
+    Sets up the segment for the cone and cylinder playlists. See ``segment_distances`` for ldist and perpdist, which
+    are each song's distance from the segment, and the slot along it that the song is nearest.
+    """
     if line_res % 2:
         raise ValueError('line_res must be even.')
     a = manifold_df[taga].values
     b = manifold_df[tagb].values
     x = np.linspace(a, b, num=line_res)
-    d = pd.DataFrame(cdist(x, manifold_df.transpose()), columns=manifold_df.columns)
-    ldist = d.min()
-    perpdist = d.idxmin()
-    return a, b, x, d, ldist, perpdist
+    ldist, perpdist = segment_distances(manifold_df, taga, tagb, line_res=line_res, exact=exact)
+    return a, b, x, ldist, perpdist
 
 
 def make_cyl_plist(taga, tagb, manifold_df, verbose=True, line_res=100,
-                   locale='playlists\\', min_len=15, resolution=1):
+                   locale='playlists\\', min_len=15, resolution=1, exact=False, continuous=False):
     plist = cyl_plist(taga, tagb, manifold_df,
-                      min_len=min_len, line_res=line_res, resolution=resolution)
+                      min_len=min_len, line_res=line_res, resolution=resolution, exact=exact, continuous=continuous)
     if verbose:
         print(*plist, sep='\n')
-    generate_m3u(plist, f"{taga.split(' - ')[-1]} to {tagb.split(' - ')[-1]} Cylinder", locale=locale)
-
-
-def icone_plist(taga, tagb, manifold_df, line_res=100, min_len=15, metrics=False, resolution=1):
-    a, b, x, d, ldist, perpdist = space_maker(line_res, manifold_df, taga, tagb)
-
-    def make_list(_r=1):
-        if metrics:
-            print(f'Trying cone of size {_r}')
-        cone_edge = np.pad(np.linspace(_r, 0, num=line_res // 2),
-                           (0, (line_res // 2)), 'symmetric')
-        songlist = {}
-        for i in range(len(cone_edge)):
-            q_songs = list(ldist[perpdist == i][ldist <= cone_edge[i]].index)
-            for s in q_songs:
-                songlist[s] = 0
-                if s == tagb:
-                    break
-        plist = list(songlist.keys())
-        if _r > euclidean(a, b):
-            return plist
-        elif len(plist) < min_len:
-            return make_list(_r=_r + resolution)
-        else:
-            return plist
+    with load_tag_dict() as reference:
+        generate_m3u(plist, f"{taga.split(' - ')[-1]} to {tagb.split(' - ')[-1]} Cylinder", reference, locale=locale)
+
 
-    return make_list()
+def icone_plist(taga, tagb, manifold_df, line_res=100, min_len=15, metrics=False, resolution=1, exact=False,
+                continuous=False):
+    """
+    The songs within an inverse cone around the segment from a to b, which is widest at the ends and pinches shut
+    half way along, and as narrow as it can be while holding `min_len` songs. See ``shape_plist`` for `resolution` and
+    `continuous`.
+    """
+    a, b, x, ldist, perpdist = space_maker(line_res, manifold_df, taga, tagb, exact=exact)
+    return shape_plist(ldist, perpdist, lambda r: np.pad(np.linspace(r, 0, num=line_res // 2),
+                                                         (0, (line_res // 2)), 'symmetric'),
+                       euclidean(a, b), min_len=min_len, resolution=resolution, continuous=continuous,
+                       stops=(tagb,), metrics=metrics, name='cone')
 
 
 def make_icone_plist(taga, tagb, manifold_df, verbose=True, line_res=100,
-                     locale='playlists\\', min_len=15, resolution=1):
+                     locale='playlists\\', min_len=15, resolution=1, exact=False, continuous=False):
     plist = icone_plist(taga, tagb, manifold_df,
-                        min_len=min_len, line_res=line_res, resolution=resolution)
+                        min_len=min_len, line_res=line_res, resolution=resolution, exact=exact, continuous=continuous)
     if verbose:
         print(*plist, sep='\n')
-    generate_m3u(plist, f"{taga.split(' - ')[-1]} to {tagb.split(' - ')[-1]} Inverse Cone", locale=locale)
+    title = f"{taga.split(' - ')[-1]} to {tagb.split(' - ')[-1]} Inverse Cone"
+    with load_tag_dict() as reference:
+        generate_m3u(plist, title, reference, locale=locale)
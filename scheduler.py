@@ -0,0 +1,197 @@
+import multiprocessing as mp
+import os
+import signal
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def limited_call(fn, job, limit=None):
+    """
+    Runs fn(job) in a worker, with its address space capped at `limit` bytes more than it's using already. Going over
+    raises a MemoryError inside the worker rather than dragging the whole machine into swap. The cap is lifted again
+    afterwards, so the next task in the same worker starts fresh. Does nothing special on systems without ``resource``.
+
+
+    :param fn: the task function
+
+    :param job: its argument
+
+    :param limit: int or NoneType bytes
+
+    :return: whatever fn returns
+    """
+    if limit is None or resource is None:
+        return fn(job)
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    try:
+        with open('/proc/self/statm') as file:
+            in_use = int(file.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        in_use = 0
+    cap = in_use + limit
+    if hard != resource.RLIM_INFINITY:
+        cap = min(cap, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (cap, hard))
+    try:
+        return fn(job)
+    finally:
+        resource.setrlimit(resource.RLIMIT_AS, (soft, hard))
+
+
+# Where each worker says which job it has started, so the scheduler can tell which one was running in a worker that was
+# killed. It's set in the workers by _init_worker.
+_started = None
+
+
+def _init_worker(started):
+    global _started
+    _started = started
+
+
+def tracked_call(i, fn, job, limit=None):
+    """
+    ``limited_call``, after telling the scheduler that job `i` is running in this worker process.
+    """
+    if _started is not None:
+        _started.put((i, os.getpid()))
+    return limited_call(fn, job, limit)
+
+
+def _read_started(started, pids):
+    while not started.empty():
+        i, pid = started.get()
+        pids[i] = pid
+
+
+class MemoryScheduler:
+    """
+    A process pool that hands out work against a memory budget instead of a fixed number of slots. Each job comes with
+    an estimate of how much memory it'll need, and a job is only started if the estimates of everything running, plus
+    its own, fit in the budget. Short songs can then run as many at a time as there are workers, and a job that's too
+    big to fit alongside anything else waits for the pool to empty and runs on its own.
+
+    If a job runs out of memory, either by going over `worker_limit` or by getting its worker killed, it's put back at
+    the front of the queue to be retried alone, with no limit, up to `retries` times. After that its result is None.
+    A killed worker takes the rest of the pool down with it, but only the job that was running in the killed worker is
+    charged a retry. The others go back in the queue as they were.
+
+    :param int budget: bytes of RAM the jobs are allowed to use between them.
+
+    :param int workers: the most jobs to run at once. Default is the number of CPUs.
+
+    :param worker_limit: int or NoneType bytes any one job may use while sharing the pool.
+
+    :param int retries: how many times to retry a job alone after it runs out of memory.
+    """
+
+    def __init__(self, budget, workers=None, worker_limit=None, retries=1):
+        self.budget = budget
+        self.workers = workers or os.cpu_count()
+        self.worker_limit = worker_limit
+        self.retries = retries
+
+    def imap_unordered(self, fn, jobs, estimate):
+        """
+        Runs fn over jobs, yielding results as they finish. Jobs are only pulled from `jobs` when there's room to start
+        them, so it can be a generator that's still producing them.
+
+        :param fn: a picklable, module level function of one argument.
+
+        :param jobs: iterable of its arguments
+
+        :param estimate: function giving the bytes a job is expected to need.
+
+        :return: generator of (index into jobs, result)
+        """
+        source = enumerate(jobs)
+        args = {}
+        queue = deque()
+        running = {}
+        started = mp.SimpleQueue()
+        # The worker process of each job that's started, as far as the workers have said.
+        pids = {}
+        pool = ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(started,))
+        try:
+            while True:
+                in_use = sum(est for _, est, _, _ in running.values())
+                alone = any(solo for _, _, solo, _ in running.values())
+                while len(running) < self.workers and not alone:
+                    if not queue:
+                        i, job = next(source, (None, None))
+                        if i is None:
+                            break
+                        args[i] = job
+                        queue.append((i, estimate(job), False, 0))
+                    i, est, solo, tries = queue[0]
+                    if running and (solo or in_use + est > self.budget):
+                        break
+                    queue.popleft()
+                    limit = None if solo else self.worker_limit
+                    running[pool.submit(tracked_call, i, fn, args[i], limit)] = (i, est, solo, tries)
+                    in_use += est
+                    alone = solo
+
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                # Read every time, so the pipe never fills up and blocks the workers.
+                _read_started(started, pids)
+                broken = any(isinstance(future.exception(), BrokenProcessPool) for future in finished)
+                culprits = None
+                if broken:
+                    # Every job in the pool fails with it, so they're all dealt with now.
+                    wait(running)
+                    finished = list(running)
+                    _read_started(started, pids)
+                    culprits = self._killed(pool, pids, [i for i, _, _, _ in running.values()])
+                for future in finished:
+                    i, est, solo, tries = running.pop(future)
+                    pids.pop(i, None)
+                    err = future.exception()
+                    if isinstance(err, BrokenProcessPool) and i not in culprits:
+                        # It didn't do anything wrong, so it goes back in the queue as it was.
+                        queue.appendleft((i, est, solo, tries))
+                        continue
+                    if isinstance(err, (MemoryError, BrokenProcessPool)):
+                        if tries < self.retries:
+                            queue.appendleft((i, est, True, tries + 1))
+                            continue
+                        result = None
+                    else:
+                        result = future.result()
+                    del args[i]
+                    yield i, result
+
+                if broken:
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    pool = ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(started,))
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def _killed(pool, pids, jobs):
+        """
+        Which of the jobs that were running when the pool broke was running in the worker that was killed. The broken
+        pool terminates the rest of its workers itself, so the killed one is the one that didn't exit that way. If that
+        can't be told, all of them are.
+
+        :param pool: the broken ProcessPoolExecutor
+        :param dict pids: the worker process of each job that's started.
+        :param jobs: list of the indexes of the jobs that were running.
+        :return: set of job indexes
+        """
+        # The pool's own thread reaps the workers as it terminates them, and an exitcode read while it's doing that can
+        # come back None, so it's left to finish first.
+        manager = getattr(pool, '_executor_manager_thread', None)
+        if manager is not None:
+            manager.join(5)
+        dead = {pid for pid, process in (pool._processes or {}).items()
+                if process.exitcode not in (None, 0, -signal.SIGTERM)}
+        culprits = {i for i in jobs if pids.get(i) in dead}
+        return culprits or set(jobs)
@@ -0,0 +1,369 @@
+"""
+A long running playlist server, so a front end doesn't have to unpickle the manifold and the tag dictionary for every
+playlist. Everything is loaded once (the tag dictionary is a ``locations.LocationStore``, so only the songs in a
+playlist are looked up), and every playlist in ``playlists`` is served over HTTP, on a TCP port or a unix
+socket, as JSON or as an m3u:
+
+    python server.py --manifold manifold.pkl --port 8765
+
+    GET /dist?tag=...&length=5
+    GET /line?a=...&b=...&line_res=100&exact=1
+    GET /cone?a=...&b=...&min_len=15&format=m3u
+    GET /cyl?...
+    GET /icone?...
+    GET /tags
+    GET /stats
+
+Results are kept in a least recently used cache, keyed by the query and the version of the manifold, so repeated
+playlists cost a dictionary lookup. If the manifold's pickle changes on disk it's loaded again, and the old results
+stop being served. ``benchmarks/bench_server.py`` measures how many requests a second it keeps up with.
+"""
+import argparse
+import asyncio
+import json
+import os
+import pickle
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlsplit
+
+import playlists
+from learning import ManifoldModel, load_tag_dict
+from locations import LocationStore
+
+QUERIES = {
+    'dist': {'tag': str, 'length': int},
+    'line': {'a': str, 'b': str, 'line_res': int, 'exact': bool},
+    'cone': {'a': str, 'b': str, 'line_res': int, 'min_len': int, 'resolution': float, 'exact': bool,
+             'continuous': bool},
+    'cyl': {'a': str, 'b': str, 'line_res': int, 'min_len': int, 'resolution': float, 'exact': bool,
+            'continuous': bool},
+    'icone': {'a': str, 'b': str, 'line_res': int, 'min_len': int, 'resolution': float, 'exact': bool,
+              'continuous': bool},
+}
+
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+class QueryError(Exception):
+    """
+    A request that can't be answered, with the HTTP status to answer it with.
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_value(kind, value):
+    """
+    Turns a query string value into the type the playlist function wants.
+
+    :param kind: type
+    :param str value:
+    :return: the value
+    """
+    if kind is bool:
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return kind(value)
+
+
+class PlaylistServer:
+    """
+    Holds everything the playlists need, and answers queries from a cache when it can.
+
+    :param str manifold_loc: where the manifold is pickled, either as the data frame or as a ``learning.ManifoldModel``
+    :param tags_loc: str or NoneType where the tag dictionary is, a ``locations.LocationStore`` or an old pickle.
+    Default is ``learning.load_tag_dict``'s.
+    :param int cache_size: how many playlists to remember.
+    :param int workers: threads working out playlists, so a slow one doesn't hold up the rest.
+    """
+
+    def __init__(self, manifold_loc='manifold.pkl', tags_loc=None, cache_size=4096, workers=4):
+        self.manifold_loc = manifold_loc
+        self.tags_loc = tags_loc
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.requests = 0
+        self.pool = ThreadPoolExecutor(workers)
+        self.mtime = None
+        self.reference = None
+        # How many lookups are running in each tag dictionary, by id, so an old one is only closed once they're done.
+        self.lookups = {}
+        self.reloading = False
+        self.load()
+
+    def read(self):
+        """
+        Loads the manifold, its ``playlists.ManifoldIndex`` and the tag dictionary, without touching what's being
+        served.
+
+        :return: tuple (modification time of the pickle, manifold data frame, index, tag dictionary)
+        """
+        mtime = os.stat(self.manifold_loc).st_mtime_ns
+        with open(self.manifold_loc, 'rb') as file:
+            manifold = pickle.load(file)
+        manifold_df = manifold.frame if isinstance(manifold, ManifoldModel) else manifold
+        index = playlists.ManifoldIndex.cached(manifold_df, self.manifold_loc)
+        reference = load_tag_dict() if self.tags_loc is None else load_tag_dict(self.tags_loc)
+        return mtime, manifold_df, index, reference
+
+    def swap(self, loaded):
+        """
+        Starts serving what ``read`` loaded. It's all assigned in one go, with nothing to wait on in between, so no
+        request on the event loop sees half of the old manifold and half of the new one. The old tag dictionary is
+        closed afterwards, or, if a request is still looking songs up in it, as soon as the last one is done.
+
+        :param tuple loaded:
+        :return: NoneType
+        """
+        old = self.reference
+        self.mtime, self.manifold_df, self.index, self.reference = loaded
+        # The fingerprint, rather than the model's own version, so a plain data frame gets one too.
+        self.version = self.index.fingerprint
+        self.cache.clear()
+        if isinstance(old, LocationStore) and old is not self.reference and not self.lookups.get(id(old)):
+            old.close()
+
+    async def locations(self, plist):
+        """
+        Looks up where a playlist's songs are, on the worker threads, so a slow disk doesn't hold up the event loop.
+
+        :param list plist: tags
+        :return: dict or LocationStore relating tags to file locations.
+        """
+        reference = self.reference
+        if not isinstance(reference, LocationStore):
+            return reference
+        self.lookups[id(reference)] = self.lookups.get(id(reference), 0) + 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.pool, reference.locations, plist)
+        finally:
+            self.lookups[id(reference)] -= 1
+            if not self.lookups[id(reference)]:
+                del self.lookups[id(reference)]
+                if reference is not self.reference:
+                    # It was swapped out while this was looking songs up in it.
+                    reference.close()
+
+    def load(self):
+        """
+        (Re)loads the manifold, its ``playlists.ManifoldIndex`` and the tag dictionary, blocking until it's done.
+
+        :return: NoneType
+        """
+        self.swap(self.read())
+
+    async def refresh(self):
+        """
+        Loads the manifold again if its pickle has changed since it was last loaded. The loading is done on another
+        thread, and the old manifold is served until the new one is ready. If it can't be loaded, e.g. because the
+        pickle is still being written, it's tried again on the next call.
+
+        :return: bool whether it was loaded again.
+        """
+        try:
+            changed = os.stat(self.manifold_loc).st_mtime_ns != self.mtime
+        except OSError:
+            return False
+        if not changed or self.reloading:
+            return False
+        self.reloading = True
+        try:
+            loaded = await asyncio.get_running_loop().run_in_executor(None, self.read)
+        except Exception:
+            return False
+        finally:
+            self.reloading = False
+        self.swap(loaded)
+        return True
+
+    def playlist(self, kind, params, manifold_df=None, index=None):
+        """
+        Works out a playlist, without the cache.
+
+        :param str kind: one of ``QUERIES``
+        :param dict params: its parameters
+        :param manifold_df: pd.DataFrame or NoneType the manifold to use, default is the one being served. ``query``
+        passes the one that was being served when the request came in, in case it's swapped while this runs.
+        :param index: ManifoldIndex or NoneType the index that goes with `manifold_df`.
+        :return: list of tags
+        """
+        if manifold_df is None:
+            manifold_df, index = self.manifold_df, self.index
+        df = manifold_df
+        for key in ('tag', 'a', 'b'):
+            if key in params and params[key] not in index:
+                raise QueryError(404, f'{params[key]} is not in the manifold.')
+        if kind == 'dist':
+            return playlists.abs_dist_playlist(params.pop('tag'), df, index=index, **params)
+        a, b = params.pop('a'), params.pop('b')
+        if kind == 'line':
+            return list(playlists.line_playlist(a, b, df, **params))
+        function = {'cone': playlists.cone_plist, 'cyl': playlists.cyl_plist, 'icone': playlists.icone_plist}[kind]
+        return function(a, b, df, **params)
+
+    async def query(self, kind, params):
+        """
+        A playlist, from the cache if it's there.
+
+        :param str kind: one of ``QUERIES``
+        :param dict params: its parameters, already parsed.
+        :return: tuple (list of tags, whether it came from the cache)
+        """
+        key = (self.version, kind, tuple(sorted(params.items())))
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return self.cache[key], True
+        self.misses += 1
+        loop = asyncio.get_running_loop()
+        try:
+            plist = await loop.run_in_executor(self.pool, self.playlist, kind, dict(params), self.manifold_df,
+                                               self.index)
+        except ValueError as err:
+            # Parameters the playlist can't work with, e.g. an odd line_res.
+            raise QueryError(400, str(err))
+        # If the manifold was swapped in the meantime, this is the old one's, and nothing will ask for it again.
+        if key[0] == self.version:
+            self.cache[key] = plist
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return plist, False
+
+    async def respond(self, target):
+        """
+        Answers one request.
+
+        :param str target: the request's path and query string.
+        :return: tuple (status, content type, body bytes)
+        """
+        url = urlsplit(target)
+        kind = url.path.strip('/')
+        query = dict(parse_qsl(url.query))
+        fmt = query.pop('format', 'json')
+        if kind == 'stats':
+            body = {'version': self.version, 'songs': len(self.index), 'requests': self.requests, 'hits': self.hits,
+                    'misses': self.misses, 'cached': len(self.cache)}
+            return 200, 'application/json', json.dumps(body).encode('utf-8')
+        if kind == 'tags':
+            return 200, 'application/json', json.dumps(self.index.tags).encode('utf-8')
+        if kind not in QUERIES:
+            raise QueryError(404, f'There is no {kind} playlist.')
+        try:
+            params = {key: parse_value(QUERIES[kind][key], value) for key, value in query.items()}
+        except KeyError as err:
+            raise QueryError(400, f'{kind} playlists have no {err.args[0]} parameter.')
+        except ValueError as err:
+            raise QueryError(400, str(err))
+        missing = [key for key in ('tag', 'a', 'b') if key in QUERIES[kind] and key not in params]
+        if missing:
+            raise QueryError(400, f'{kind} playlists need {", ".join(missing)}.')
+
+        plist, cached = await self.query(kind, params)
+        reference = await self.locations(plist)
+        if fmt == 'm3u':
+            body = ''.join(reference.get(tag, tag) + '\n' for tag in plist)
+            return 200, 'audio/x-mpegurl; charset=utf-8', body.encode('utf-8')
+        body = {'playlist': list(plist), 'locations': [reference.get(tag) for tag in plist],
+                'version': self.version, 'cached': cached}
+        return 200, 'application/json', json.dumps(body).encode('utf-8')
+
+    async def handle(self, reader, writer):
+        """
+        Serves one connection, which can send any number of requests, one after the other.
+        """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    method, target, version = line.decode('latin-1').split()
+                except ValueError:
+                    break
+                keep_alive = version == 'HTTP/1.1'
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = header.decode('latin-1').partition(':')
+                    if name.strip().lower() == 'connection':
+                        keep_alive = value.strip().lower() == 'keep-alive' or (
+                            keep_alive and value.strip().lower() != 'close')
+
+                self.requests += 1
+                try:
+                    if method != 'GET':
+                        raise QueryError(405, 'Only GET is supported.')
+                    status, content_type, body = await self.respond(target)
+                except QueryError as err:
+                    status, content_type = err.status, 'application/json'
+                    body = json.dumps({'error': str(err)}).encode('utf-8')
+                except Exception as err:
+                    status, content_type = 500, 'application/json'
+                    body = json.dumps({'error': repr(err)}).encode('utf-8')
+
+                writer.write(f'HTTP/1.1 {status} {STATUS[status]}\r\nContent-Type: {content_type}\r\n'
+                             f'Content-Length: {len(body)}\r\n'
+                             f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode('latin-1') + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def watch(self, every=5):
+        """
+        Checks for a new manifold every `every` seconds.
+        """
+        while True:
+            await asyncio.sleep(every)
+            await self.refresh()
+
+    async def serve(self, host='127.0.0.1', port=8765, unix=None):
+        """
+        Serves until cancelled.
+
+        :param str host:
+        :param int port:
+        :param unix: str or NoneType serve on this unix socket instead.
+        :return: NoneType
+        """
+        if unix is not None:
+            server = await asyncio.start_unix_server(self.handle, path=unix)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        watcher = asyncio.ensure_future(self.watch())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            watcher.cancel()
+            self.pool.shutdown(wait=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves playlists from a manifold.')
+    parser.add_argument('--manifold', default='manifold.pkl', help='the pickled manifold or ManifoldModel')
+    parser.add_argument('--tags', default=None, help='the tag dictionary, default is the one learning uses')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', default=None, help='serve on this unix socket instead')
+    parser.add_argument('--cache', type=int, default=4096, help='playlists to cache')
+    parser.add_argument('--workers', type=int, default=4, help='threads working out playlists')
+    args = parser.parse_args()
+    server = PlaylistServer(args.manifold, args.tags, cache_size=args.cache, workers=args.workers)
+    print(f'Serving {len(server.index)} songs on {args.unix or f"http://{args.host}:{args.port}"}')
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+import logging
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+DONE = object()
+# What compute is expected to raise for a song it can't analyze, or for every song a killed worker had. Anything else
+# is a bug, and stops the run rather than being written down as a failed song.
+FAILURES = (BrokenProcessPool, OSError, RuntimeError, MemoryError, ValueError)
+
+log = logging.getLogger(__name__)
+
+
+class StagedPipeline:
+    """
+    Runs a decode, compute, write job as three overlapping stages, so that neither the disk nor the CPUs sit idle
+    waiting on the other:
+
+    1. `decoders` threads each take an item and `decode` it, into a queue that holds at most `prefetch` results. This
+       should be I/O, which is why threads are enough.
+    2. A pool of `workers` processes runs `compute` on the decoded items, with at most ``2 * workers`` handed out at
+       once.
+    3. A writer thread collects what comes back and hands it on `batch_size` at a time.
+
+    Every queue is bounded, so memory use is capped by `prefetch` and `workers` rather than by how many items there
+    are. :meth:`depths` shows how full each stage is. If the decoded queue is always empty, decoding is the bottleneck,
+    if it's always full, computing is.
+
+    ``analysis.preprocess`` uses this with ``analysis.decode_window`` and ``analysis.analyze_window``, or with
+    ``analysis.decode_windows`` and ``analysis.analyze_windows`` for several configs at once.
+
+    :param decode: function of an item, returning what `compute` needs, or None if the item can't be used.
+
+    :param compute: picklable, module level function run on the process pool.
+
+    :param int decoders: threads running `decode`.
+
+    :param int workers: processes running `compute`.
+
+    :param int prefetch: decoded items to hold in memory, waiting for a worker.
+
+    :param int batch_size: the most results to hand to the writer at once.
+    """
+
+    def __init__(self, decode, compute, decoders=4, workers=2, prefetch=8, batch_size=32):
+        self.decode = decode
+        self.compute = compute
+        self.decoders = decoders
+        self.workers = workers
+        self.batch_size = batch_size
+        self.decoded = queue.Queue(prefetch)
+        self.computed = queue.Queue(prefetch)
+        self.slots = threading.Semaphore(2 * workers)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.error = None
+        self.stopping = threading.Event()
+
+    def depths(self):
+        """
+        How much work is waiting at each stage.
+
+        :return: dict with the number of items decoded and waiting for a worker, being computed, and waiting to be
+        written.
+        """
+        return {'decoded': self.decoded.qsize(), 'computing': self.in_flight, 'to_write': self.computed.qsize()}
+
+    def _decode(self, items, lock):
+        """
+        The decoder threads. They stop taking items as soon as the run is stopping or something has failed.
+        """
+        try:
+            while not self.stopping.is_set() and self.error is None:
+                with lock:
+                    item = next(items, DONE)
+                if item is DONE:
+                    break
+                try:
+                    decoded = self.decode(item)
+                except (OSError, RuntimeError, MemoryError):
+                    decoded = None
+                self.decoded.put((item, decoded))
+        finally:
+            self.decoded.put(DONE)
+
+    def _write(self, write):
+        """
+        The writer thread. If `write` fails, the rest of the results are drained without writing, so the other stages
+        don't block, and the error is raised by :meth:`run`.
+        """
+        batch = []
+        while True:
+            result = self.computed.get()
+            done = result is DONE
+            if not done:
+                batch.append(result)
+            if batch and self.error is None and (done or len(batch) >= self.batch_size or self.computed.empty()):
+                try:
+                    write(batch)
+                except Exception as err:
+                    self.error = err
+                batch = []
+            if done:
+                break
+
+    def _finish(self, item, future):
+        """
+        Called by the process pool as each item is computed. Whatever went wrong, the item is handed on and its slot is
+        given back, or :meth:`run` would wait on it forever. The item fails if `compute` raised one of ``FAILURES``,
+        anything else is logged and raised by :meth:`run`.
+        """
+        result = None
+        try:
+            result = future.result()
+        except FAILURES:
+            # That includes BrokenProcessPool, when a worker was killed, e.g. by the OOM killer. Every item it had
+            # fails with it, and run starts a new pool.
+            pass
+        except Exception as err:
+            log.exception('Computing %s failed.', item)
+            if self.error is None:
+                self.error = err
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+            self.slots.release()
+            self.computed.put((item, result))
+
+    def run(self, items, write):
+        """
+        Decodes and computes every item, handing the results to `write` in batches as they come in. Returns once
+        everything has been written.
+
+        :param items: iterable of things to decode. It's shared between the decoder threads, so it can be a generator
+        that's still producing them.
+
+        :param write: function taking a list of (item, result) pairs, where the result is None if the item couldn't be
+        decoded or computed. It's always called from the same thread.
+
+        Once anything goes wrong, no more items are handed out, and whatever is already being worked on is finished and
+        written before the error is raised.
+
+        :return: NoneType
+        """
+        items = iter(items)
+        lock = threading.Lock()
+        decoders = [threading.Thread(target=self._decode, args=(items, lock), daemon=True)
+                    for _ in range(self.decoders)]
+        writer = threading.Thread(target=self._write, args=(write,), daemon=True)
+        for thread in decoders + [writer]:
+            thread.start()
+
+        pool = ProcessPoolExecutor(self.workers)
+        remaining = self.decoders
+        try:
+            while remaining:
+                decoded = self.decoded.get()
+                if decoded is DONE:
+                    remaining -= 1
+                    continue
+                if self.error is not None:
+                    # Something already failed, so what's left is only taken off the queue for the decoders to stop.
+                    continue
+                item, window = decoded
+                if window is None:
+                    self.computed.put((item, None))
+                    continue
+                self.slots.acquire()
+                with self.lock:
+                    self.in_flight += 1
+                try:
+                    future = pool.submit(self.compute, window)
+                except BrokenProcessPool:
+                    # A worker died. What it had has already failed in _finish, the rest carry on in a new pool.
+                    pool.shutdown(wait=True)
+                    pool = ProcessPoolExecutor(self.workers)
+                    future = pool.submit(self.compute, window)
+                future.add_done_callback(partial(self._finish, item))
+        finally:
+            # However this loop ended, the decoders and the writer are told to stop, and waited for, so nothing is left
+            # blocked on a queue holding whatever write has open.
+            self.stopping.set()
+            while remaining:
+                if self.decoded.get() is DONE:
+                    remaining -= 1
+            pool.shutdown(wait=True)
+            self.computed.put(DONE)
+            writer.join()
+        if self.error is not None:
+            raise self.error
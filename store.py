@@ -0,0 +1,172 @@
+import json
+import os
+
+import numpy as np
+
+import instrument
+from library import trim_partial_line
+
+
+class FeatureStore:
+    """
+    All of the cepstra in one place. The arrays are stored back to back as float32 in a single data file, and an index
+    file records where each tag's array starts and what shape it is. New arrays are only ever appended, so adding a
+    song costs the same no matter how big the store is. If a tag is appended twice, the newer array wins.
+
+    Reading uses ``np.memmap``, so loading a store gives views into the file rather than copies, and the operating
+    system only pages in the parts that actually get used.
+
+    Only one process should append at a time. ``analysis.preprocess`` has its workers hand their cepstra back to the
+    parent, which does all of the writing.
+
+    The index file may start with a line naming the data file it belongs to. ``compact`` writes its arrays to a new
+    data file and then swaps in an index that names it, so the store flips from the old arrays to the new ones in a
+    single rename.
+
+    :param str loc: the folder to keep the store in. It's only created once something is written to it, so opening a
+    store that isn't there just gives an empty one.
+
+    :param namespace: str or NoneType keeps a separate set of arrays in a subfolder of `loc`, so that features from
+    different analyses of the same songs (see ``analysis.config_name``) can live side by side.
+    """
+
+    def __init__(self, loc='cepstra.store', namespace=None):
+        if namespace is not None:
+            loc = os.path.join(loc, namespace)
+        self.loc = loc
+        self.namespace = namespace
+        self.data_loc = os.path.join(loc, 'data.f32')
+        self.index_loc = os.path.join(loc, 'index.jsonl')
+        self.index = {}
+        # Where the data of the last indexed array ends, in floats. Anything after it was never indexed.
+        self.end = 0
+        if os.path.exists(self.index_loc):
+            with open(self.index_loc, encoding='utf-8') as file:
+                for line in file:
+                    # A line cut off part way through, or mangled, belongs to an append that never finished.
+                    if not line.endswith('\n'):
+                        continue
+                    try:
+                        entry = json.loads(line)
+                        if 'data' in entry:
+                            self.data_loc = os.path.join(loc, entry['data'])
+                            continue
+                        offset, shape = entry['offset'], tuple(entry['shape'])
+                    except (ValueError, KeyError, TypeError):
+                        continue
+                    self.index[entry['tag']] = (offset, shape)
+                    self.end = max(self.end, offset + int(np.prod(shape)))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, tag):
+        return tag in self.index
+
+    def __getitem__(self, tag):
+        offset, shape = self.index[tag]
+        return self._memmap()[offset:offset + int(np.prod(shape))].reshape(shape)
+
+    def keys(self):
+        return self.index.keys()
+
+    def _memmap(self):
+        if self.end == 0:
+            return np.zeros(0, dtype=np.float32)
+        # Only as far as the index goes, so a half written array at the end doesn't get in the way.
+        return np.memmap(self.data_loc, dtype=np.float32, mode='r', shape=(self.end,))
+
+    def append(self, tag, array):
+        """
+        Adds an array to the end of the store. The data is written before the index entry, so if this gets interrupted
+        the store is left as it was.
+
+        :param str tag: corpus tag
+
+        :param np.array array: the cepstrum
+
+        :return: NoneType
+        """
+        self.extend([(tag, array)])
+
+    def extend(self, items):
+        """
+        Adds a batch of arrays to the end of the store, with one write and one sync for the lot. Whatever an
+        interrupted append left behind, data past the last indexed array or half an index line, is cut off first.
+
+        :param items: list of (tag, np.array) pairs.
+
+        :return: NoneType
+        """
+        arrays = [(tag, np.ascontiguousarray(array, dtype=np.float32)) for tag, array in items]
+        entries = []
+        os.makedirs(self.loc, exist_ok=True)
+        if os.path.exists(self.data_loc) and os.path.getsize(self.data_loc) > self.end * 4:
+            os.truncate(self.data_loc, self.end * 4)
+        trim_partial_line(self.index_loc)
+        with instrument.span('store.write', songs=len(arrays), bytes=sum(array.nbytes for _, array in arrays)), \
+                open(self.data_loc, 'ab') as file:
+            end = self.end
+            for tag, array in arrays:
+                entries.append((tag, end, array.shape))
+                end += array.size
+            file.write(b''.join(array.tobytes() for _, array in arrays))
+            file.flush()
+            os.fsync(file.fileno())
+        with open(self.index_loc, 'a', encoding='utf-8') as file:
+            file.write(''.join(json.dumps({'tag': tag, 'offset': offset, 'shape': list(shape)}) + '\n'
+                               for tag, offset, shape in entries))
+        for tag, offset, shape in entries:
+            self.index[tag] = (offset, shape)
+        self.end = end
+
+    def load(self):
+        """
+        Opens every array in the store without copying any of them.
+
+        :return: dict relating tags to read-only np.memmap views.
+        """
+        data = self._memmap()
+        return {tag: data[offset:offset + int(np.prod(shape))].reshape(shape)
+                for tag, (offset, shape) in self.index.items()}
+
+    def compact(self):
+        """
+        Rewrites the store without the arrays that were superseded by a later append. The live arrays go to a fresh
+        data file, then an index naming that file replaces the old index in one rename, so if this is interrupted the
+        store is either all old or all new. The old data file is removed last.
+
+        :return: NoneType
+        """
+        if not os.path.exists(self.loc):
+            return
+        arrays = self.load()
+        name = os.path.basename(self.data_loc)
+        generation = int(name.split('.')[1]) + 1 if name.count('.') == 2 else 1
+        data_name = f'data.{generation}.f32'
+        data_loc = os.path.join(self.loc, data_name)
+        index = {}
+        end = 0
+        with open(data_loc, 'wb') as file:
+            for tag, array in arrays.items():
+                array = np.ascontiguousarray(array, dtype=np.float32)
+                index[tag] = (end, array.shape)
+                end += array.size
+                file.write(array.tobytes())
+            file.flush()
+            os.fsync(file.fileno())
+        del arrays
+        index_tmp = self.index_loc + '.tmp'
+        with open(index_tmp, 'w', encoding='utf-8') as file:
+            file.write(json.dumps({'data': data_name}) + '\n')
+            file.write(''.join(json.dumps({'tag': tag, 'offset': offset, 'shape': list(shape)}) + '\n'
+                               for tag, (offset, shape) in index.items()))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(index_tmp, self.index_loc)
+        old = self.data_loc
+        self.data_loc = data_loc
+        self.index = index
+        self.end = end
+        if os.path.exists(old) and old != data_loc:
+            os.remove(old)
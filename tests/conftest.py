@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules live at the top of the repository rather than in a package, like the benchmarks expect.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
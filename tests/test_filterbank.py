@@ -0,0 +1,31 @@
+"""
+``filterbank.gtgram`` against the ``gammatone.gtgram`` MATLAB port it replaced. The ``gammatone`` package isn't a
+dependency of ongaku anymore, so these are skipped where it isn't installed.
+"""
+import numpy as np
+import pytest
+
+import filterbank
+
+gt = pytest.importorskip('gammatone.gtgram')
+
+
+def synthetic_wave(seconds=3, sr=22050):
+    rs = np.random.RandomState(0)
+    t = np.arange(int(seconds * sr)) / sr
+    return 0.3 * np.sin(2 * np.pi * 440 * t) + 0.1 * np.sin(2 * np.pi * 3000 * t) + 0.05 * rs.randn(len(t)), sr
+
+
+def decibels(sxx):
+    with np.errstate(divide='ignore'):
+        return 10 * np.log10(sxx)
+
+
+@pytest.mark.parametrize('interval, height, blocksize', [(0.25, 16, 2 ** 16), (0.1, 32, 2 ** 16), (0.25, 16, 3000)])
+def test_gtgram_matches_gammatone(interval, height, blocksize):
+    wave, sr = synthetic_wave()
+    ref = decibels(gt.gtgram(wave, sr, interval, interval, height, 20))
+    new = decibels(filterbank.gtgram(wave.astype(np.float32), sr, interval, height, 20, blocksize=blocksize))
+    assert new.shape == ref.shape
+    loud = ref > -100
+    assert np.abs(ref - new)[loud].max() < filterbank.DB_TOLERANCE
@@ -0,0 +1,74 @@
+"""
+``learning.Corpus`` against the dict functions it stands in for, ``cropped_corpus``, ``padded_corpus`` and
+``flattened_corpus``.
+"""
+import numpy as np
+import pytest
+
+from learning import Corpus, cropped_corpus, flattened_corpus, padded_corpus
+
+# The dict functions pad with np.log(0).
+pytestmark = pytest.mark.filterwarnings('ignore:divide by zero:RuntimeWarning')
+
+
+@pytest.fixture
+def corp():
+    """
+    Songs of odd and even lengths, some shorter than the crops below, and one exactly as long as one of them.
+    """
+    rs = np.random.RandomState(0)
+    lengths = {'A - B - long': 41, 'A - B - even': 30, 'A - C - exact': 20, 'D - E - short': 13, 'D - E - tiny': 4}
+    return {tag: rs.randn(3, n).astype(np.float32) for tag, n in lengths.items()}
+
+
+def finite(song):
+    return song[np.isfinite(song)]
+
+
+def test_to_dict_round_trip(corp):
+    packed = Corpus.from_dict(corp)
+    assert packed.tags[0] == 'A - B - long' and packed.tags[-1] == 'D - E - tiny'
+    unpacked = packed.to_dict()
+    assert unpacked.keys() == corp.keys()
+    for tag, song in corp.items():
+        np.testing.assert_array_equal(unpacked[tag], song)
+
+
+@pytest.mark.parametrize('tar_len', [20, 12, 50])
+def test_crop_matches_cropped_corpus(corp, tar_len):
+    cropped = Corpus.from_dict(corp).crop(tar_len)
+    expected = cropped_corpus(corp, tar_len)
+    assert set(cropped.tags) == set(expected)
+    for tag, song in expected.items():
+        np.testing.assert_array_equal(cropped[tag], song)
+    if expected:
+        np.testing.assert_array_equal(cropped.flatten(), np.array([flattened_corpus(expected)[tag]
+                                                                   for tag in cropped.tags]))
+
+
+@pytest.mark.parametrize('tar_len', [20, 12, 50])
+def test_crop_pads_short_songs(corp, tar_len):
+    # cropped_corpus pads at the end and Corpus on both sides, so only the songs themselves and the shapes agree.
+    cropped = Corpus.from_dict(corp).crop(tar_len, pad_shorts=True)
+    expected = cropped_corpus(corp, tar_len, pad_shorts=True)
+    assert set(cropped.tags) == set(expected) == set(corp)
+    for tag, song in expected.items():
+        assert cropped[tag].shape == song.shape == (3, tar_len)
+        np.testing.assert_array_equal(finite(cropped[tag]), finite(song))
+
+
+def test_from_dict_tar_len_matches_crop(corp):
+    for pad_shorts in (False, True):
+        whole = Corpus.from_dict(corp).crop(20, pad_shorts)
+        packed = Corpus.from_dict(corp, tar_len=20).crop(20, pad_shorts)
+        assert packed.tags == whole.tags
+        np.testing.assert_array_equal(packed.data, whole.data)
+
+
+def test_pad_matches_padded_corpus(corp):
+    padded = Corpus.from_dict(corp).pad()
+    expected = padded_corpus(corp)
+    assert set(padded.tags) == set(expected)
+    for tag, song in expected.items():
+        assert padded[tag].shape == song.shape
+        np.testing.assert_array_equal(finite(padded[tag]), finite(song))
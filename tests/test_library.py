@@ -0,0 +1,59 @@
+"""
+The manifest's ledger, and how failures are counted, in ``library``.
+"""
+import os
+
+from library import (append_ledger, ledger_location, load_manifest, quarantined, record_failure, save_manifest,
+                     trim_partial_line)
+
+
+def record(status='done', attempts=0):
+    return {'size': 1, 'mtime': 1, 'tag': 'Artist - Album - Song', 'status': status, 'attempts': attempts}
+
+
+def test_trim_partial_line(tmp_path):
+    loc = str(tmp_path / 'lines')
+    assert trim_partial_line(loc) == 0
+    with open(loc, 'wb') as file:
+        file.write(b'one\ntwo\nthr')
+    assert trim_partial_line(loc) == 3
+    with open(loc, 'rb') as file:
+        assert file.read() == b'one\ntwo\n'
+    assert trim_partial_line(loc) == 0
+    # A single line longer than the blocks it's searched in, with no newline at all.
+    with open(loc, 'wb') as file:
+        file.write(b'x' * 10000)
+    assert trim_partial_line(loc) == 10000
+    assert os.path.getsize(loc) == 0
+
+
+def test_ledger_is_applied_on_load_and_folded_in_on_save(tmp_path):
+    loc = str(tmp_path / 'manifest.pkl')
+    manifest = {'a.flac': record(), 'b.flac': record('new')}
+    save_manifest(manifest, loc)
+    manifest['b.flac'] = record('failed', 1)
+    manifest['c.flac'] = record()
+    append_ledger(manifest, ['b.flac'], loc)
+    append_ledger(manifest, ['c.flac'], loc)
+    assert load_manifest(loc) == manifest
+    save_manifest(manifest, loc)
+    assert not os.path.exists(ledger_location(loc))
+    assert load_manifest(loc) == manifest
+
+
+def test_torn_ledger_line_is_skipped_and_trimmed(tmp_path):
+    loc = str(tmp_path / 'manifest.pkl')
+    manifest = {'a.flac': record()}
+    append_ledger(manifest, ['a.flac'], loc)
+    with open(ledger_location(loc), 'a', encoding='utf-8') as file:
+        file.write('{"song": "b.flac", "rec')
+    assert load_manifest(loc) == manifest
+    manifest['c.flac'] = record()
+    append_ledger(manifest, ['c.flac'], loc)
+    assert load_manifest(loc) == manifest
+
+
+def test_failures_are_quarantined_after_the_retries():
+    entry = record('new')
+    assert [record_failure(entry, retries=2) for _ in range(3)] == ['failed', 'failed', 'quarantined']
+    assert quarantined({'a.flac': entry, 'b.flac': record()}) == ['a.flac']
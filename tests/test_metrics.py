@@ -0,0 +1,115 @@
+"""
+The vectorized metrics against the per-group loops and ``pdist`` they replaced, on a synthetic manifold.
+"""
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.spatial.distance import pdist
+
+import metrics
+
+
+def synthetic_manifold(dims=5, seed=0):
+    """
+    Artists with one album of one song, a few small albums, and one album too big to batch, so every path in
+    ``metrics.group_log_distances`` gets used. The songs are shuffled so groups aren't contiguous.
+    """
+    rs = np.random.RandomState(seed)
+    sizes = {('Solo', 'Single'): 1, ('Band', 'First'): 3, ('Band', 'Second'): 3, ('Duo', 'Only'): 7,
+             ('Various', 'Huge'): 80, ('Aardvark', 'Pair'): 2}
+    tags = [f'{artist} - {album} - {i:03}' for (artist, album), n in sizes.items() for i in range(n)]
+    tags = [tags[i] for i in rs.permutation(len(tags))]
+    return pd.DataFrame(rs.randn(dims, len(tags)), columns=tags)
+
+
+def old_groups(mdf, level):
+    names = np.unique([code.split(' - ')[level] for code in mdf])
+    return {name: np.array([mdf[code].values for code in mdf if code.split(' - ')[level] == name]) for name in names}
+
+
+def old_log_distances(mdf, level):
+    # A group of one song has no pairs, and the mean of nothing is nan, with a warning.
+    with np.errstate(divide='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return {name: np.nanmean(np.log(pdist(songs))) / np.log(songs.shape[1])
+                for name, songs in old_groups(mdf, level).items()}
+
+
+def old_xdsd(mdf, level):
+    return {name: np.nanmean(songs.std(axis=0)) for name, songs in old_groups(mdf, level).items()}
+
+
+def assert_same_dict(new, old):
+    assert list(new) == list(old)
+    np.testing.assert_allclose(list(new.values()), list(old.values()), rtol=1e-10, equal_nan=True)
+
+
+@pytest.mark.parametrize('level', [metrics.ARTIST, metrics.ALBUM])
+def test_group_songs_match_loops(level):
+    mdf = synthetic_manifold()
+    new = metrics.group_songs(mdf, level)
+    old = old_groups(mdf, level)
+    assert list(new) == list(old)
+    for name in old:
+        np.testing.assert_array_equal(new[name], old[name])
+
+
+def test_group_metrics_match_loops():
+    mdf = synthetic_manifold()
+    assert_same_dict(metrics.artist_metric(mdf), old_log_distances(mdf, metrics.ARTIST))
+    assert_same_dict(metrics.album_metric(mdf), old_log_distances(mdf, metrics.ALBUM))
+    assert_same_dict(metrics.artist_xdsd(mdf), old_xdsd(mdf, metrics.ARTIST))
+    assert_same_dict(metrics.album_xdsd(mdf), old_xdsd(mdf, metrics.ALBUM))
+
+
+def test_group_metrics_small_batches():
+    mdf = synthetic_manifold()
+    old = old_log_distances(mdf, metrics.ALBUM)
+    # One group per batch, and everything through pairwise_stats.
+    for batch, small in [(1, 64), (2 ** 22, 1)]:
+        new = dict(zip(metrics.group_index(mdf, metrics.ALBUM).names,
+                       metrics.group_log_distances(mdf, metrics.ALBUM, batch=batch, small=small)))
+        assert_same_dict(new, old)
+
+
+def test_averages_match_loops():
+    mdf = synthetic_manifold()
+    for level, average in [(metrics.ARTIST, metrics.avg_artist_metric), (metrics.ALBUM, metrics.avg_album_metric)]:
+        assert average(mdf) == pytest.approx(np.nanmean(list(old_log_distances(mdf, level).values())), rel=1e-10)
+    for level, average in [(metrics.ARTIST, metrics.avg_artist_xdsd), (metrics.ALBUM, metrics.avg_album_xdsd)]:
+        assert average(mdf) == pytest.approx(np.nanmean(list(old_xdsd(mdf, level).values())), rel=1e-10)
+
+
+@pytest.mark.parametrize('block', [2048, 7])
+def test_pairwise_stats_match_pdist(block):
+    rs = np.random.RandomState(1)
+    songs = rs.randn(60, 4) * 3 + 100
+    # Duplicates far from the origin, which the matrix product alone would get wrong.
+    songs[10] = songs[3]
+    songs[45] = songs[3]
+    dists = pdist(songs)
+    stats = metrics.pairwise_stats(songs, block=block)
+    assert stats.count == stats.population == len(dists)
+    assert not stats.sampled
+    assert stats.min == 0
+    assert stats.max == pytest.approx(dists.max(), rel=1e-10)
+    assert stats.mean == pytest.approx(dists.mean(), rel=1e-10)
+    assert stats.std == pytest.approx(dists.std(), rel=1e-8)
+    with np.errstate(divide='ignore'):
+        logs = np.log(dists)
+    assert stats.log_mean == -np.inf == logs.mean()
+    nonzero = metrics.pairwise_stats(np.delete(songs, [10, 45], axis=0), block=block)
+    assert nonzero.log_mean == pytest.approx(np.log(pdist(np.delete(songs, [10, 45], axis=0))).mean(), rel=1e-10)
+
+
+def test_corpus_cohesion_exact_and_sampled():
+    mdf = synthetic_manifold()
+    expected = pdist(mdf.values.T).mean() / np.log(mdf.shape[0])
+    assert metrics.corpus_cohesion(mdf) == pytest.approx(expected, rel=1e-10)
+    # Asking for at least every pair gives the exact answer back.
+    assert metrics.corpus_cohesion(mdf, pairs=10 ** 6) == pytest.approx(expected, rel=1e-10)
+    estimate, low, high = metrics.corpus_cohesion_interval(mdf, pairs=2000, random_state=0)
+    assert low < expected < high
+    assert estimate == pytest.approx(expected, rel=0.1)
@@ -0,0 +1,88 @@
+"""
+``analysis.preprocess`` end to end, on a few seconds of synthetic FLACs.
+"""
+import os
+import re
+
+import numpy as np
+import pytest
+
+sf = pytest.importorskip('soundfile')
+FLAC = pytest.importorskip('mutagen.flac').FLAC
+
+import analysis  # noqa: E402
+import learning  # noqa: E402
+from library import ledger_location, load_manifest, quarantined  # noqa: E402
+
+SR = 8000
+
+
+def write_song(loc, title, seconds=12, freq=300):
+    os.makedirs(os.path.dirname(loc), exist_ok=True)
+    t = np.arange(seconds * SR) / SR
+    sf.write(loc, np.column_stack([np.sin(2 * np.pi * freq * t)] * 2) * 0.3, SR)
+    tags = FLAC(loc)
+    tags['artist'] = 'Artist'
+    tags['album'] = 'Album'
+    tags['title'] = title
+    tags.save()
+
+
+@pytest.fixture
+def library(tmp_path, monkeypatch):
+    """
+    Three songs, in a library, with preprocess run from a scratch folder.
+    """
+    folder = tmp_path / 'library'
+    for i in range(3):
+        write_song(str(folder / 'Artist' / 'Album' / f'{i}.flac'), f'Song{i}', freq=300 + 100 * i)
+    work = tmp_path / 'work'
+    work.mkdir()
+    monkeypatch.chdir(work)
+    return str(folder) + os.sep
+
+
+def run(library, **kwargs):
+    return analysis.preprocess(re.compile(''), library_locale=library, locations='locations.db', **kwargs)
+
+
+def test_crop_and_whole_songs_are_kept_apart(library):
+    assert sorted(run(library, crop=4)) == ['Artist - Album - Song0', 'Artist - Album - Song1', 'Artist - Album - Song2']
+    assert len(run(library)) == 3
+    whole = learning.load_corpus()
+    cropped = learning.load_corpus(namespace=analysis.config_name({'crop': 4}))
+    assert {song.shape for song in whole.values()} == {(16, 12)}
+    assert {song.shape for song in cropped.values()} == {(16, 4)}
+    # Both are done now, so there's nothing left to do for either.
+    assert run(library, crop=4) == [] and run(library) == []
+    with pytest.raises(ValueError):
+        learning.load_corpus(namespace=analysis.config_name({'crop': 8}))
+
+
+def test_resume_retry_and_quarantine(library):
+    bad = os.path.join(library, 'Artist', 'Album', 'bad.flac')
+    with open(bad, 'wb') as file:
+        file.write(b'not a flac' * 100)
+    first = run(library, retries=1)
+    assert sorted(tag for tag in first if tag) == ['Artist - Album - Song0', 'Artist - Album - Song1',
+                                                   'Artist - Album - Song2']
+    # The unreadable song is reported as failed, then tried once more, and then left alone.
+    assert first.count(False) == 1
+    assert run(library, retries=1) == [False]
+    assert run(library, retries=1) == []
+    assert quarantined(load_manifest('manifest.pkl')) == [bad]
+
+    # Fixing the file takes it out of quarantine.
+    write_song(bad, 'Fixed')
+    assert run(library, retries=1) == ['Artist - Album - Fixed']
+    assert run(library, resume=False, retries=1) != []
+
+
+def test_interrupted_run_resumes_from_the_ledger(library, monkeypatch):
+    # As if the run was killed before the manifest was saved, with only its ledger and the store written.
+    with monkeypatch.context() as patch:
+        patch.setattr(analysis, 'save_manifest', lambda manifest, loc: None)
+        assert len(run(library)) == 3
+    assert not os.path.exists('manifest.pkl') and os.path.exists(ledger_location('manifest.pkl'))
+    assert run(library) == []
+    assert not os.path.exists(ledger_location('manifest.pkl'))
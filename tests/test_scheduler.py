@@ -0,0 +1,53 @@
+"""
+``scheduler.MemoryScheduler``: which jobs are charged a retry when they run out of memory or their worker is killed.
+"""
+import os
+import signal
+import sys
+import time
+
+import pytest
+
+from scheduler import MemoryScheduler
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason='needs SIGKILL')
+
+
+def job(name):
+    """
+    Runs in the pool. 'kill' has its worker killed, like the OOM killer would, 'oom' raises a MemoryError, and 'kill
+    once' is only killed the first time it runs, which it finds out from the file named after it.
+    """
+    if name == 'oom':
+        raise MemoryError
+    if name == 'kill' or (name.startswith('kill once') and not os.path.exists(name[len('kill once '):])):
+        if name != 'kill':
+            open(name[len('kill once '):], 'w').close()
+        time.sleep(0.2)
+        os.kill(os.getpid(), signal.SIGKILL)
+    time.sleep(0.5)
+    return name
+
+
+def run(jobs, workers=3, retries=1):
+    results = dict(MemoryScheduler(10 ** 9, workers=workers, retries=retries).imap_unordered(job, jobs, lambda j: 1))
+    return [results[i] for i in range(len(jobs))]
+
+
+def test_results_come_back_for_every_job():
+    assert run(['a', 'b', 'c', 'd', 'e']) == ['a', 'b', 'c', 'd', 'e']
+
+
+def test_memory_error_is_retried_then_given_up():
+    assert run(['a', 'oom', 'b']) == ['a', None, 'b']
+
+
+def test_only_the_killed_job_is_charged():
+    # With no retries, any job that was charged for the kill would come back as None.
+    assert run(['a', 'kill', 'b', 'c'], retries=0) == ['a', None, 'b', 'c']
+
+
+def test_killed_job_is_retried(tmp_path):
+    marker = str(tmp_path / 'killed')
+    assert run(['a', f'kill once {marker}', 'b'], retries=1) == ['a', f'kill once {marker}', 'b']
+    assert os.path.exists(marker)
@@ -0,0 +1,103 @@
+"""
+``store.FeatureStore``: appends, recovery from appends that were cut off, and compaction.
+"""
+import json
+import os
+
+import numpy as np
+
+from store import FeatureStore
+
+
+def arrays(n=4, seed=0):
+    rs = np.random.RandomState(seed)
+    return [(f'Artist - Album - {i}', rs.rand(3, 5 + i).astype(np.float32)) for i in range(n)]
+
+
+def assert_loads(features, expected):
+    loaded = features.load()
+    assert list(loaded) == list(expected)
+    for tag, array in expected.items():
+        np.testing.assert_array_equal(loaded[tag], array)
+        np.testing.assert_array_equal(features[tag], array)
+
+
+def test_append_and_reopen(tmp_path):
+    loc = str(tmp_path / 'cepstra.store')
+    features = FeatureStore(loc)
+    items = arrays()
+    features.append(*items[0])
+    features.extend(items[1:])
+    assert len(features) == 4 and items[2][0] in features
+    assert_loads(FeatureStore(loc), dict(items))
+
+
+def test_newer_append_wins(tmp_path):
+    loc = str(tmp_path / 'cepstra.store')
+    items = arrays()
+    FeatureStore(loc).extend(items)
+    replacement = np.full((3, 2), 7, dtype=np.float32)
+    FeatureStore(loc).append(items[1][0], replacement)
+    assert_loads(FeatureStore(loc), dict(items, **{items[1][0]: replacement}))
+
+
+def test_opening_creates_nothing(tmp_path):
+    loc = str(tmp_path / 'cepstra.store')
+    features = FeatureStore(loc, namespace='gamma-h16-i1')
+    assert len(features) == 0 and features.load() == {}
+    assert not os.path.exists(loc)
+
+
+def test_recovers_from_interrupted_append(tmp_path):
+    loc = str(tmp_path / 'cepstra.store')
+    items = arrays()
+    FeatureStore(loc).extend(items[:2])
+    # An append killed part way: its data was written, but only half of its index line.
+    with open(os.path.join(loc, 'data.f32'), 'ab') as file:
+        file.write(items[2][1].tobytes())
+    with open(os.path.join(loc, 'index.jsonl'), 'a', encoding='utf-8') as file:
+        file.write(json.dumps({'tag': items[2][0], 'offset': 0, 'shape': [3, 7]})[:20])
+    features = FeatureStore(loc)
+    assert_loads(features, dict(items[:2]))
+    features.extend(items[2:])
+    assert_loads(FeatureStore(loc), dict(items))
+    assert os.path.getsize(os.path.join(loc, 'data.f32')) == sum(array.nbytes for _, array in items)
+
+
+def test_compact(tmp_path):
+    loc = str(tmp_path / 'cepstra.store')
+    items = arrays()
+    features = FeatureStore(loc)
+    features.extend(items)
+    replacement = np.zeros((3, 1), dtype=np.float32)
+    features.append(items[0][0], replacement)
+    expected = dict(items, **{items[0][0]: replacement})
+    features.compact()
+    assert_loads(features, expected)
+    assert sorted(os.listdir(loc)) == ['data.1.f32', 'index.jsonl']
+    assert os.path.getsize(os.path.join(loc, 'data.1.f32')) == sum(array.nbytes for array in expected.values())
+
+    # Appending to a compacted store goes to its new data file, and compacting again starts another generation.
+    reopened = FeatureStore(loc)
+    assert_loads(reopened, expected)
+    extra = arrays(6, seed=1)[5]
+    reopened.append(*extra)
+    reopened.compact()
+    expected[extra[0]] = extra[1]
+    assert_loads(FeatureStore(loc), expected)
+    assert sorted(os.listdir(loc)) == ['data.2.f32', 'index.jsonl']
+
+
+def test_interrupted_compact_leaves_the_old_store(tmp_path):
+    loc = str(tmp_path / 'cepstra.store')
+    items = arrays()
+    FeatureStore(loc).extend(items)
+    # What a compaction killed before its index was swapped in leaves behind.
+    with open(os.path.join(loc, 'data.1.f32'), 'wb') as file:
+        file.write(b'\0' * 12)
+    with open(os.path.join(loc, 'index.jsonl.tmp'), 'w', encoding='utf-8') as file:
+        file.write(json.dumps({'data': 'data.1.f32'}) + '\n')
+    features = FeatureStore(loc)
+    assert_loads(features, dict(items))
+    features.compact()
+    assert_loads(FeatureStore(loc), dict(items))
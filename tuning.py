@@ -0,0 +1,261 @@
+"""
+Tries out a lot of manifold pipelines on the same corpus, and tables how each did on the ``metrics``. The scorers in
+``metrics`` are fine for the odd ``GridSearchCV``, but every one of their calls unpickles the whole corpus again, and
+every candidate refits every step of its pipeline, even when the step before the embedding is the same PCA for all of
+them. Here, instead:
+
+1. The corpus is cropped, flattened and scaled once, like ``learning.make_manifold`` does it, straight into a block of
+   shared memory. Worker processes read the songs from there rather than getting a copy each, along with the artist
+   and album ``metrics.GroupIndex``, which is also only worked out once.
+2. Every step of a pipeline but the last is a prefix, and each distinct prefix is fit once, in parallel, with the
+   output of every step saved in `cache_dir`. Candidates with the same scaler and PCA, say, share those, and so do
+   later runs on the same corpus.
+3. Each candidate then only fits its last step on its prefix's output, as soon as that's ready, and is scored.
+
+    import tuning
+    from learning import default_pipeline
+    candidates = tuning.grid_candidates(default_pipeline(), {'reduce_dims__n_components': [50, 100],
+                                                             'embedding__n_neighbors': [5, 10, 20]})
+    results = tuning.tune(candidates, workers=4)
+    print(results.sort_values('album_metric').to_string())
+"""
+import hashlib
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing.shared_memory import SharedMemory
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+from sklearn.base import clone
+from sklearn.model_selection import ParameterGrid
+
+import metrics
+from learning import Corpus, load_corpus, robust_scale, robust_scale_params, song_batches
+
+METRICS = {
+    'album_metric': metrics.avg_album_metric,
+    'artist_metric': metrics.avg_artist_metric,
+    'album_xdsd': metrics.avg_album_xdsd,
+    'artist_xdsd': metrics.avg_artist_xdsd,
+    'corpus_xdsd': metrics.corpus_xdsd,
+}
+
+_worker = {}
+
+
+def grid_candidates(pipeline, grid):
+    """
+    A candidate for every combination of parameters in a grid, like ``GridSearchCV`` would try.
+
+    :param pipeline: sklearn.pipeline.Pipeline
+    :param grid: dict or list of dicts, as for ``sklearn.model_selection.ParameterGrid``.
+    :return: dict relating a name for each combination to its pipeline.
+    """
+    return {', '.join(f'{key}={value}' for key, value in params.items()) or 'default': clone(pipeline).set_params(
+        **params) for params in ParameterGrid(grid)}
+
+
+def shared_songs(corp=None, tar_len=120, pad_shorts=True, lower=-1000, upper=5, batch_size=512):
+    """
+    Crops, flattens and scales a corpus the way ``learning.make_manifold`` does, into shared memory. The songs are
+    copied in a batch at a time (see ``learning.song_batches``) and scaled in place, so there's never a second copy of
+    the whole thing.
+
+    Whoever calls this owns the shared memory, and has to ``close`` and ``unlink`` it.
+
+    :param corp: dict, Corpus or NoneType default is ``learning.load_corpus()``.
+    :param tar_len: int
+    :param pad_shorts: bool
+    :param lower: float clip below
+    :param upper: float clip above
+    :param batch_size: int songs to copy at once.
+    :return: tuple (SharedMemory, (songs, features) np.array view of it, list of tags)
+    """
+    if corp is None:
+        corp = load_corpus()
+    tags = corp.tags if isinstance(corp, Corpus) else list(corp)
+    tags = [tag for tag in tags if pad_shorts or corp[tag].shape[1] >= tar_len]
+    features = corp[tags[0]].shape[0] * tar_len
+    shm = SharedMemory(create=True, size=max(1, len(tags) * features * 4))
+    songs = np.ndarray((len(tags), features), dtype=np.float32, buffer=shm.buf)
+    order = []
+    for batch_tags, batch in song_batches(corp, tags, tar_len, pad_shorts, batch_size):
+        songs[len(order):len(order) + len(batch_tags)] = batch
+        order += batch_tags
+    center, scale = robust_scale_params(songs)
+    robust_scale(songs, lower, upper, center=center, scale=scale)
+    return shm, songs, order
+
+
+def data_key(songs, tags, **settings):
+    """
+    A short hash that changes whenever the songs do, so cached steps aren't used with some other corpus. Every byte of
+    the songs goes into it, which takes a fraction of the time of fitting anything on them.
+
+    :param np.array songs: the scaled songs
+    :param tags: list of str
+    :param settings: anything else they were made with.
+    :return: str
+    """
+    digest = hashlib.sha1(repr((songs.shape, sorted(settings.items()))).encode('utf-8'))
+    digest.update('\n'.join(tags).encode('utf-8'))
+    digest.update(np.ascontiguousarray(songs, dtype=np.float32).data)
+    return digest.hexdigest()
+
+
+def step_key(previous, step):
+    """
+    The cache key of a step's output, from the key of its input and the step's own class and parameters.
+
+    :param str previous: key of whatever the step is fit on.
+    :param step: sklearn transformer
+    :return: str
+    """
+    params = sorted(step.get_params(deep=True).items())
+    description = f'{previous} {type(step).__module__}.{type(step).__qualname__} {params!r}'
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+
+def prefix_key(key, steps):
+    for step in steps:
+        key = step_key(key, step)
+    return key
+
+
+def _attach(name, shape, tags, indexes, cache_dir):
+    """
+    Sets up a worker process, with the songs from shared memory and the group indexes made by the parent.
+    """
+    shm = SharedMemory(name=name)
+    songs = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+    songs.flags.writeable = False
+    for index in indexes:
+        metrics.remember_group_index(index)
+    _worker.update(shm=shm, songs=songs, tags=tags, cache_dir=cache_dir)
+
+
+def _save(loc, array):
+    """
+    Saves a step's output so that nothing ever sees half of it, even with two workers saving the same one.
+    """
+    tmp = f'{loc}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as file:
+        np.save(file, np.ascontiguousarray(array))
+    os.replace(tmp, loc)
+
+
+def _fit_prefix(key, steps):
+    """
+    Fits the steps one after the other, starting from the shared songs, and skipping every step whose output is
+    already cached.
+
+    :return: tuple (where the last output is, seconds spent fitting, whether all of it was cached already)
+    """
+    songs = _worker['songs']
+    seconds = 0
+    cached = True
+    loc = None
+    for step in steps:
+        key = step_key(key, step)
+        loc = os.path.join(_worker['cache_dir'], key + '.npy')
+        if os.path.exists(loc):
+            songs = np.load(loc, mmap_mode='r')
+            continue
+        st = perf_counter()
+        songs = clone(step).fit_transform(songs)
+        seconds += perf_counter() - st
+        cached = False
+        _save(loc, songs)
+    return loc, seconds, cached
+
+
+def _fit_candidate(last, prefix_loc, scorers):
+    """
+    Fits a candidate's last step on its prefix's output, and scores the result.
+
+    :return: tuple (dict of scores, seconds fitting, seconds scoring)
+    """
+    songs = _worker['songs'] if prefix_loc is None else np.load(prefix_loc, mmap_mode='r')
+    st = perf_counter()
+    transformed = clone(last).fit_transform(songs)
+    fit_seconds = perf_counter() - st
+    st = perf_counter()
+    manifold_df = pd.DataFrame(np.asarray(transformed).T, columns=_worker['tags'])
+    scores = {name: float(scorer(manifold_df)) for name, scorer in scorers.items()}
+    return scores, fit_seconds, perf_counter() - st
+
+
+def tune(candidates, corp=None, scorers=None, workers=2, cache_dir='tuning.cache', tar_len=120, pad_shorts=True,
+         lower=-1000, upper=5):
+    """
+    Fits and scores every candidate pipeline on the same corpus, `workers` at a time.
+
+    :param candidates: dict relating names to sklearn.pipeline.Pipeline, e.g. from ``grid_candidates``, or a list of
+    pipelines.
+    :param corp: dict, Corpus or NoneType default is ``learning.load_corpus()``.
+    :param scorers: dict relating names to module level functions of a manifold data frame, default is ``METRICS``.
+    :param workers: int processes fitting at once.
+    :param cache_dir: str where to keep the output of every step but the last. It's created if it doesn't exist.
+    Delete it to start from scratch.
+    :param tar_len: int
+    :param pad_shorts: bool
+    :param lower: float clip below
+    :param upper: float clip above
+    :return: pd.DataFrame one row per candidate, with its scores, how long its prefix took to fit (zero if it was
+    cached, and shared between the candidates that have it), how long its last step took, how long scoring took, and
+    the total.
+    """
+    if not isinstance(candidates, dict):
+        candidates = {str(i): pipeline for i, pipeline in enumerate(candidates)}
+    scorers = METRICS if scorers is None else scorers
+    if not os.path.exists(cache_dir):
+        os.mkdir(cache_dir)
+
+    st = perf_counter()
+    shm, songs, tags = shared_songs(corp, tar_len, pad_shorts, lower, upper)
+    try:
+        key = data_key(songs, tags, tar_len=tar_len, pad_shorts=pad_shorts, lower=lower, upper=upper)
+        indexes = [metrics.GroupIndex(tags, level) for level in (metrics.ARTIST, metrics.ALBUM)]
+        setup_seconds = perf_counter() - st
+
+        prefixes = {}
+        for name, pipeline in candidates.items():
+            steps = [step for _, step in pipeline.steps[:-1] if step not in (None, 'passthrough')]
+            prefixes.setdefault(prefix_key(key, steps), (steps, []))[1].append(name)
+
+        rows = {}
+        with ProcessPoolExecutor(workers, initializer=_attach,
+                                 initargs=(shm.name, songs.shape, tags, indexes, cache_dir)) as pool:
+            pending = {}
+            for pkey, (steps, names) in prefixes.items():
+                if steps:
+                    pending[pool.submit(_fit_prefix, key, steps)] = ('prefix', names)
+                else:
+                    for name in names:
+                        pending[pool.submit(_fit_candidate, candidates[name].steps[-1][1], None, scorers)] = (
+                            'candidate', (name, 0.0, True))
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, info = pending.pop(future)
+                    if stage == 'prefix':
+                        loc, seconds, cached = future.result()
+                        for name in info:
+                            pending[pool.submit(_fit_candidate, candidates[name].steps[-1][1], loc, scorers)] = (
+                                'candidate', (name, seconds, cached))
+                    else:
+                        name, prefix_seconds, cached = info
+                        scores, fit_seconds, score_seconds = future.result()
+                        rows[name] = dict(scores, prefix_seconds=prefix_seconds, prefix_cached=cached,
+                                          fit_seconds=fit_seconds, score_seconds=score_seconds,
+                                          seconds=prefix_seconds + fit_seconds + score_seconds)
+    finally:
+        del songs
+        shm.close()
+        shm.unlink()
+
+    results = pd.DataFrame.from_dict({name: rows[name] for name in candidates}, orient='index')
+    results.index.name = 'candidate'
+    results.attrs['setup_seconds'] = setup_seconds
+    return results